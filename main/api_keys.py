@@ -0,0 +1,171 @@
+"""
+Header token auth for the native driver app (DriverAPIKey).
+
+Clients send `Authorization: Token <raw>` (or `X-Driver-Token: <raw>`).
+verify() resolves the token through the cache (Redis when configured) keyed
+by the sha256 of the token, so a valid token costs no query after the first
+use. Bad tokens are cached briefly too. expires_at is checked on every call,
+and saving, revoking or deleting a key drops its cache entry once the change
+commits (main.signals, plus DriverAPIKey.create_for_driver for the hash it
+replaces).
+
+last_used is not written per request: touches are throttled per key and
+flushed in batches by a write-behind buffer (main.writebehind).
+
+Settings:
+  DRIVER_API_KEY_CACHE_TTL_S        seconds a verified key is trusted (default 300)
+  DRIVER_API_KEY_NEGATIVE_TTL_S     seconds an unknown/revoked token is remembered (default 30)
+  DRIVER_API_KEY_LAST_USED_S        resolution of last_used, per key and process (default 60)
+  DRIVER_API_KEY_FLUSH_MS           last_used write-behind flush interval (default 5000)
+"""
+import time
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import DriverAPIKey, _hash_token
+from .writebehind import WriteBehindBuffer
+
+CACHE_TTL_S = int(getattr(settings, 'DRIVER_API_KEY_CACHE_TTL_S', 300))
+NEGATIVE_TTL_S = int(getattr(settings, 'DRIVER_API_KEY_NEGATIVE_TTL_S', 30))
+LAST_USED_S = float(getattr(settings, 'DRIVER_API_KEY_LAST_USED_S', 60))
+
+# what a verified token resolves to
+KeyPrincipal = namedtuple('KeyPrincipal', 'key_id driver_id user_id')
+
+_INVALID = 0  # cached marker for tokens that did not verify
+
+
+def _key(key_hash):
+    return f'driver_api_key:{key_hash}'
+
+
+def forget(key_hash):
+    if key_hash:
+        try:
+            cache.delete(_key(key_hash))
+        except Exception:
+            pass
+
+
+# --- header parsing ---
+
+def token_from_header(authorization=None, driver_token=None):
+    """Raw token from an Authorization: Token <raw> header or X-Driver-Token, else None."""
+    if driver_token:
+        return driver_token.strip() or None
+    if authorization:
+        scheme, _, raw = authorization.strip().partition(' ')
+        if scheme.lower() in ('token', 'bearer') and raw.strip():
+            return raw.strip()
+    return None
+
+
+def request_token(request):
+    return token_from_header(request.headers.get('Authorization'), request.headers.get('X-Driver-Token'))
+
+
+def scope_token(scope):
+    headers = {k.lower(): v for k, v in scope.get('headers') or []}
+    decode = lambda v: v.decode('latin1') if v else None
+    return token_from_header(decode(headers.get(b'authorization')), decode(headers.get(b'x-driver-token')))
+
+
+# --- verification ---
+
+def _load(key_hash):
+    row = (DriverAPIKey.objects.filter(key_hash=key_hash, revoked=False)
+           .values_list('id', 'driver_id', 'driver__user_id', 'expires_at').first())
+    if row is None:
+        return _INVALID, NEGATIVE_TTL_S
+    key_id, driver_id, user_id, expires_at = row
+    ttl = CACHE_TTL_S
+    if expires_at is not None:
+        ttl = int(min(ttl, max(1, (expires_at - timezone.now()).total_seconds())))
+    return (key_id, driver_id, user_id, expires_at.timestamp() if expires_at else None), ttl
+
+
+def _principal(entry):
+    if not entry:
+        return None
+    key_id, driver_id, user_id, expires_ts = entry
+    if expires_ts is not None and expires_ts < time.time():
+        return None
+    touch(key_id)
+    return KeyPrincipal(key_id, driver_id, user_id)
+
+
+def verify(raw_token):
+    """Return a KeyPrincipal for a valid, unrevoked, unexpired token, else None."""
+    if not raw_token:
+        return None
+    key_hash = _hash_token(raw_token)
+    try:
+        entry = cache.get(_key(key_hash))
+    except Exception:
+        entry = None
+    if entry is None:
+        entry, ttl = _load(key_hash)
+        try:
+            cache.set(_key(key_hash), entry, ttl)
+        except Exception:
+            pass
+    return _principal(entry)
+
+
+async def averify(raw_token):
+    """verify() for async views and consumers."""
+    if not raw_token:
+        return None
+    key_hash = _hash_token(raw_token)
+    try:
+        entry = await cache.aget(_key(key_hash))
+    except Exception:
+        entry = None
+    if entry is None:
+        entry, ttl = await sync_to_async(_load)(key_hash)
+        try:
+            await cache.aset(_key(key_hash), entry, ttl)
+        except Exception:
+            pass
+    return _principal(entry)
+
+
+# --- deferred last_used ---
+
+# key_id -> monotonic time of the last touch queued by this process
+_touched = {}
+
+
+def write_last_used(rows):
+    """Flush (key_id, used_at) rows; the latest use of each key wins."""
+    latest = {}
+    for key_id, used_at in rows:
+        if key_id not in latest or used_at > latest[key_id]:
+            latest[key_id] = used_at
+    DriverAPIKey.objects.bulk_update(
+        [DriverAPIKey(id=key_id, last_used=used_at) for key_id, used_at in latest.items()],
+        ['last_used'],
+    )
+
+
+last_used_writer = WriteBehindBuffer(
+    'driver_api_key_last_used',
+    write_last_used,
+    max_rows=500,
+    max_delay_ms=int(getattr(settings, 'DRIVER_API_KEY_FLUSH_MS', 5000)),
+    max_buffer=10000,
+)
+
+
+def touch(key_id):
+    """Record a use of the key; written at most once per DRIVER_API_KEY_LAST_USED_S per process."""
+    now = time.monotonic()
+    prev = _touched.get(key_id)
+    if prev is not None and now - prev < LAST_USED_S:
+        return
+    _touched[key_id] = now
+    last_used_writer.add((key_id, timezone.now()))
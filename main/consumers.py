@@ -1,16 +1,36 @@
+import asyncio
 import json
 import logging
+import time
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
+from main.live import parse_fix, save_fix, fix_messages, publish
 from main.models import Ride
-from verify.models import Drivers
+from main.spatial import bbox_around, cell_count_in_bbox, cell_groups_in_bbox, driver_index, haversine_m
+from verify.models import Drivers, Users
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
+# NearbyConsumer tuning
+NEARBY_PUSH_MS = int(getattr(settings, 'NEARBY_WS_PUSH_MS', 1000))          # max one delta frame per socket per this
+NEARBY_RESYNC_S = float(getattr(settings, 'NEARBY_WS_RESYNC_S', 30.0))      # full re-diff against the grid index
+NEARBY_MAX_CELLS = int(getattr(settings, 'NEARBY_WS_MAX_CELLS', 64))        # largest viewport (in cell groups)
+NEARBY_MAX_RADIUS_M = float(getattr(settings, 'NEARBY_WS_MAX_RADIUS_M', 50000))
+
+
+def _owns_driver(user, driver):
+    """True if the socket's user (custom Users or Django auth user) is this driver's account."""
+    if isinstance(user, Users):
+        return driver.user_id == user.id
+    email = (getattr(user, 'email', '') or '').strip()
+    return bool(email) and Users.objects.filter(pk=driver.user_id, email__iexact=email).exists()
+
 
 class DriverLiveConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -29,7 +49,13 @@ class DriverLiveConsumer(AsyncWebsocketConsumer):
         logger.info("DriverLiveConsumer.connect attempt driver_id=%s user_id=%s client=%s",
                     self.driver_id, getattr(user, 'id', None), self.scope.get('client'))
 
-        if not user or not user.is_authenticated:
+        if 'api_driver_id' in self.scope:
+            # native app token (medwheels.asgi / main.api_keys): only its own driver's socket
+            if self.scope['api_driver_id'] != self.driver_id:
+                logger.info("DriverLiveConsumer.connect: token not valid for driver_id=%s -> close(4001)", self.driver_id)
+                await self.close(code=4001)
+                return
+        elif not user or not user.is_authenticated:
             logger.info("DriverLiveConsumer.connect: unauthenticated -> close(4001)")
             await self.close(code=4001)
             return
@@ -54,7 +80,9 @@ class DriverLiveConsumer(AsyncWebsocketConsumer):
             await self.close(code=4500)
             return
 
-        logger.info("DriverLiveConsumer.connect: accepted driver_id=%s user_id=%s", self.driver_id, user.id)
+        # token sockets carry AnonymousUser (no id): log the driver the token resolved to as well
+        logger.info("DriverLiveConsumer.connect: accepted driver_id=%s user_id=%s api_driver_id=%s", self.driver_id,
+                    getattr(user, 'id', None), self.scope.get('api_driver_id'))
         await self.accept()
 
     async def disconnect(self, close_code):
@@ -111,7 +139,13 @@ class DriverConsumer(AsyncWebsocketConsumer):
         logger.info("DriverConsumer.connect attempt driver_id=%s user_id=%s client=%s",
                     self.driver_id, getattr(user, 'id', None), self.scope.get('client'))
 
-        if not user or not user.is_authenticated:
+        if 'api_driver_id' in self.scope:
+            # native app token (medwheels.asgi / main.api_keys): only its own driver's socket
+            if self.scope['api_driver_id'] != self.driver_id:
+                logger.info("DriverConsumer.connect: token not valid for driver_id=%s -> close(4001)", self.driver_id)
+                await self.close(code=4001)
+                return
+        elif not user or not user.is_authenticated:
             logger.info("DriverConsumer.connect: unauthenticated -> close(4001)")
             await self.close(code=4001)
             return
@@ -135,7 +169,13 @@ class DriverConsumer(AsyncWebsocketConsumer):
             await self.close(code=4500)
             return
 
-        logger.info("DriverConsumer.connect: accepted driver_id=%s user_id=%s", self.driver_id, user.id)
+        # validated once per connection: only the driver's own account may publish fixes
+        self.can_publish = ('api_driver_id' in self.scope
+                            or await database_sync_to_async(_owns_driver)(user, driver))
+
+        # token sockets carry AnonymousUser (no id): log the driver the token resolved to as well
+        logger.info("DriverConsumer.connect: accepted driver_id=%s user_id=%s api_driver_id=%s", self.driver_id,
+                    getattr(user, 'id', None), self.scope.get('api_driver_id'))
         await self.accept()
 
     async def disconnect(self, close_code):
@@ -157,7 +197,43 @@ class DriverConsumer(AsyncWebsocketConsumer):
         await self.send_json({'type': 'driver.assignment_confirmed', 'ride_id': event.get('ride_id')})
 
     async def receive(self, text_data=None, bytes_data=None):
-        return
+        """
+        Accept location frames { type: 'location', lat, lng, is_online } from the driver.
+        Same rules as api_driver_live_update (main.live), without a Django request per fix.
+        """
+        if not text_data:
+            return
+        try:
+            payload = json.loads(text_data)
+        except Exception:
+            await self.send_json({'type': 'location.error', 'error': 'invalid json'})
+            return
+        if not isinstance(payload, dict) or payload.get('type') != 'location':
+            return
+        if not getattr(self, 'can_publish', False):
+            await self.send_json({'type': 'location.error', 'error': 'not allowed to publish for this driver'})
+            return
+
+        try:
+            lat_dec, lng_dec, is_online = parse_fix(payload)
+        except ValueError as e:
+            await self.send_json({'type': 'location.error', 'error': str(e)})
+            return
+
+        now = timezone.now()
+        try:
+            ride_ids = await save_fix(self.driver_id, lat_dec, lng_dec, is_online, now)
+        except Exception as e:
+            logger.exception("DriverConsumer.receive: failed to update live for driver %s: %s", self.driver_id, e)
+            await self.send_json({'type': 'location.error', 'error': 'failed to update live'})
+            return
+
+        # ride_ids is None when the fix was dead-banded (only last_seen refreshed)
+        messages = [] if ride_ids is None else fix_messages(self.driver_id, lat_dec, lng_dec, is_online, now, ride_ids)
+        for group, e in await publish(self.channel_layer, messages):
+            logger.warning("DriverConsumer.receive: group_send to %s failed: %s", group, e)
+
+        await self.send_json({'type': 'location.ack', 'last_seen': now.isoformat(), 'is_online': is_online})
 
     async def send_json(self, payload):
         await self.send(text_data=json.dumps(payload))
@@ -257,3 +333,172 @@ class RideConsumer(AsyncWebsocketConsumer):
             "type": "ride.assigned",
             "driver": event["driver"]
         }))
+
+
+class NearbyConsumer(AsyncWebsocketConsumer):
+    """
+    Rider map socket: replaces polling api/nearby/.
+
+    The client subscribes to a viewport, either a bbox or a circle:
+      { type: 'subscribe', south, west, north, east }
+      { type: 'subscribe', lat, lng, radius_m }
+    and receives { type: 'nearby.delta', add: [...], move: [...], remove: [driver_id, ...] }
+    where add/move items are { driver_id, lat, lng, distance_m } (distance from the
+    viewport centre). The first delta after a subscribe is the full snapshot.
+
+    Driver fixes arrive on per-cell groups (main.live.fix_messages) and are conflated
+    per socket: at most one frame every NEARBY_WS_PUSH_MS, carrying only the latest
+    position of each driver that changed.
+    """
+
+    async def connect(self):
+        self.groups_joined = set()
+        self.bbox = None
+        self.center = None
+        self.known = {}        # driver_id -> (lat, lng) as last sent to the client
+        self.pending = {}      # driver_id -> (lat, lng) or None (gone), not sent yet
+        self.last_push = 0.0
+        self.flush_task = None
+        self.resync_task = None
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        for task in (self.flush_task, self.resync_task):
+            if task is not None:
+                task.cancel()
+        for group in self.groups_joined:
+            try:
+                await self.channel_layer.group_discard(group, self.channel_name)
+            except Exception as e:
+                logger.exception("NearbyConsumer.disconnect: error discarding group %s: %s", group, e)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not text_data:
+            return
+        try:
+            payload = json.loads(text_data)
+        except Exception:
+            await self.send_json({'type': 'nearby.error', 'error': 'invalid json'})
+            return
+        if not isinstance(payload, dict):
+            return
+        if payload.get('type') == 'unsubscribe':
+            await self._set_groups(set())
+            self.bbox = self.center = None
+            self.pending = {driver_id: None for driver_id in self.known}
+            await self._flush()
+            return
+        if payload.get('type') != 'subscribe':
+            return
+
+        try:
+            if payload.get('radius_m') is not None:
+                lat, lng = float(payload['lat']), float(payload['lng'])
+                radius_m = min(float(payload['radius_m']), NEARBY_MAX_RADIUS_M)
+                bbox = bbox_around(lat, lng, radius_m)
+            else:
+                bbox = tuple(float(payload[k]) for k in ('south', 'west', 'north', 'east'))
+                lat, lng = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+            if not (-90 <= bbox[0] <= bbox[2] <= 90 and -180 <= bbox[1] <= bbox[3] <= 180):
+                raise ValueError
+        except Exception:
+            await self.send_json({'type': 'nearby.error', 'error': 'subscribe needs south/west/north/east or lat/lng/radius_m'})
+            return
+
+        # refuse before building the group names: a whole-world bbox is millions of cells
+        if cell_count_in_bbox(*bbox) > NEARBY_MAX_CELLS:
+            await self.send_json({'type': 'nearby.error', 'error': 'viewport too large, zoom in'})
+            return
+        groups = cell_groups_in_bbox(*bbox)
+
+        self.bbox, self.center = bbox, (lat, lng)
+        await self._set_groups(set(groups))
+        await self._resync(always_send=True)
+        if self.resync_task is None:
+            self.resync_task = asyncio.ensure_future(self._resync_loop())
+
+    # group_send(type='nearby.driver') from main.live.fix_messages
+    async def nearby_driver(self, event):
+        driver_id = event.get('driver_id')
+        lat, lng = event.get('lat'), event.get('lng')
+        if self.bbox and event.get('is_online', True) and self._inside(lat, lng):
+            self.pending[driver_id] = (lat, lng)
+        elif driver_id in self.known or driver_id in self.pending:
+            self.pending[driver_id] = None
+        else:
+            return
+        self._schedule_flush()
+
+    # --- internals ---
+    def _inside(self, lat, lng):
+        if lat is None or lng is None:
+            return False
+        south, west, north, east = self.bbox
+        return south <= lat <= north and west <= lng <= east
+
+    async def _set_groups(self, groups):
+        for group in self.groups_joined - groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for group in groups - self.groups_joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.groups_joined = groups
+
+    async def _resync(self, always_send=False):
+        """Diff the grid index for the whole viewport against what the client has."""
+        if not self.bbox:
+            return
+        south, west, north, east = self.bbox
+        lat, lng = self.center
+        radius_m = max(haversine_m(lat, lng, south, west), haversine_m(lat, lng, north, east))
+        hits = await driver_index.awithin(lat, lng, radius_m)
+        current = {driver_id: (d_lat, d_lng) for _d, driver_id, d_lat, d_lng in hits if self._inside(d_lat, d_lng)}
+        for driver_id in self.known:
+            if driver_id not in current:
+                self.pending[driver_id] = None
+        for driver_id, pos in current.items():
+            if self.known.get(driver_id) != pos:
+                self.pending[driver_id] = pos
+        await self._flush(always_send)
+
+    async def _resync_loop(self):
+        # picks up drivers dropped by other workers (logout, missed cell moves)
+        while True:
+            await asyncio.sleep(NEARBY_RESYNC_S)
+            try:
+                await self._resync()
+            except Exception as e:
+                logger.warning("NearbyConsumer: resync failed: %s", e)
+
+    def _schedule_flush(self):
+        if self.flush_task is not None and not self.flush_task.done():
+            return
+        delay = max(0.0, self.last_push + NEARBY_PUSH_MS / 1000.0 - time.monotonic())
+        self.flush_task = asyncio.ensure_future(self._flush_later(delay))
+
+    async def _flush_later(self, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        await self._flush()
+
+    async def _flush(self, always_send=False):
+        pending, self.pending = self.pending, {}
+        add, move, remove = [], [], []
+        for driver_id, pos in pending.items():
+            if pos is None:
+                if self.known.pop(driver_id, None) is not None:
+                    remove.append(driver_id)
+                continue
+            item = {
+                'driver_id': driver_id,
+                'lat': pos[0],
+                'lng': pos[1],
+                'distance_m': int(haversine_m(self.center[0], self.center[1], pos[0], pos[1])),
+            }
+            (move if driver_id in self.known else add).append(item)
+            self.known[driver_id] = pos
+        self.last_push = time.monotonic()
+        if add or move or remove or always_send:
+            await self.send_json({'type': 'nearby.delta', 'add': add, 'move': move, 'remove': remove})
+
+    async def send_json(self, payload):
+        await self.send(text_data=json.dumps(payload))
@@ -0,0 +1,259 @@
+"""
+Dispatch waves for rides requested by ambulance type (status 'matching').
+
+api_request_ambulance_type sends wave 0 with the ride INSERT and hands the
+ride to the dispatcher on commit. Each later wave fires when the previous
+offer window (DISPATCH_OFFER_TIMEOUT_S) runs out with nobody accepted. It
+searches a wider radius for more drivers and offers the ride to drivers not
+yet offered; drivers who rejected were offered already, so they never get it
+again. When every wave has had its window the ride goes through the 'fail'
+transition (main.rides) and the rider's group gets ride.matching_failed.
+
+The dispatcher is one asyncio loop on a daemon thread per worker process.
+A waiting ride is a timer handle and a couple of small sets, so thousands of
+concurrently matching rides cost next to nothing. Wave work (the grid lookup,
+one status check and the outbox insert) runs on a small thread pool, never on
+a request thread. Once a wave finds the ride assigned or cancelled, the ride
+is dropped. When every driver offered so far has rejected (rejects this worker
+saw), the next wave goes out without waiting for the timer.
+
+Each wave claims the ride in the database: its check that the ride is still
+open is an UPDATE that bumps updated_at. So a ride some worker is still
+matching has updated_at within the last offer window. Rides orphaned by a
+restart go quiet and are failed by a periodic sweep: 'matching' rides not
+updated for two windows. The sweep's 'fail' is a compare-and-set on that
+same updated_at, so it never fails a ride that a live worker claimed in
+between, and several workers sweeping at once is harmless.
+
+Settings:
+  DISPATCH_WAVES             [(radius_m, drivers), ...], widening (default 5km/8, 10km/16, 20km/32)
+  DISPATCH_OFFER_TIMEOUT_S   how long each wave waits for an accept (default 25)
+  DISPATCH_WORKERS           thread pool size for wave work (default 4)
+  DISPATCH_SWEEP_S           interval of the orphaned-ride sweep (default 60)
+"""
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import outbox, ride_events, rides
+from .models import Ride
+from .pricing import rupees
+from .spatial import driver_index
+
+logger = logging.getLogger(__name__)
+
+WAVES = [(float(r), int(n)) for r, n in getattr(
+    settings, 'DISPATCH_WAVES', [(5000, 8), (10000, 16), (20000, 32)])]
+OFFER_TIMEOUT_S = float(getattr(settings, 'DISPATCH_OFFER_TIMEOUT_S', 25))
+WORKERS = int(getattr(settings, 'DISPATCH_WORKERS', 4))
+SWEEP_S = float(getattr(settings, 'DISPATCH_SWEEP_S', 60))
+
+
+def offer_messages(ride, hits, ambulance_type, fare_paise, wave=0):
+    """ride.request events for [(distance_m, driver_id, lat, lng), ...]."""
+    requested_at = ride.requested_at.isoformat() if getattr(ride, 'requested_at', None) else timezone.now().isoformat()
+    return [
+        (f"driver_{driver_id}", {
+            'type': 'ride.request',     # your driver consumer must handle this
+            'ride_id': ride.id,
+            'pickup': ride.pickup_address,
+            'pickup_lat': float(ride.pickup_lat),
+            'pickup_lng': float(ride.pickup_lng),
+            'dropoff': ride.dropoff_address,
+            'ambulance_type': ambulance_type,
+            'fare': rupees(fare_paise),
+            'distance_m': float(d_m),
+            'requested_at': requested_at,
+            'wave': wave,
+        })
+        for d_m, driver_id, _lat, _lng in hits
+    ]
+
+
+def offer_events(hits, wave=0):
+    return [('ride.offered', {'driver_id': driver_id, 'distance_m': int(d_m), 'wave': wave})
+            for d_m, driver_id, _lat, _lng in hits]
+
+
+def failed_messages(ride):
+    return [(f"ride_{ride.id}", {'type': 'ride.matching_failed', 'ride_id': ride.id})]
+
+
+def fail(ride_id, reason='no driver accepted', updated_before=None):
+    """'fail' transition + ride.matching_failed (outbox). False if the ride was no longer open
+    (or, with updated_before, was touched since)."""
+    return rides.transition(ride_id, 'fail', cancellation_reason=reason, notify=failed_messages,
+                            updated_before=updated_before).won
+
+
+class _Matching:
+    __slots__ = ('ride_id', 'lat', 'lng', 'ambulance_type', 'fare_paise', 'wave', 'offered', 'rejected', 'timer')
+
+    def __init__(self, ride_id, lat, lng, ambulance_type, fare_paise, offered):
+        self.ride_id = ride_id
+        self.lat = lat
+        self.lng = lng
+        self.ambulance_type = ambulance_type
+        self.fare_paise = fare_paise
+        self.wave = 0
+        self.offered = set(offered)
+        self.rejected = set()
+        self.timer = None
+
+
+class Dispatcher:
+    def __init__(self, waves=WAVES, offer_timeout_s=OFFER_TIMEOUT_S, workers=WORKERS, sweep_s=SWEEP_S):
+        self.waves = waves
+        self.offer_timeout_s = offer_timeout_s
+        self.workers = workers
+        self.sweep_s = sweep_s
+        self._rides = {}  # ride id -> _Matching; only touched on the loop thread
+        self._loop = None
+        self._thread = None
+        self._executor = None
+        self._pid = None
+        self._tasks = set()  # strong refs: the loop only keeps weak ones
+        self._lock = threading.Lock()
+
+    # --- called from any thread ---
+    def track(self, ride_id, lat, lng, ambulance_type, fare_paise, offered):
+        """Start the wave timers for a ride whose wave 0 went out with offers to `offered`."""
+        self._call(self._track, ride_id, lat, lng, ambulance_type, fare_paise, list(offered))
+
+    def rejected(self, ride_id, driver_id):
+        """A driver turned the offer down; no-op for rides this worker does not match."""
+        if self._loop is not None and self._pid == os.getpid():
+            self._loop.call_soon_threadsafe(self._rejected, ride_id, driver_id)
+
+    def stats(self):
+        return {'matching': len(self._rides), 'waves': len(self.waves), 'budget_s': self.offer_timeout_s * len(self.waves)}
+
+    def _call(self, fn, *args):
+        self._ensure_thread()
+        self._loop.call_soon_threadsafe(fn, *args)
+
+    def _ensure_thread(self):
+        # (re)start lazily, and again after a fork (e.g. gunicorn --preload workers)
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            self._pid = pid
+            self._rides = {}
+            self._loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='dispatch')
+            self._thread = threading.Thread(target=self._run, name='dispatch-waves', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(self._schedule_sweep, 0)
+        self._loop.run_forever()
+
+    # --- loop thread ---
+    def _track(self, ride_id, lat, lng, ambulance_type, fare_paise, offered):
+        if ride_id in self._rides:
+            return
+        m = self._rides[ride_id] = _Matching(ride_id, lat, lng, ambulance_type, fare_paise, offered)
+        self._arm(m)
+
+    def _arm(self, m):
+        m.timer = self._loop.call_later(self.offer_timeout_s, self._expired, m.ride_id)
+
+    def _expired(self, ride_id):
+        m = self._rides.get(ride_id)
+        if m is not None:
+            self._spawn(self._next_wave(m))
+
+    def _spawn(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _rejected(self, ride_id, driver_id):
+        m = self._rides.get(ride_id)
+        if m is None or driver_id not in m.offered:
+            return
+        m.rejected.add(driver_id)
+        if m.timer is not None and m.rejected >= m.offered:
+            # everybody asked so far said no: don't sit out the rest of the window
+            m.timer.cancel()
+            m.timer = None
+            self._spawn(self._next_wave(m))
+
+    async def _next_wave(self, m):
+        m.timer = None
+        wave = m.wave + 1
+        try:
+            if wave >= len(self.waves):
+                await self._in_pool(fail, m.ride_id)
+                self._rides.pop(m.ride_id, None)
+                return
+            sent = await self._in_pool(self._send_wave, m, wave)
+        except Exception:
+            logger.exception("dispatch wave %s for ride %s failed", wave, m.ride_id)
+            sent = []  # try again with the next wave after the usual window
+        if sent is None:
+            # assigned or cancelled meanwhile
+            self._rides.pop(m.ride_id, None)
+            return
+        m.wave = wave
+        m.offered.update(sent)
+        self._arm(m)
+
+    async def _in_pool(self, fn, *args):
+        return await self._loop.run_in_executor(self._executor, _with_connections, fn, *args)
+
+    def _send_wave(self, m, wave):
+        """Offer the ride to new drivers within this wave's radius. None if it is no longer open."""
+        radius_m, count = self.waves[wave]
+        hits = driver_index.within(m.lat, m.lng, radius_m, limit=count + len(m.offered))
+        hits = [h for h in hits if h[1] not in m.offered][:count]
+        with transaction.atomic():
+            # claim: still open, and updated_at tells the orphan sweep a worker is on it
+            if not Ride.objects.filter(pk=m.ride_id, status='matching', driver__isnull=True).update(
+                    updated_at=timezone.now()):
+                return None
+            ride = Ride.objects.get(pk=m.ride_id)
+            outbox.enqueue(offer_messages(ride, hits, m.ambulance_type, m.fare_paise, wave))
+            ride_events.record_many(ride.id, offer_events(hits, wave))
+        return [h[1] for h in hits]
+
+    # --- orphan sweep ---
+    def _schedule_sweep(self, delay):
+        self._loop.call_later(delay, lambda: self._spawn(self._sweep()))
+
+    async def _sweep(self):
+        try:
+            await self._in_pool(self.fail_orphans)
+        except Exception:
+            logger.exception("dispatch sweep failed")
+        self._schedule_sweep(self.sweep_s)
+
+    def fail_orphans(self):
+        """Fail 'matching' rides no worker has claimed for two offer windows; returns how many."""
+        # a tracked ride is claimed every window, and failed one window after its last wave
+        cutoff = timezone.now() - timedelta(seconds=self.offer_timeout_s * 2)
+        stale = Ride.objects.filter(status='matching', updated_at__lt=cutoff).values_list('id', flat=True)
+        return sum(fail(ride_id, reason='matching timed out', updated_before=cutoff)
+                   for ride_id in list(stale[:500]))
+
+
+def _with_connections(fn, *args):
+    close_old_connections()
+    try:
+        return fn(*args)
+    finally:
+        close_old_connections()
+
+
+dispatcher = Dispatcher()
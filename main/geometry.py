@@ -0,0 +1,36 @@
+"""
+Batched (NumPy) geometry for candidate scoring.
+
+Everything here takes arrays of candidate coordinates and does one vectorized
+pass instead of calling haversine_m once per driver. Fares are main.pricing's
+job (integer paise). `python manage.py bench_geometry` compares the
+api_estimate path against the per-row loop.
+"""
+import numpy as np
+
+EARTH_RADIUS_M = 6371000
+AVG_SPEED_KMPH = 25.0  # conservative city speed for ETA estimate
+
+
+def haversine_m_batch(lat, lng, lats, lngs):
+    """Return an array of distances (meters) from (lat, lng) to each (lats[i], lngs[i])."""
+    lat1 = np.radians(lat)
+    lng1 = np.radians(lng)
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    lng2 = np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def eta_s_batch(distance_m, avg_speed_kmph=AVG_SPEED_KMPH):
+    """Return ETA in whole seconds for each distance at a constant average speed."""
+    return np.rint(np.asarray(distance_m) / (avg_speed_kmph / 3.6)).astype(np.int64)
+
+
+def top_n(values, n=None):
+    """Return indices of the n smallest values, smallest first (all indices if n is None)."""
+    values = np.asarray(values)
+    if n is None or n >= values.size:
+        return np.argsort(values, kind='stable')
+    part = np.argpartition(values, n)[:n]
+    return part[np.argsort(values[part], kind='stable')]
@@ -0,0 +1,190 @@
+"""
+Idempotency-Key support for the ride booking endpoints.
+
+A client retrying a POST sends the same Idempotency-Key header. The first
+request claims the key by inserting an IdempotencyKey row; the unique index
+makes that claim atomic across workers. When it finishes, its response
+(status + JSON body) is stored on the row and in the cache. A retry gets that
+response back (header Idempotent-Replayed: true) without running the view:
+no second Ride and no second round of driver notifications. Lookups are
+cache first, then one indexed row read.
+
+Keys are scoped per endpoint and per session user. Outcomes:
+- same key while the first request is still running      -> 409
+- same key with a different request body                 -> 422
+- first request ended in a 5xx or raised                 -> key released, a retry runs again
+Requests without the header behave as before.
+
+Settings:
+  IDEMPOTENCY_KEY_TTL_S     how long a key and its response are kept (default 86400)
+  IDEMPOTENCY_CACHE_TTL_S   cache lifetime of a stored response (default 600)
+  IDEMPOTENCY_LOCK_S        a key still running after this long is taken over (default 120)
+"""
+import asyncio
+import hashlib
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+KEY_TTL_S = int(getattr(settings, 'IDEMPOTENCY_KEY_TTL_S', 24 * 3600))
+CACHE_TTL_S = int(getattr(settings, 'IDEMPOTENCY_CACHE_TTL_S', 600))
+LOCK_S = int(getattr(settings, 'IDEMPOTENCY_LOCK_S', 120))
+MAX_KEY_LEN = 255
+
+
+def _sha(text):
+    return hashlib.sha256(text.encode('utf-8') if isinstance(text, str) else text).hexdigest()
+
+
+def _cache_key(key):
+    return f'idem:{key}'  # -> (request_hash, status, body)
+
+
+def _replay(status, body):
+    response = HttpResponse(body, status=status, content_type='application/json')
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _conflict(status, error):
+    return JsonResponse({'ok': False, 'error': error}, status=status)
+
+
+def _begin(key, request_hash):
+    """
+    Claim `key` or find its stored response.
+    Returns ('run', row_id) | ('replay', (status, body)) | ('conflict', response).
+    """
+    for _attempt in range(2):
+        row = IdempotencyKey.objects.filter(key=key).first()
+        if row is not None:
+            age_s = (timezone.now() - row.created_at).total_seconds()
+            expired = age_s > KEY_TTL_S or (row.status_code is None and age_s > LOCK_S)
+            if not expired:
+                if row.request_hash != request_hash:
+                    return 'conflict', _conflict(422, f'{HEADER} was used for a different request')
+                if row.status_code is None:
+                    return 'conflict', _conflict(409, 'a request with this key is still in progress')
+                _remember(key, request_hash, row.status_code, row.response_body)
+                return 'replay', (row.status_code, row.response_body)
+            # stale: take it over (only if nobody else did first)
+            IdempotencyKey.objects.filter(pk=row.pk, created_at=row.created_at).delete()
+        try:
+            row = IdempotencyKey.objects.create(key=key, request_hash=request_hash)
+            return 'run', row.pk
+        except IntegrityError:
+            continue  # lost the claim to a concurrent request: look at theirs
+    return 'conflict', _conflict(409, 'a request with this key is still in progress')
+
+
+def _finish(key, request_hash, row_id, response):
+    """Store a final response, or release the key after a server error."""
+    if response is None or response.status_code >= 500 or getattr(response, 'streaming', False):
+        IdempotencyKey.objects.filter(pk=row_id).delete()
+        return
+    body = response.content.decode('utf-8')
+    IdempotencyKey.objects.filter(pk=row_id).update(status_code=response.status_code, response_body=body)
+    _remember(key, request_hash, response.status_code, body)
+
+
+def _remember(key, request_hash, status, body):
+    try:
+        cache.set(_cache_key(key), (request_hash, status, body), CACHE_TTL_S)
+    except Exception:
+        pass
+
+
+def _scope(name, request, user_id):
+    raw = request.headers.get(HEADER)
+    if not raw or not user_id:
+        return None, None
+    raw = raw.strip()[:MAX_KEY_LEN]
+    return _sha(f'{name}:{user_id}:{raw}'), _sha(request.body)
+
+
+def _cached(key):
+    try:
+        return cache.get(_cache_key(key))
+    except Exception:
+        return None
+
+
+def _from_cache(hit, request_hash):
+    stored_hash, status, body = hit
+    if stored_hash != request_hash:
+        return _conflict(422, f'{HEADER} was used for a different request')
+    return _replay(status, body)
+
+
+def idempotent(name):
+    """
+    View decorator: honour Idempotency-Key for the session user (request.session['user_id']).
+    `name` scopes keys to one endpoint. Works on sync and async views.
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def _async_wrapped(request, *args, **kwargs):
+                key, request_hash = _scope(name, request, await request.session.aget('user_id'))
+                if key is None:
+                    return await view(request, *args, **kwargs)
+                try:
+                    hit = await cache.aget(_cache_key(key))
+                except Exception:
+                    hit = None
+                if hit is not None:
+                    return _from_cache(hit, request_hash)
+                action, value = await sync_to_async(_begin)(key, request_hash)
+                if action == 'replay':
+                    return _replay(*value)
+                if action == 'conflict':
+                    return value
+                response = None
+                try:
+                    response = await view(request, *args, **kwargs)
+                    return response
+                finally:
+                    await sync_to_async(_finish)(key, request_hash, value, response)
+            return _async_wrapped
+
+        @wraps(view)
+        def _wrapped(request, *args, **kwargs):
+            key, request_hash = _scope(name, request, request.session.get('user_id'))
+            if key is None:
+                return view(request, *args, **kwargs)
+            hit = _cached(key)
+            if hit is not None:
+                return _from_cache(hit, request_hash)
+            action, value = _begin(key, request_hash)
+            if action == 'replay':
+                return _replay(*value)
+            if action == 'conflict':
+                return value
+            response = None
+            try:
+                response = view(request, *args, **kwargs)
+                return response
+            finally:
+                _finish(key, request_hash, value, response)
+        return _wrapped
+    return decorator
+
+
+def prune(older_than_s=KEY_TTL_S, batch_size=5000):
+    """Delete expired keys in batches (created_at index). Returns the number removed."""
+    cutoff = timezone.now() - timedelta(seconds=older_than_s)
+    removed = 0
+    while True:
+        ids = list(IdempotencyKey.objects.filter(created_at__lt=cutoff).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return removed
+        removed += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
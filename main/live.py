@@ -0,0 +1,174 @@
+"""
+Driver live-location pipeline shared by the HTTP endpoint (api_driver_live_update)
+and the driver websocket (DriverConsumer.receive).
+
+parse_fix() validates a payload, save_fix() does the DB work (async ORM),
+fix_messages() builds the channel-layer fan-out and publish() sends it
+concurrently, so both transports apply exactly the same rules.
+
+Dead-banding: a fix that moved less than LIVE_DEADBAND_M meters from the last
+fully written one, with the same is_online, inside LIVE_KEEPALIVE_S seconds,
+only refreshes DriverLive.last_seen (no telemetry row, no broadcast).
+
+Full writes also feed ride milestones (driver.near_pickup) to main.ride_events.
+
+Every broadcast fix also goes to the viewport cell group(s) of the driver
+(spatial.cell_group): the new cell, plus the previous one when the driver
+crossed a cell border or went offline, so NearbyConsumer can emit removals.
+"""
+import asyncio
+import time
+from decimal import Decimal
+
+from django.conf import settings
+
+from .models import DriverLive
+from .ride_events import anote_fix
+from .ride_cache import aactive_ride_ids
+from .spatial import cell_group, driver_index, haversine_m
+from .telemetry import record_fix
+
+DEADBAND_M = float(getattr(settings, 'LIVE_DEADBAND_M', 15.0))
+KEEPALIVE_S = float(getattr(settings, 'LIVE_KEEPALIVE_S', 60.0))
+
+# driver_id -> (lat, lng, is_online, monotonic time) of the last full write in this worker
+_last_written = {}
+# driver_id -> viewport cell group the driver was last published to by this worker
+_published_cell = {}
+
+
+def _within_deadband(driver_id, lat_dec, lng_dec, is_online):
+    prev = _last_written.get(driver_id)
+    if prev is None:
+        return False
+    p_lat, p_lng, p_online, p_at = prev
+    if p_online != is_online or time.monotonic() - p_at >= KEEPALIVE_S:
+        return False
+    if lat_dec is None or lng_dec is None:
+        return True
+    if p_lat is None or p_lng is None:
+        return False
+    return haversine_m(p_lat, p_lng, float(lat_dec), float(lng_dec)) < DEADBAND_M
+
+
+def parse_fix(payload):
+    """
+    Validate { lat: <float>|null, lng: <float>|null, is_online: true/false }.
+    Returns (lat_dec, lng_dec, is_online); raises ValueError with a client-facing message.
+    """
+    lat = payload.get('lat')
+    lng = payload.get('lng')
+    is_online = payload.get('is_online', True)
+
+    # If driver intends to mark offline, allow missing coords (browser may not provide them on unload)
+    if is_online is True:
+        if lat is None or lng is None:
+            raise ValueError('lat and lng required when is_online is true')
+
+    # coercion and validation (only if lat/lng present)
+    lat_dec = None
+    lng_dec = None
+    if lat is not None and lng is not None:
+        try:
+            lat_dec = Decimal(str(lat))
+            lng_dec = Decimal(str(lng))
+        except Exception:
+            raise ValueError('invalid lat/lng')
+    return lat_dec, lng_dec, bool(is_online)
+
+
+async def save_fix(driver_id, lat_dec, lng_dec, is_online, now):
+    """
+    Update/create the DriverLive row, queue DriverLocation telemetry (if coords
+    present) and feed the grid index. Returns ids of rides assigned to the driver,
+    or None when the fix was dead-banded (only last_seen refreshed, nothing to broadcast).
+    DriverLive failures propagate; telemetry is written behind (main.telemetry).
+    """
+    if _within_deadband(driver_id, lat_dec, lng_dec, is_online):
+        if await DriverLive.objects.filter(driver_id=driver_id).aupdate(last_seen=now):
+            return None
+        # row vanished behind our back: fall through to a full write
+
+    if lat_dec is not None and lng_dec is not None:
+        await DriverLive.objects.aupdate_or_create(
+            driver_id=driver_id,
+            defaults={'latitude': lat_dec, 'longitude': lng_dec, 'is_online': is_online, 'last_seen': now}
+        )
+    else:
+        # No coords provided (likely marking offline). Update only is_online/last_seen.
+        await DriverLive.objects.aupdate_or_create(
+            driver_id=driver_id,
+            defaults={'is_online': is_online, 'last_seen': now}
+        )
+
+    # keep this worker's grid index in step with the row we just wrote
+    driver_index.apply(driver_id, lat_dec, lng_dec, is_online)
+    _last_written[driver_id] = (
+        float(lat_dec) if lat_dec is not None else None,
+        float(lng_dec) if lng_dec is not None else None,
+        is_online,
+        time.monotonic(),
+    )
+
+    # append telemetry (DriverLocation) - only if we have coords; buffered, written in batches
+    if lat_dec is not None and lng_dec is not None:
+        record_fix(driver_id, lat_dec, lng_dec, now)
+
+    try:
+        # cached driver -> active rides mapping (main.ride_cache): no Ride query per fix
+        ride_ids = await aactive_ride_ids(driver_id)
+    except Exception:
+        # Non-fatal: the fix is stored, riders just miss this broadcast
+        return []
+    # audit milestones (main.ride_events); a pickup lookup only the first time a ride is seen
+    try:
+        await anote_fix(driver_id, lat_dec, lng_dec, ride_ids, now)
+    except Exception:
+        pass
+    return ride_ids
+
+
+def fix_messages(driver_id, lat_dec, lng_dec, is_online, now, ride_ids):
+    """Return [(group, event), ...] to broadcast for one fix."""
+    lat = float(lat_dec) if lat_dec is not None else None
+    lng = float(lng_dec) if lng_dec is not None else None
+    messages = [(f"driver_{driver_id}", {
+        'type': 'location.update',
+        'driver_id': driver_id,
+        'lat': lat,
+        'lng': lng,
+        'is_online': is_online,
+        'last_seen': now.isoformat()
+    })]
+    # Also notify any rider(s) with assigned rides to this driver
+    for ride_id in ride_ids:
+        messages.append((f"ride_{ride_id}", {
+            'type': 'location.update',
+            'driver_id': driver_id,
+            'lat': lat,
+            'lng': lng,
+            'last_seen': now.isoformat()
+        }))
+    # Viewport subscribers (NearbyConsumer): current cell, and the one the driver left
+    cell = cell_group(lat, lng) if is_online and lat is not None and lng is not None else None
+    prev = _published_cell.pop(driver_id, None)
+    if cell:
+        _published_cell[driver_id] = cell
+    for group in dict.fromkeys(g for g in (cell, prev) if g):
+        messages.append((group, {
+            'type': 'nearby.driver',
+            'driver_id': driver_id,
+            'lat': lat,
+            'lng': lng,
+            'is_online': is_online,
+        }))
+    return messages
+
+
+async def publish(channel_layer, messages):
+    """Send [(group, event), ...] concurrently. Returns [(group, exception), ...] for failed sends."""
+    results = await asyncio.gather(
+        *(channel_layer.group_send(group, event) for group, event in messages),
+        return_exceptions=True,
+    )
+    return [(group, r) for (group, _e), r in zip(messages, results) if isinstance(r, Exception)]
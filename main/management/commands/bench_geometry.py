@@ -0,0 +1,62 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from main import pricing
+from main.geometry import eta_s_batch, haversine_m_batch, top_n
+from main.spatial import haversine_m
+
+
+def _per_row(plat, plng, lats, lngs, n, avg_speed_kmph, base, per_km, per_min):
+    """The pre-geometry api_estimate loop: haversine_m + Decimal ETA/fare per driver."""
+    base, per_km, per_min = Decimal(base), Decimal(per_km), Decimal(per_min)
+    out = []
+    for lat, lng in zip(lats, lngs):
+        d_m = haversine_m(plat, plng, lat, lng)
+        d_km = Decimal(d_m) / Decimal(1000)
+        eta_min = (d_km / Decimal(avg_speed_kmph)) * Decimal(60)
+        fare = (base + (per_km * d_km) + (per_min * eta_min)).quantize(Decimal('0.01'))
+        out.append((int((eta_min * Decimal(60)).quantize(Decimal('1'))), int(d_m), fare))
+    out.sort(key=lambda x: (x[0], x[1]))
+    return out[:n]
+
+
+def _vectorized(plat, plng, lats, lngs, n, tariff):
+    """What api_estimate runs: distance / ETA in one pass, paise fares for the top n."""
+    distance_m = haversine_m_batch(plat, plng, lats, lngs)
+    eta_s = eta_s_batch(distance_m)
+    order = top_n(distance_m, n)
+    return order, pricing.quote_batch(distance_m[order], eta_s[order], tariff=tariff)
+
+
+class Command(BaseCommand):
+    help = ("Benchmark api_estimate's candidate scoring (main.geometry + main.pricing.quote_batch) "
+            "against the per-row loop.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drivers', type=int, nargs='+', default=[100, 1000, 5000, 20000])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--top', type=int, default=6)
+
+    def handle(self, *args, **opts):
+        plat, plng = 22.5726, 88.3639
+        args = dict(avg_speed_kmph=25.0, base='200.00', per_km='10.0', per_min='2.0')
+        tariff = pricing.tariff_for()
+        self.stdout.write(f"{'drivers':>8} {'per-row ms':>12} {'numpy ms':>10} {'speedup':>8}")
+        for count in opts['drivers']:
+            lats = [plat + random.uniform(-0.2, 0.2) for _ in range(count)]
+            lngs = [plng + random.uniform(-0.2, 0.2) for _ in range(count)]
+
+            t0 = time.perf_counter()
+            for _ in range(opts['repeat']):
+                _per_row(plat, plng, lats, lngs, opts['top'], **args)
+            loop_ms = (time.perf_counter() - t0) * 1000 / opts['repeat']
+
+            t0 = time.perf_counter()
+            for _ in range(opts['repeat']):
+                _vectorized(plat, plng, lats, lngs, opts['top'], tariff)
+            vec_ms = (time.perf_counter() - t0) * 1000 / opts['repeat']
+
+            self.stdout.write(f"{count:>8} {loop_ms:>12.3f} {vec_ms:>10.3f} {loop_ms / vec_ms:>7.1f}x")
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main import retention
+
+
+class Command(BaseCommand):
+    help = ("Delete driver_locations rows older than the retention window in small batches "
+            "(or drop expired partitions on a partitioned Postgres table). Safe to run from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Retention window in days (default: DRIVER_LOCATION_RETENTION_DAYS).')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches (spread a large backlog over several runs).')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit load.')
+        parser.add_argument('--convert-to-partitions', action='store_true',
+                            help='Postgres only: convert driver_locations to daily range partitions first.')
+
+    def handle(self, *args, **opts):
+        if opts['convert_to_partitions']:
+            try:
+                created = retention.convert_to_partitioned()
+            except RuntimeError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f"partitions created: {', '.join(created) or 'none'}")
+
+        removed = retention.prune_driver_locations(
+            days=opts['days'],
+            batch_size=opts['batch_size'],
+            max_batches=opts['max_batches'],
+            sleep_s=opts['sleep'],
+        )
+        self.stdout.write(self.style.SUCCESS(f"pruned {removed} driver_locations rows"))
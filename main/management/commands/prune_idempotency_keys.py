@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from main import idempotency
+
+
+class Command(BaseCommand):
+    help = "Delete idempotency_keys rows older than IDEMPOTENCY_KEY_TTL_S in batches. Safe to run from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **opts):
+        removed = idempotency.prune(batch_size=opts['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"pruned {removed} idempotency_keys rows"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from main.outbox import dispatcher
+
+
+class Command(BaseCommand):
+    help = ("Send queued channel-layer notifications (main.outbox) until stopped. "
+            "Use with OUTBOX_IN_PROCESS = False to keep the dispatcher out of web workers.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="drain what is due and exit")
+
+    def handle(self, *args, **opts):
+        if opts['once']:
+            self.stdout.write(f"sent {dispatcher.drain()} messages")
+            return
+        dispatcher.run_forever()
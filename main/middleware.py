@@ -1,11 +1,18 @@
 import json
 from urllib.parse import unquote
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
 from django.contrib.sessions.models import Session
 from django.contrib.auth import get_user_model
 from django.db import close_old_connections
+from django.utils.decorators import sync_and_async_middleware
 
 User = get_user_model()
 
+# URL prefixes whose views accept a driver API token (see DriverTokenCsrfMiddleware)
+TOKEN_PATHS = tuple(getattr(settings, 'DRIVER_TOKEN_PATHS', ('/api/driver/',)))
+
 class CookieAuthMiddleware:
     """
     Custom middleware to restore request.session and user
@@ -42,3 +49,33 @@ class CookieAuthMiddleware:
             logging.getLogger("django.channels").warning(f"CookieAuthMiddleware error: {e}")
 
         return await self.inner(scope, receive, send)
+
+
+@sync_and_async_middleware
+def DriverTokenCsrfMiddleware(get_response):
+    """
+    Driver API requests authenticated by a token header (main.api_keys) are not
+    subject to CSRF: browsers never attach that header on their own, and views
+    given a token never fall back to the session cookie. Only paths under
+    DRIVER_TOKEN_PATHS (default /api/driver/) are exempted, and only once the
+    token verifies; anything else goes through CsrfViewMiddleware as usual.
+    Must sit before CsrfViewMiddleware.
+    """
+    from .api_keys import averify, request_token, verify
+
+    def _token(request):
+        return request_token(request) if request.path_info.startswith(TOKEN_PATHS) else None
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = _token(request)
+            if token and await averify(token):
+                request._dont_enforce_csrf_checks = True
+            return await get_response(request)
+    else:
+        def middleware(request):
+            token = _token(request)
+            if token and verify(token):
+                request._dont_enforce_csrf_checks = True
+            return get_response(request)
+    return middleware
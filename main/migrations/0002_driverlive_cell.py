@@ -0,0 +1,43 @@
+# Generated by Django 5.2.6 on 2026-10-18 09:55
+
+from math import floor
+
+from django.db import migrations, models
+
+# must match main.spatial.DB_CELL_DEG at the time this migration was written
+CELL_DEG = 0.05
+
+
+def backfill_cells(apps, schema_editor):
+    DriverLive = apps.get_model('main', 'DriverLive')
+    batch = []
+    rows = DriverLive.objects.filter(latitude__isnull=False, longitude__isnull=False).only('id', 'latitude', 'longitude')
+    for live in rows.iterator(chunk_size=1000):
+        live.cell = f'{int(floor(float(live.latitude) / CELL_DEG))}:{int(floor(float(live.longitude) / CELL_DEG))}'
+        batch.append(live)
+        if len(batch) >= 1000:
+            DriverLive.objects.bulk_update(batch, ['cell'])
+            batch = []
+    if batch:
+        DriverLive.objects.bulk_update(batch, ['cell'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+        ('verify', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driverlive',
+            name='cell',
+            field=models.CharField(blank=True, max_length=24, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='driverlive',
+            index=models.Index(fields=['is_online', 'cell'], name='driver_live_is_onli_54b0f9_idx'),
+        ),
+        migrations.RunPython(backfill_cells, migrations.RunPython.noop),
+    ]
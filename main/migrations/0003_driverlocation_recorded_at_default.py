@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-18 09:57
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_driverlive_cell'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='driverlocation',
+            name='recorded_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
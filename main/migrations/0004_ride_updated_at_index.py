@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_driverlocation_recorded_at_default'),
+        ('verify', '0004_driverdocuments_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['updated_at'], name='rides_updated_b03ec9_idx'),
+        ),
+    ]
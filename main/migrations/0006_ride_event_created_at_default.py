@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-18 10:23
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rideevent',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
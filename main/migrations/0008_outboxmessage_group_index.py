@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-18 10:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(fields=['group', 'id'], name='outbox_mess_group_15830a_idx'),
+        ),
+    ]
@@ -1,5 +1,5 @@
 
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from decimal import Decimal
 import secrets
@@ -7,6 +7,8 @@ import hashlib
 from datetime import timedelta
 from django.utils import timezone
 
+from .spatial import cell_key
+
 RIDE_STATUS = [
     ('requested','Requested'),
     ('matching','Matching'),
@@ -36,25 +38,36 @@ class DriverLive(models.Model):
     longitude = models.DecimalField(max_digits=9, decimal_places=6, blank=True, null=True)
     is_online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(blank=True, null=True)
+    # spatial cell key ("row:col", see main.spatial.cell_key); derived from latitude/longitude on save
+    cell = models.CharField(max_length=24, blank=True, null=True)
 
     class Meta:
         db_table = 'driver_live'
         indexes = [
             models.Index(fields=['is_online']),
             models.Index(fields=['-last_seen']),
+            models.Index(fields=['is_online', 'cell']),
         ]
 
+    def save(self, *args, **kwargs):
+        self.cell = cell_key(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and ({'latitude', 'longitude'} & set(update_fields)):
+            kwargs['update_fields'] = set(update_fields) | {'cell'}
+        super().save(*args, **kwargs)
+
 class DriverLocation(models.Model):
     """
     Append-only telemetry: keep recent location history for driver tracking.
-    Prune older rows with a periodic task to keep table small.
+    Prune older rows with a periodic task to keep table small (manage.py prune_driver_locations, main.retention).
+    Rows are written in batches by main.telemetry, so recorded_at is the fix time, not insert time.
     """
     driver = models.ForeignKey('verify.Drivers', on_delete=models.CASCADE, related_name='locations')
     latitude = models.DecimalField(max_digits=9, decimal_places=6)
     longitude = models.DecimalField(max_digits=9, decimal_places=6)
     speed = models.FloatField(blank=True, null=True)
     heading = models.IntegerField(blank=True, null=True)
-    recorded_at = models.DateTimeField(auto_now_add=True)
+    recorded_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         db_table = 'driver_locations'
@@ -106,6 +119,8 @@ class Ride(models.Model):
             models.Index(fields=['user', '-created_at']),
             models.Index(fields=['driver', 'status']),
             models.Index(fields=['status', 'created_at']),
+            # incremental pulls of recently changed rides (main.surge)
+            models.Index(fields=['updated_at']),
         ]
 
 class RideEvent(models.Model):
@@ -117,7 +132,8 @@ class RideEvent(models.Model):
     actor_type = models.CharField(max_length=30, blank=True, null=True)  # 'user','driver','system','ceo'
     event_type = models.CharField(max_length=80)
     event_data = models.JSONField(blank=True, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # when it happened, not when main.ride_events flushed it (so no auto_now_add)
+    created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         db_table = 'ride_events'
@@ -161,6 +177,41 @@ class Review(models.Model):
         db_table = 'reviews'
         indexes = [models.Index(fields=['driver']), models.Index(fields=['user'])]
 
+class OutboxMessage(models.Model):
+    """
+    Channel-layer message written in the same transaction as the change it announces.
+    Sent (and deleted) by the dispatcher in main.outbox; rows with failed_at set ran out of retries.
+    """
+    group = models.CharField(max_length=200)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    failed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'outbox_messages'
+        indexes = [
+            models.Index(fields=['failed_at', 'available_at']),
+            models.Index(fields=['group', 'id']),  # per-group ordering check in main.outbox.claim
+        ]
+
+class IdempotencyKey(models.Model):
+    """
+    Stored response for an Idempotency-Key (see main.idempotency).
+    status_code is NULL while the first request with the key is still running.
+    """
+    key = models.CharField(max_length=64, unique=True)  # sha256 of (endpoint, user, header value)
+    request_hash = models.CharField(max_length=64)      # sha256 of the request body
+    status_code = models.PositiveSmallIntegerField(blank=True, null=True)
+    response_body = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'idempotency_keys'
+        indexes = [models.Index(fields=['created_at'])]
+
 def _hash_token(raw: str) -> str:
     """Return sha256 hex digest of raw token."""
     return hashlib.sha256(raw.encode('utf-8')).hexdigest()
@@ -196,9 +247,12 @@ class DriverAPIKey(models.Model):
         Create (or replace) an API key for the driver.
         Returns the raw token (show this to the caller only once).
         """
+        from .api_keys import forget
+
         raw = cls.generate_raw_token()
         key_hash = _hash_token(raw)
 
+        replaced = cls.objects.filter(driver=driver).values_list('key_hash', flat=True).first()
         # If there's already a key, replace it (or you could keep multiple)
         obj, created = cls.objects.update_or_create(
             driver=driver,
@@ -209,27 +263,25 @@ class DriverAPIKey(models.Model):
                 'expires_at': (timezone.now() + timedelta(days=lifetime_days)) if lifetime_days else None,
             }
         )
+        # the replaced token must stop verifying right away (it may be cached); forgotten only once
+        # the new row is committed, or a concurrent verify() could cache the old row again
+        if replaced:
+            transaction.on_commit(lambda: forget(replaced))
         return raw
 
     @classmethod
     def verify_token(cls, raw_token: str):
         """
         Return DriverAPIKey instance if token valid and not revoked/expired, else None.
-        Also updates last_used timestamp.
+        Verification goes through the cache in main.api_keys; last_used is
+        recorded there too and written in batches, not per call.
         """
-        if not raw_token:
-            return None
-        key_hash = _hash_token(raw_token)
-        try:
-            obj = cls.objects.get(key_hash=key_hash, revoked=False)
-        except cls.DoesNotExist:
-            return None
-        if obj.expires_at and obj.expires_at < timezone.now():
+        from .api_keys import verify
+
+        principal = verify(raw_token)
+        if principal is None:
             return None
-        # Update last_used
-        obj.last_used = timezone.now()
-        obj.save(update_fields=['last_used'])
-        return obj
+        return cls.objects.filter(pk=principal.key_id).first()
 
     def revoke(self):
         self.revoked = True
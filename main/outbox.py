@@ -0,0 +1,209 @@
+"""
+Transactional outbox for channel-layer notifications.
+
+enqueue([(group, event), ...]) inserts OutboxMessage rows in the caller's
+transaction, so a ride change and its notifications commit (or roll back)
+together. The request never talks to the channel layer (Redis).
+
+A dispatcher thread per process (started on first enqueue, or run on its
+own with `manage.py run_outbox`) drains due rows in batches:
+- Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED where the database
+  supports it. The claim is a short lease on available_at, so several
+  dispatchers never send the same row.
+- Messages to one group are delivered in id order. Within a batch each
+  group's rows are sent one after the other; only different groups are sent
+  concurrently (asyncio.gather). When a send fails, the rest of that group
+  is held back, and claim() skips a row while an older row of its group is
+  leased or backing off.
+- Sent rows are deleted. Failed rows are retried with exponential backoff.
+  After OUTBOX_MAX_ATTEMPTS a row is marked failed_at and kept for
+  inspection, not lost (and no longer holds its group back).
+
+Sends run on the dispatcher's own event loop, which is right for
+RedisChannelLayer (REDIS_URL) and required in production. The
+InMemoryChannelLayer used without Redis keeps its queues on the server's
+event loop, and another loop must not touch them. With that layer the
+websocket middleware (medwheels.asgi) hands the server loop to
+attach_loop(), and sends are run there instead.
+Commits wake the dispatcher straight away. The poll interval only matters
+for rows left behind by other processes.
+
+Location fixes do not go through here: they are high-volume and superseded
+by the next fix, so main.live keeps sending them directly.
+
+Settings:
+  OUTBOX_BATCH            rows per claim (default 200)
+  OUTBOX_POLL_S           idle poll interval (default 1.0)
+  OUTBOX_LEASE_S          how long a claimed row is hidden from other dispatchers (default 30)
+  OUTBOX_MAX_ATTEMPTS     sends before a row is marked failed (default 8)
+  OUTBOX_IN_PROCESS       run the dispatcher thread in web workers (default True)
+"""
+import asyncio
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+BATCH = int(getattr(settings, 'OUTBOX_BATCH', 200))
+POLL_S = float(getattr(settings, 'OUTBOX_POLL_S', 1.0))
+LEASE_S = float(getattr(settings, 'OUTBOX_LEASE_S', 30))
+MAX_ATTEMPTS = int(getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 8))
+IN_PROCESS = getattr(settings, 'OUTBOX_IN_PROCESS', True)
+
+
+def backoff_s(attempts):
+    return min(2 ** attempts, 300)
+
+
+async def _send_groups(layer, rows):
+    """
+    Send rows (in id order) group by group, concurrently across groups only.
+    -> {pk: None if sent, else the exception}; rows after a failure in their group are left out.
+    """
+    by_group = {}
+    for r in rows:
+        by_group.setdefault(r.group, []).append(r)
+    results = {}
+
+    async def _send_group(group_rows):
+        for r in group_rows:
+            try:
+                await layer.group_send(r.group, r.payload)
+            except Exception as e:
+                results[r.pk] = e
+                return
+            results[r.pk] = None
+
+    await asyncio.gather(*(_send_group(group_rows) for group_rows in by_group.values()))
+    return results
+
+
+class Dispatcher:
+    def __init__(self, batch=BATCH, poll_s=POLL_S):
+        self.batch = batch
+        self.poll_s = poll_s
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._loop = None
+        self._asgi_loop = None
+        self._stopping = False
+
+    def wake(self):
+        self._wake.set()
+
+    def attach_loop(self, loop):
+        """Remember the ASGI server's event loop (used for an InMemoryChannelLayer)."""
+        self._asgi_loop = loop
+
+    # --- draining ---
+    def claim(self):
+        """Lease up to `batch` due rows to this dispatcher; returns them."""
+        now = timezone.now()
+        # an older row of the same group that is leased or backing off goes first
+        held_back = OutboxMessage.objects.filter(
+            group=OuterRef('group'), id__lt=OuterRef('id'), failed_at__isnull=True, available_at__gt=now)
+        with transaction.atomic():
+            rows = list(
+                OutboxMessage.objects.select_for_update(skip_locked=True)
+                .filter(failed_at__isnull=True, available_at__lte=now)
+                .exclude(Exists(held_back))
+                .order_by('id')[:self.batch]
+            )
+            if rows:
+                OutboxMessage.objects.filter(pk__in=[r.pk for r in rows]).update(
+                    available_at=now + timedelta(seconds=LEASE_S))
+        return rows
+
+    def send(self, rows):
+        """Send claimed rows; delete the sent ones, reschedule or fail the rest."""
+        from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+        layer = get_channel_layer()
+        loop = self._asgi_loop
+        if isinstance(layer, InMemoryChannelLayer) and loop is not None and not loop.is_closed():
+            # its queues belong to the server loop (no websocket attached yet = nobody to deliver to)
+            results = asyncio.run_coroutine_threadsafe(_send_groups(layer, rows), loop).result(LEASE_S)
+        else:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+            results = self._loop.run_until_complete(_send_groups(layer, rows))
+
+        sent = [pk for pk, res in results.items() if res is None]
+        if sent:
+            OutboxMessage.objects.filter(pk__in=sent).delete()
+        now = timezone.now()
+        for r in rows:
+            if r.pk not in results:
+                # held back behind a failed row of its group: release the lease, claim() keeps the order
+                OutboxMessage.objects.filter(pk=r.pk).update(available_at=now)
+                continue
+            res = results[r.pk]
+            if res is None:
+                continue
+            attempts = r.attempts + 1
+            update = {'attempts': attempts, 'last_error': repr(res)[:1000]}
+            if attempts >= MAX_ATTEMPTS:
+                update['failed_at'] = now
+                logger.error("outbox message %s to %s failed %s times: %s", r.pk, r.group, attempts, res)
+            else:
+                update['available_at'] = now + timedelta(seconds=backoff_s(attempts))
+            OutboxMessage.objects.filter(pk=r.pk).update(**update)
+        return len(sent)
+
+    def drain(self):
+        """Send everything that is due; returns the number of messages sent."""
+        total = 0
+        while True:
+            rows = self.claim()
+            if not rows:
+                return total
+            total += self.send(rows)
+            if len(rows) < self.batch:
+                return total
+
+    # --- thread ---
+    def run_forever(self):
+        while not self._stopping:
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.drain()
+            except Exception:
+                logger.exception("outbox drain failed")
+            finally:
+                close_old_connections()
+            self._wake.wait(self.poll_s)
+
+    def ensure_thread(self):
+        # (re)start lazily, and again after a fork (e.g. gunicorn --preload workers)
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._loop = None
+        self._thread = threading.Thread(target=self.run_forever, name='outbox-dispatcher', daemon=True)
+        self._thread.start()
+
+
+dispatcher = Dispatcher()
+
+
+def enqueue(messages):
+    """Queue [(group, event), ...] in the current transaction; sent after it commits."""
+    messages = list(messages)
+    if not messages:
+        return 0
+    OutboxMessage.objects.bulk_create([OutboxMessage(group=g, payload=e) for g, e in messages])
+    if IN_PROCESS:
+        dispatcher.ensure_thread()
+        transaction.on_commit(dispatcher.wake)
+    return len(messages)
@@ -0,0 +1,151 @@
+"""
+Fare engine: per-ambulance-type tariffs with time-of-day tables, computed in
+integer paise.
+
+Tariffs are parsed from settings once, at import. Each ambulance type gets a
+day table: a sorted list of (start minute, Tariff) that covers 00:00-24:00,
+so finding the tariff in force is a bisect. quote_batch() prices a whole
+candidate batch in one NumPy int64 pass. No Decimal or float money is
+involved. Amounts are rounded half-up to the paisa, and the minimum fare
+is applied per candidate. A surge multiplier from main.surge (in
+thousandths) is applied last.
+
+FARE_TARIFFS = {
+    'medwheels_basic': {
+        'base': '200.00', 'per_km': '10.00', 'per_min': '2.00', 'minimum': '200.00',
+        # optional time-of-day overrides (local time in FARE_TIME_ZONE; may wrap midnight)
+        'periods': [{'from': '22:00', 'to': '06:00', 'base': '250.00', 'per_km': '12.50'}],
+    },
+}
+
+Without FARE_TARIFFS there is one type, DEFAULT_TYPE, built from the older
+FARE_BASE / FARE_PER_KM / FARE_PER_MIN settings.
+
+Settings:
+  FARE_TARIFFS         see above
+  FARE_DEFAULT_TYPE    ambulance type used when none is given (default 'medwheels_basic')
+  FARE_TIME_ZONE       zone the period times are in (default 'Asia/Kolkata')
+"""
+from bisect import bisect_right
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+# all money fields in paise; rates are per km / per minute
+Tariff = namedtuple('Tariff', 'base per_km per_min minimum')
+
+DEFAULT_TYPE = getattr(settings, 'FARE_DEFAULT_TYPE', 'medwheels_basic')
+TIME_ZONE = ZoneInfo(getattr(settings, 'FARE_TIME_ZONE', 'Asia/Kolkata'))
+MINUTES_PER_DAY = 24 * 60
+NO_SURGE = 1000  # surge multipliers are in thousandths
+
+
+class UnknownAmbulanceType(KeyError):
+    pass
+
+
+def to_paise(amount):
+    """'12.345' / 12.345 / Decimal -> 1235 (half-up)."""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def rupees(paise):
+    """1235 -> '12.35' (what the JSON payloads carry)."""
+    paise = int(paise)
+    sign = '-' if paise < 0 else ''
+    return f'{sign}{abs(paise) // 100}.{abs(paise) % 100:02d}'
+
+
+def to_decimal(paise):
+    """1235 -> Decimal('12.35') for DecimalField columns."""
+    return Decimal(int(paise)).scaleb(-2)
+
+
+def _minute(hhmm):
+    h, m = hhmm.split(':')
+    return (int(h) * 60 + int(m)) % MINUTES_PER_DAY
+
+
+def _tariff(spec, fallback=None):
+    def field(name):
+        if name in spec:
+            return to_paise(spec[name])
+        return getattr(fallback, name) if fallback else 0
+    base = field('base')
+    minimum = to_paise(spec['minimum']) if 'minimum' in spec else (fallback.minimum if fallback else base)
+    return Tariff(base, field('per_km'), field('per_min'), minimum)
+
+
+def _day_table(spec):
+    """[(start_minute, Tariff), ...] sorted by start and covering the whole day."""
+    default = _tariff(spec)
+    owner = [None] * MINUTES_PER_DAY  # minute of day -> period tariff (later periods win)
+    for period in spec.get('periods') or ():
+        tariff = _tariff(period, default)
+        start, end = _minute(period['from']), _minute(period['to'])
+        span = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+        for i in range(span):
+            owner[(start + i) % MINUTES_PER_DAY] = tariff
+    table = []
+    for minute, tariff in enumerate(owner):
+        tariff = tariff or default
+        if not table or table[-1][1] != tariff:
+            table.append((minute, tariff))
+    return table
+
+
+def _load():
+    specs = getattr(settings, 'FARE_TARIFFS', None) or {
+        DEFAULT_TYPE: {
+            'base': getattr(settings, 'FARE_BASE', '200.00'),
+            'per_km': getattr(settings, 'FARE_PER_KM', '10.0'),
+            'per_min': getattr(settings, 'FARE_PER_MIN', '2.0'),
+        },
+    }
+    tables = {}
+    for ambulance_type, spec in specs.items():
+        table = _day_table(spec)
+        tables[ambulance_type] = ([start for start, _ in table], [tariff for _, tariff in table])
+    return tables
+
+
+_TABLES = _load()
+
+
+def ambulance_types():
+    return list(_TABLES)
+
+
+def tariff_for(ambulance_type=None, at=None):
+    """Tariff in force for the type at `at` (aware datetime, default now)."""
+    try:
+        starts, tariffs = _TABLES[ambulance_type or DEFAULT_TYPE]
+    except KeyError:
+        raise UnknownAmbulanceType(ambulance_type)
+    local = timezone.localtime(at or timezone.now(), TIME_ZONE)
+    return tariffs[bisect_right(starts, local.hour * 60 + local.minute) - 1]
+
+
+def quote_batch(distance_m, eta_s, ambulance_type=None, at=None, tariff=None, surge=NO_SURGE):
+    """
+    Fares in paise (int64 array) for arrays of distance (m) and ETA (s):
+    base + per_km * km + per_min * minutes, each term rounded half-up, floored at minimum,
+    then times surge (thousandths, see main.surge; 1000 = none).
+    """
+    t = tariff or tariff_for(ambulance_type, at)
+    d = np.rint(np.asarray(distance_m, dtype=np.float64)).astype(np.int64)
+    s = np.asarray(eta_s, dtype=np.int64)
+    fare = t.base + (t.per_km * d + 500) // 1000 + (t.per_min * s + 30) // 60
+    fare = np.maximum(fare, t.minimum)
+    if surge != NO_SURGE:
+        fare = (fare * int(surge) + 500) // 1000
+    return fare
+
+
+def quote(distance_m, eta_s, ambulance_type=None, at=None, surge=NO_SURGE):
+    """Fare in paise (int) for a single trip."""
+    return int(quote_batch([distance_m], [eta_s], ambulance_type, at, surge=surge)[0])
@@ -0,0 +1,200 @@
+"""
+Retention for the driver_locations telemetry table.
+
+prune_driver_locations() deletes rows older than the retention window in
+small batches walked in recorded_at index order, each batch its own short
+transaction, so no long table lock is taken. Run it from cron / any scheduler
+via `python manage.py prune_driver_locations`.
+
+On Postgres the table can optionally be range-partitioned by recorded_at
+(convert_to_partitioned()); pruning then drops whole partitions whose upper
+bound is past the cutoff (O(1)) and pre-creates daily partitions ahead. A
+DEFAULT partition catches rows if the pruner has not run for a while. Postgres
+will not create a partition for a range the DEFAULT partition already holds
+rows for, so ensure_partitions() moves those rows into the new day partition
+(detach DEFAULT, create, move, re-attach) in one transaction.
+
+Settings:
+  DRIVER_LOCATION_RETENTION_DAYS   days of history to keep (default 7)
+"""
+import re
+import time
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import DriverLocation
+
+RETENTION_DAYS = int(getattr(settings, 'DRIVER_LOCATION_RETENTION_DAYS', 7))
+TABLE = DriverLocation._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def cutoff_for(days=None):
+    return timezone.now() - timedelta(days=RETENTION_DAYS if days is None else days)
+
+
+def prune_driver_locations(days=None, batch_size=5000, max_batches=None, sleep_s=0.0):
+    """
+    Delete DriverLocation rows older than `days` (default DRIVER_LOCATION_RETENTION_DAYS).
+    Returns the number of rows removed (partition drops count as their row estimate).
+    """
+    cutoff = cutoff_for(days)
+    removed = 0
+    if is_partitioned():
+        removed += drop_expired_partitions(cutoff)
+        ensure_partitions()
+
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        # oldest first, straight off the recorded_at index
+        ids = list(
+            DriverLocation.objects.filter(recorded_at__lt=cutoff)
+            .order_by('recorded_at').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        with transaction.atomic():
+            deleted, _ = DriverLocation.objects.filter(id__in=ids).delete()
+        removed += deleted
+        batches += 1
+        if len(ids) < batch_size:
+            break
+        if sleep_s:
+            time.sleep(sleep_s)
+    return removed
+
+
+# --- Postgres partitioning (optional) ---
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = %s AND pg_table_is_visible(c.oid)", [TABLE])
+        return cursor.fetchone() is not None
+
+
+def partitions():
+    """Return [(partition_name, upper_bound_or_None, estimated_rows), ...]."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint "
+            "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s", [TABLE])
+        out = []
+        for name, bound, rows in cursor.fetchall():
+            m = _UPPER_BOUND.search(bound or '')
+            upper = datetime.fromisoformat(m.group(1)) if m else None
+            if upper is not None and timezone.is_naive(upper):
+                upper = timezone.make_aware(upper, dt_timezone.utc)
+            out.append((name, upper, max(rows, 0)))
+        return out
+
+
+def drop_expired_partitions(cutoff):
+    """Drop partitions that only hold rows older than cutoff. Returns their estimated row count."""
+    removed = 0
+    qn = connection.ops.quote_name
+    for name, upper, rows in partitions():
+        if upper is None or upper > cutoff:
+            continue
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f"ALTER TABLE {qn(TABLE)} DETACH PARTITION {qn(name)}")
+                cursor.execute(f"DROP TABLE {qn(name)}")
+        removed += rows
+    return removed
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, dt_time.min), dt_timezone.utc)
+
+
+def ensure_partitions(days_ahead=7):
+    """Create daily partitions from today up to days_ahead (idempotent). Returns names created."""
+    qn = connection.ops.quote_name
+    parts = partitions()
+    existing = {name for name, _u, _r in parts}
+    latest = max((u for _n, u, _r in parts if u is not None), default=None)
+    created = []
+    today = timezone.now().astimezone(dt_timezone.utc).date()
+    for offset in range(days_ahead + 1):
+        day = today + timedelta(days=offset)
+        start, end = _day_start(day), _day_start(day + timedelta(days=1))
+        name = f"{TABLE}_p{day:%Y%m%d}"
+        if name in existing or (latest is not None and start < latest):
+            continue
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                moving = DEFAULT_PARTITION in existing and _default_has_rows(cursor, start, end)
+                if moving:
+                    # the DEFAULT partition's implicit constraint would block the CREATE
+                    cursor.execute(f"ALTER TABLE {qn(TABLE)} DETACH PARTITION {qn(DEFAULT_PARTITION)}")
+                cursor.execute(
+                    f"CREATE TABLE {qn(name)} PARTITION OF {qn(TABLE)} FOR VALUES FROM (%s) TO (%s)",
+                    [start.isoformat(), end.isoformat()])
+                if moving:
+                    cursor.execute(
+                        f"INSERT INTO {qn(name)} SELECT * FROM {qn(DEFAULT_PARTITION)} "
+                        f"WHERE recorded_at >= %s AND recorded_at < %s", [start, end])
+                    cursor.execute(
+                        f"DELETE FROM {qn(DEFAULT_PARTITION)} WHERE recorded_at >= %s AND recorded_at < %s",
+                        [start, end])
+                    cursor.execute(f"ALTER TABLE {qn(TABLE)} ATTACH PARTITION {qn(DEFAULT_PARTITION)} DEFAULT")
+        created.append(name)
+    return created
+
+
+def _default_has_rows(cursor, start, end):
+    cursor.execute(
+        f"SELECT 1 FROM {connection.ops.quote_name(DEFAULT_PARTITION)} "
+        f"WHERE recorded_at >= %s AND recorded_at < %s LIMIT 1", [start, end])
+    return cursor.fetchone() is not None
+
+
+@transaction.atomic
+def convert_to_partitioned(days_ahead=7):
+    """
+    One-off: turn driver_locations into a table range-partitioned by recorded_at.
+    The existing table is kept as the first partition (everything before tomorrow)
+    and is dropped by the pruner once the cutoff passes its upper bound.
+    Takes an ACCESS EXCLUSIVE lock for the duration; run it in a quiet window.
+    """
+    if connection.vendor != 'postgresql':
+        raise RuntimeError('time-partitioned driver_locations needs Postgres')
+    if is_partitioned():
+        return ensure_partitions(days_ahead)
+
+    qn = connection.ops.quote_name
+    legacy = f"{TABLE}_legacy"
+    tomorrow = _day_start(timezone.now().astimezone(dt_timezone.utc).date() + timedelta(days=1))
+    drivers_table = DriverLocation._meta.get_field('driver').related_model._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {qn(TABLE)} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {qn(TABLE)}")
+        next_id = cursor.fetchone()[0] + 1
+        cursor.execute(f"ALTER TABLE {qn(TABLE)} RENAME TO {qn(legacy)}")
+        cursor.execute(f"ALTER TABLE {qn(legacy)} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        cursor.execute(
+            f"CREATE TABLE {qn(TABLE)} (LIKE {qn(legacy)} INCLUDING DEFAULTS) PARTITION BY RANGE (recorded_at)")
+        cursor.execute(f"ALTER TABLE {qn(TABLE)} ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY "
+                       f"(START WITH {int(next_id)})")
+        # the partition key has to be part of the primary key
+        cursor.execute(f"ALTER TABLE {qn(TABLE)} ADD PRIMARY KEY (id, recorded_at)")
+        cursor.execute(f"CREATE INDEX {qn(TABLE + '_drv_rec_idx')} ON {qn(TABLE)} (driver_id, recorded_at DESC)")
+        cursor.execute(f"CREATE INDEX {qn(TABLE + '_rec_idx')} ON {qn(TABLE)} (recorded_at)")
+        cursor.execute(
+            f"ALTER TABLE {qn(TABLE)} ADD CONSTRAINT {qn(TABLE + '_driver_fk')} FOREIGN KEY (driver_id) "
+            f"REFERENCES {qn(drivers_table)} (id) DEFERRABLE INITIALLY DEFERRED")
+        cursor.execute(
+            f"ALTER TABLE {qn(TABLE)} ATTACH PARTITION {qn(legacy)} FOR VALUES FROM (MINVALUE) TO (%s)",
+            [tomorrow.isoformat()])
+        cursor.execute(f"CREATE TABLE {qn(DEFAULT_PARTITION)} PARTITION OF {qn(TABLE)} DEFAULT")
+    return [legacy] + ensure_partitions(days_ahead)
@@ -0,0 +1,74 @@
+"""
+Cached driver -> active ride ids mapping.
+
+Every location fix is forwarded to the riders of the driver's active rides.
+Instead of querying Ride on each fix, the ids live in the cache (Redis when
+configured) and are refreshed on every main.rides transition, which is the
+only way a ride enters or leaves an active status.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Ride
+
+ACTIVE_STATUSES = ('assigned', 'accepted', 'on_trip')
+TTL_S = int(getattr(settings, 'ACTIVE_RIDE_CACHE_TTL_S', 6 * 3600))
+
+
+def _key(driver_id):
+    return f'active_rides:{driver_id}'
+
+
+def _load(driver_id):
+    return list(Ride.objects.filter(driver_id=driver_id, status__in=ACTIVE_STATUSES).values_list('id', flat=True))
+
+
+def active_ride_ids(driver_id):
+    """Ids of the driver's assigned/accepted/on_trip rides; no DB round-trip on a cache hit."""
+    try:
+        ids = cache.get(_key(driver_id))
+    except Exception:
+        # cache backend down: fall back to the query
+        return _load(driver_id)
+    if ids is None:
+        ids = _load(driver_id)
+        try:
+            cache.set(_key(driver_id), ids, TTL_S)
+        except Exception:
+            pass
+    return ids
+
+
+async def aactive_ride_ids(driver_id):
+    """Async-ORM twin of active_ride_ids() for async views and consumers."""
+    try:
+        ids = await cache.aget(_key(driver_id))
+    except Exception:
+        ids = None
+    if ids is None:
+        ids = [i async for i in Ride.objects.filter(driver_id=driver_id, status__in=ACTIVE_STATUSES)
+               .values_list('id', flat=True)]
+        try:
+            await cache.aset(_key(driver_id), ids, TTL_S)
+        except Exception:
+            pass
+    return ids
+
+
+def refresh(driver_id):
+    """Recompute the mapping for a driver once the current transaction commits."""
+    if not driver_id:
+        return
+
+    def _refresh():
+        try:
+            cache.set(_key(driver_id), _load(driver_id), TTL_S)
+        except Exception:
+            # can't write the fresh value: at least don't leave a stale one behind
+            try:
+                cache.delete(_key(driver_id))
+            except Exception:
+                pass
+
+    transaction.on_commit(_refresh)
@@ -0,0 +1,140 @@
+"""
+RideEvent audit trail, written behind.
+
+record(ride_id, event_type, ...) appends to memory and returns; a
+WriteBehindBuffer thread persists batches with bulk_create. created_at is the
+moment of record(), so the timeline order does not depend on when a batch
+was flushed. Inside a transaction the event is queued on commit, so a
+rolled-back change leaves no event behind.
+
+Recorded by:
+- api_book_ride / api_request_ambulance_type: ride.requested, ride.offered (per driver)
+- api_driver_respond: ride.offer_rejected
+- main.rides transitions: ride.assigned, ride.cancelled, ride.matching_failed, ...
+- main.live.save_fix: driver.near_pickup, the first fix of an assigned driver
+  within RIDE_EVENT_NEAR_PICKUP_M of the pickup (once per ride per worker)
+
+atimeline(ride_id) streams a ride's events over the (ride, -created_at) index,
+one chunk per query, from async code (the ASGI response iterates it on the
+event loop; each chunk is fetched in a worker thread). Events reach it after
+the next flush (RIDE_EVENT_FLUSH_MS at most).
+
+Settings:
+  RIDE_EVENT_FLUSH_ROWS     flush once this many events are buffered (default 200)
+  RIDE_EVENT_FLUSH_MS       ...or after this many milliseconds (default 1000)
+  RIDE_EVENT_MAX_BUFFER     events kept in memory before new ones are dropped (default 20000)
+  RIDE_EVENT_NEAR_PICKUP_M  radius for driver.near_pickup (default 150)
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .models import Ride, RideEvent
+from .spatial import haversine_m
+from .writebehind import WriteBehindBuffer
+
+NEAR_PICKUP_M = float(getattr(settings, 'RIDE_EVENT_NEAR_PICKUP_M', 150.0))
+
+# transition name (main.rides) -> event type
+TRANSITION_EVENTS = {
+    'assign': 'ride.assigned',
+    'accept': 'ride.accepted',
+    'arrive': 'ride.arrived',
+    'start': 'ride.started',
+    'complete': 'ride.completed',
+    'cancel': 'ride.cancelled',
+    'fail': 'ride.matching_failed',
+}
+
+
+def write_events(rows):
+    """Insert a batch of (ride_id, actor_user_id, actor_type, event_type, data, created_at) tuples."""
+    events = [
+        RideEvent(ride_id=ride_id, actor_user_id=actor_user_id, actor_type=actor_type,
+                  event_type=event_type, event_data=data, created_at=created_at)
+        for ride_id, actor_user_id, actor_type, event_type, data, created_at in rows
+    ]
+    try:
+        with transaction.atomic():
+            RideEvent.objects.bulk_create(events)
+    except IntegrityError:
+        # a ride deleted before the flush: keep the rest of the batch
+        live = set(Ride.objects.filter(pk__in={e.ride_id for e in events}).values_list('id', flat=True))
+        RideEvent.objects.bulk_create([e for e in events if e.ride_id in live])
+
+
+event_writer = WriteBehindBuffer(
+    'ride_events',
+    write_events,
+    max_rows=int(getattr(settings, 'RIDE_EVENT_FLUSH_ROWS', 200)),
+    max_delay_ms=int(getattr(settings, 'RIDE_EVENT_FLUSH_MS', 1000)),
+    max_buffer=int(getattr(settings, 'RIDE_EVENT_MAX_BUFFER', 20000)),
+)
+
+
+def record(ride_id, event_type, data=None, actor_type='system', actor_user_id=None, at=None):
+    """Queue one RideEvent (after commit when inside a transaction). Never queries."""
+    row = (ride_id, actor_user_id, actor_type, event_type, data, at or timezone.now())
+    # plain attribute read: safe from async code, which never holds an atomic block here
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: event_writer.add(row))
+    else:
+        event_writer.add(row)
+
+
+def record_many(ride_id, events, actor_type='system', actor_user_id=None):
+    """record() for [(event_type, data), ...], in that order."""
+    at = timezone.now()
+    for i, (event_type, data) in enumerate(events):
+        # 1us apart: the timeline is ordered by created_at alone (that is what the index covers)
+        record(ride_id, event_type, data, actor_type, actor_user_id, at + timedelta(microseconds=i))
+
+
+# --- location milestones ---
+
+# ride id -> (pickup lat, lng), or None once the milestone is recorded / there is no pickup
+_pickups = {}
+MAX_TRACKED = 10000
+
+
+async def anote_fix(driver_id, lat, lng, ride_ids, now):
+    """Record driver.near_pickup for the driver's active rides this fix reached."""
+    if lat is None or lng is None or not ride_ids:
+        return
+    missing = [ride_id for ride_id in ride_ids if ride_id not in _pickups]
+    if missing:
+        if len(_pickups) > MAX_TRACKED:
+            _pickups.clear()  # finished rides are never looked at again
+        async for ride_id, p_lat, p_lng in Ride.objects.filter(pk__in=missing).values_list(
+                'id', 'pickup_lat', 'pickup_lng'):
+            _pickups[ride_id] = (float(p_lat), float(p_lng)) if p_lat is not None and p_lng is not None else None
+    for ride_id in ride_ids:
+        pickup = _pickups.get(ride_id)
+        if pickup is None:
+            continue
+        d_m = haversine_m(float(lat), float(lng), pickup[0], pickup[1])
+        if d_m <= NEAR_PICKUP_M:
+            _pickups[ride_id] = None
+            record(ride_id, 'driver.near_pickup', {'driver_id': driver_id, 'distance_m': int(d_m)},
+                   actor_type='driver', at=now)
+
+
+# --- reads ---
+
+async def atimeline(ride_id, newest_first=False, limit=None, chunk_size=500):
+    """Async-yield a ride's events as dicts, streamed from the (ride, -created_at) index."""
+    qs = RideEvent.objects.filter(ride_id=ride_id).order_by('-created_at' if newest_first else 'created_at')
+    if limit:
+        qs = qs[:limit]
+    # values(), not values_list(): ValuesListIterable runs its query before aiterator() moves to a thread
+    async for row in qs.values(
+            'event_type', 'actor_type', 'actor_user_id', 'event_data', 'created_at').aiterator(chunk_size=chunk_size):
+        yield {
+            'type': row['event_type'],
+            'actor_type': row['actor_type'],
+            'actor_user_id': row['actor_user_id'],
+            'data': row['event_data'],
+            'at': row['created_at'].isoformat(),
+        }
@@ -0,0 +1,134 @@
+"""
+Ride state machine with compare-and-set transitions.
+
+Each transition is one conditional UPDATE:
+
+    UPDATE rides SET status = <to>, <stamp> = now, ...
+     WHERE id = %s AND status IN (<from>) [AND driver_id IS NULL | = %s] [AND user_id = %s]
+
+The affected-row count decides the outcome. With 8 drivers tapping accept
+at once, exactly one UPDATE matches and the rest get 0 rows back right
+away. Nobody queues on a row lock held across queries and channel sends
+(the old select_for_update() in api_driver_respond did that).
+
+Channel notifications for a change are written to the outbox (main.outbox)
+in the same transaction as the UPDATE: pass notify=lambda ride: [(group,
+event), ...]. They are sent only if the change commits, and the request
+never waits on the channel layer.
+
+Other side effects run after the transaction commits, and never while a
+lock is held:
+- ride_cache refresh
+- surge counts (the UPDATE bypasses post_save)
+- the RideEvent for the transition (main.ride_events)
+"""
+from collections import namedtuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import outbox, ride_cache, ride_events, surge
+from .models import Ride
+
+OPEN = ('requested', 'matching')
+
+# name -> (allowed from-states, to-state, timestamp field)
+TRANSITIONS = {
+    'assign':   (OPEN, 'assigned', 'assigned_at'),
+    'accept':   (('assigned',), 'accepted', 'accepted_at'),
+    'arrive':   (('assigned', 'accepted'), 'arrived', 'arrived_at'),
+    'start':    (('arrived',), 'on_trip', 'started_at'),
+    'complete': (('on_trip',), 'completed', 'completed_at'),
+    'cancel':   (OPEN + ('assigned', 'accepted', 'arrived'), 'cancelled', 'cancelled_at'),
+    'fail':     (OPEN, 'cancelled', 'cancelled_at'),  # matching gave up (no driver)
+}
+
+# won: this call made the change. ride: the row after the change (winner) or as found (loser).
+Outcome = namedtuple('Outcome', 'won ride')
+
+
+class InvalidTransition(ValueError):
+    pass
+
+
+def transition(ride_id, name, driver_id=None, only_unassigned=False, user_id=None, notify=None,
+               updated_before=None, **fields):
+    """
+    Apply transition `name` to ride `ride_id` if its status allows it.
+
+    driver_id        for 'assign': the driver to set; otherwise the ride must belong to this driver
+    only_unassigned  also require driver_id IS NULL (assign)
+    user_id          require the ride to belong to this rider
+    updated_before   require updated_at < this (nobody has touched the ride since; main.dispatch sweep)
+    notify           ride -> [(group, event), ...]; queued in the outbox if this call wins.
+                     It runs while the UPDATE's row lock is held: build payloads beforehand
+                     and keep it to assembling messages (no queries).
+    fields           extra columns to set (e.g. cancellation_reason)
+
+    Returns Outcome(won, ride). ride is None if no such ride exists (or it is not the
+    caller's), so callers can tell "not found" from "lost the race / wrong status".
+    """
+    try:
+        from_states, to_state, stamp = TRANSITIONS[name]
+    except KeyError:
+        raise InvalidTransition(name)
+
+    now = timezone.now()
+    qs = Ride.objects.filter(pk=ride_id, status__in=from_states)
+    if only_unassigned:
+        qs = qs.filter(driver_id__isnull=True)
+    if user_id is not None:
+        qs = qs.filter(user_id=user_id)
+    if updated_before is not None:
+        qs = qs.filter(updated_at__lt=updated_before)
+    values = dict(fields, status=to_state, updated_at=now)  # .update() skips auto_now
+    values[stamp] = now
+    if name == 'assign':
+        values['driver_id'] = driver_id
+    elif driver_id is not None:
+        qs = qs.filter(driver_id=driver_id)
+
+    with transaction.atomic():
+        won = qs.update(**values) == 1
+
+        lookup = Ride.objects.filter(pk=ride_id)
+        if user_id is not None:
+            lookup = lookup.filter(user_id=user_id)
+        ride = lookup.first()
+        if won and ride is not None:
+            if notify is not None:
+                outbox.enqueue(notify(ride))
+            _after_change(ride)
+            _record(ride, name, user_id, fields)
+    return Outcome(won, ride)
+
+
+def _after_change(ride):
+    ride_cache.refresh(ride.driver_id)
+    surge.feed_on_commit(ride)
+
+
+def _record(ride, name, user_id, fields):
+    data = {'driver_id': ride.driver_id}
+    if fields.get('cancellation_reason'):
+        data['reason'] = fields['cancellation_reason']
+    if user_id is not None:
+        actor_type = 'user'
+    elif name in ('assign', 'accept', 'arrive', 'start', 'complete'):
+        actor_type = 'driver'
+    else:
+        actor_type = 'system'
+    ride_events.record(ride.id, ride_events.TRANSITION_EVENTS[name], data,
+                       actor_type=actor_type, actor_user_id=user_id)
+
+
+# --- named helpers for the common calls ---
+
+def assign(ride_id, driver_id, notify=None):
+    """First driver to accept wins: open status and no driver yet."""
+    return transition(ride_id, 'assign', driver_id=driver_id, only_unassigned=True, notify=notify)
+
+
+def cancel_by_rider(ride_id, user_id, reason=None, notify=None):
+    fields = {'cancellation_reason': reason} if reason else {}
+    return transition(ride_id, 'cancel', user_id=user_id, notify=notify, **fields)
@@ -11,4 +11,7 @@ websocket_urlpatterns = [
 
     # rider tracking socket: the find_driver.html connects here for a particular ride
     re_path(r'ws/ride/(?P<ride_id>\d+)/$', consumers.RideConsumer.as_asgi()),
+
+    # rider map socket: add/move/remove deltas for drivers inside a viewport (replaces api/nearby/ polling)
+    re_path(r'ws/nearby/$', consumers.NearbyConsumer.as_asgi()),
 ]
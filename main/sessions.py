@@ -0,0 +1,164 @@
+"""
+Session engine (SESSION_ENGINE = 'main.sessions'): tiered, cached DB sessions.
+
+Reads go L1 (per-process dict, a few seconds) -> shared cache (Redis when
+configured, SESSION_CACHE_ALIAS) -> database, filling the tiers on the way
+back. So a view reading request.session['user_id'] normally costs no query.
+
+Writes to an existing session update L1 and the shared cache right away. The
+database copy is written behind (main.writebehind), with repeated saves of
+the same session coalesced into one UPDATE per flush. New sessions,
+cycle_key() and deletes still hit the database synchronously. A write-behind
+UPDATE never recreates a row that was deleted in between.
+
+Every deleted session (logout, flush(), cycle_key()) is also dropped from the
+websocket handshake cache (main.ws_auth).
+
+Settings:
+  SESSION_L1_TTL_S          seconds a session stays in the per-process tier (default 2);
+                            this is also how stale another worker's write can look here
+  SESSION_L1_SIZE           sessions kept per process (default 10000)
+  SESSION_WRITE_BEHIND      coalesce DB writes (default: on when the cache is shared, i.e.
+                            not LocMemCache, otherwise other workers could read old rows)
+  SESSION_FLUSH_MS          write-behind flush interval (default 1000)
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.contrib.sessions.models import Session
+
+from .writebehind import WriteBehindBuffer
+from .ws_auth import forget_session
+
+logger = logging.getLogger(__name__)
+
+L1_TTL_S = float(getattr(settings, 'SESSION_L1_TTL_S', 2.0))
+L1_SIZE = int(getattr(settings, 'SESSION_L1_SIZE', 10000))
+_shared_cache = 'locmem' not in settings.CACHES.get(
+    getattr(settings, 'SESSION_CACHE_ALIAS', 'default'), {}).get('BACKEND', '').lower()
+WRITE_BEHIND = getattr(settings, 'SESSION_WRITE_BEHIND', _shared_cache)
+
+# session_key -> (expires_at monotonic, data)
+_l1 = OrderedDict()
+_l1_lock = threading.Lock()
+
+
+def _l1_get(session_key):
+    with _l1_lock:
+        entry = _l1.get(session_key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del _l1[session_key]
+            return None
+        _l1.move_to_end(session_key)
+        # callers mutate the session dict; hand out a copy
+        return dict(entry[1])
+
+
+def _l1_set(session_key, data):
+    with _l1_lock:
+        _l1[session_key] = (time.monotonic() + L1_TTL_S, dict(data))
+        _l1.move_to_end(session_key)
+        while len(_l1) > L1_SIZE:
+            _l1.popitem(last=False)
+
+
+def _l1_drop(session_key):
+    with _l1_lock:
+        _l1.pop(session_key, None)
+
+
+def write_sessions(rows):
+    """Flush (session_key, session_data, expire_date) rows; the last save of each key wins."""
+    latest = {}
+    for session_key, session_data, expire_date in rows:
+        latest[session_key] = (session_data, expire_date)
+    # UPDATE only: a session deleted since it was queued stays deleted
+    Session.objects.bulk_update(
+        [Session(session_key=k, session_data=d, expire_date=e) for k, (d, e) in latest.items()],
+        ['session_data', 'expire_date'],
+    )
+
+
+session_writer = WriteBehindBuffer(
+    'sessions',
+    write_sessions,
+    max_rows=500,
+    max_delay_ms=int(getattr(settings, 'SESSION_FLUSH_MS', 1000)),
+    max_buffer=50000,
+)
+
+
+class SessionStore(CachedDBStore):
+    cache_key_prefix = 'main.sessions:'
+
+    # --- reads ---
+    def load(self):
+        data = _l1_get(self.session_key) if self.session_key else None
+        if data is None:
+            data = super().load()
+            if self.session_key:
+                _l1_set(self.session_key, data)
+        return data
+
+    async def aload(self):
+        data = _l1_get(self.session_key) if self.session_key else None
+        if data is None:
+            data = await super().aload()
+            if self.session_key:
+                _l1_set(self.session_key, data)
+        return data
+
+    # --- writes ---
+    def _behind(self, must_create):
+        return WRITE_BEHIND and not must_create and self.session_key is not None
+
+    def save(self, must_create=False):
+        if self._behind(must_create):
+            data = self._get_session()
+            try:
+                self._cache.set(self.cache_key, data, self.get_expiry_age())
+            except Exception:
+                # no shared copy: the DB has to be current
+                logger.exception("Error saving to cache (%s)", self._cache)
+            else:
+                _l1_set(self.session_key, data)
+                if session_writer.add((self.session_key, self.encode(data), self.get_expiry_date())):
+                    return
+        super().save(must_create)
+        if self.session_key:
+            _l1_set(self.session_key, self._get_session())
+
+    async def asave(self, must_create=False):
+        if self._behind(must_create):
+            data = await self._aget_session()
+            try:
+                await self._cache.aset(await self.acache_key(), data, await self.aget_expiry_age())
+            except Exception:
+                logger.exception("Error saving to cache (%s)", self._cache)
+            else:
+                _l1_set(self.session_key, data)
+                if session_writer.add((self.session_key, self.encode(data), await self.aget_expiry_date())):
+                    return
+        await super().asave(must_create)
+        if self.session_key:
+            _l1_set(self.session_key, await self._aget_session())
+
+    def delete(self, session_key=None):
+        session_key = session_key or self.session_key
+        if session_key:
+            _l1_drop(session_key)
+            forget_session(session_key)
+        super().delete(session_key)
+
+    async def adelete(self, session_key=None):
+        session_key = session_key or self.session_key
+        if session_key:
+            _l1_drop(session_key)
+            forget_session(session_key)
+        await super().adelete(session_key)
@@ -0,0 +1,27 @@
+"""Cache invalidation and in-memory index hooks for the main app (connected in MainConfig.ready)."""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import api_keys, surge
+from .models import DriverAPIKey, Ride
+
+
+@receiver(post_save, sender=DriverAPIKey)
+@receiver(post_delete, sender=DriverAPIKey)
+def driver_api_key_changed(sender, instance, **kwargs):
+    # revoked / expires_at / key_hash edits must not outlive the verification cache;
+    # after commit, so a concurrent verify() cannot cache the old row again
+    key_hash = instance.key_hash
+    transaction.on_commit(lambda: api_keys.forget(key_hash))
+
+
+@receiver(post_save, sender=Ride)
+def ride_saved(sender, instance, **kwargs):
+    # open-request counts for surge pricing, after commit (other workers pick it up via updated_at)
+    surge.feed_on_commit(instance)
+
+
+@receiver(post_delete, sender=Ride)
+def ride_deleted(sender, instance, **kwargs):
+    surge.feed_on_commit(instance, deleted=True)
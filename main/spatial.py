@@ -0,0 +1,305 @@
+"""
+In-memory spatial grid of online drivers (one per worker process).
+
+The grid maps a fixed-size lat/lng cell -> set of driver ids, plus the last
+known position of every online driver. It is fed by the same updates that hit
+api_driver_live_update, loaded from DriverLive on first use and kept in sync
+with rows written by other workers by an incremental resync on last_seen.
+
+Views use driver_index.within() / driver_index.nearest() instead of scanning
+DriverLive with a bounding box on every request.
+"""
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from datetime import timedelta
+from math import radians, cos, sin, asin, sqrt, floor
+
+from django.conf import settings
+from django.utils import timezone
+
+from .geometry import haversine_m_batch, top_n
+
+M_PER_DEG_LAT = 111320.0  # 1 deg lat ≈ 111320 meters
+EARTH_RADIUS_M = 6371000
+
+# ~1.1 km cells; small enough to keep per-cell scans short in dense cities
+CELL_DEG = float(getattr(settings, 'DRIVER_GRID_CELL_DEG', 0.01))
+# how often (seconds) a worker pulls DriverLive rows written by other workers
+RESYNC_S = float(getattr(settings, 'DRIVER_INDEX_RESYNC_S', 5.0))
+# set False to answer every query from DriverLive.cell instead of the in-memory grid
+INDEX_ENABLED = getattr(settings, 'DRIVER_INDEX_ENABLED', True)
+# ~5.5 km cells for the DriverLive.cell column: a 10 km search is ~25 equality lookups.
+# Changing this needs DriverLive.cell re-backfilled (see migration 0002).
+DB_CELL_DEG = float(getattr(settings, 'DRIVER_CELL_DEG', 0.05))
+# cells riders subscribe to for live nearby deltas (channel group per cell, see NearbyConsumer)
+VIEWPORT_CELL_DEG = float(getattr(settings, 'NEARBY_CELL_DEG', 0.05))
+# most cells cells_covering() will enumerate; DriverGrid walks its occupied cells for wider searches
+MAX_COVER_CELLS = int(getattr(settings, 'DRIVER_GRID_MAX_COVER_CELLS', 10000))
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Return distance in meters between two (lat,lng)."""
+    # convert decimal degrees to radians
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a))
+    return EARTH_RADIUS_M * c
+
+
+def cell_of(lat, lng, cell_deg=CELL_DEG):
+    """Return the (row, col) grid cell containing (lat, lng)."""
+    return int(floor(lat / cell_deg)), int(floor(lng / cell_deg))
+
+
+def cell_span(lat, lng, radius_m, cell_deg=CELL_DEG):
+    """
+    Return (rows, cols) of the grid cells intersecting the bbox of a circle
+    around (lat, lng). Rows are clipped to the poles; columns wrap across the
+    antimeridian, and a bbox wider than the globe yields every column once.
+    """
+    south, west, north, east = bbox_around(lat, lng, radius_m)
+    r0, c0 = cell_of(max(south, -90.0), west, cell_deg)
+    r1, c1 = cell_of(min(north, 90.0), east, cell_deg)
+    n = int(round(360.0 / cell_deg))
+    if c1 - c0 + 1 >= n:
+        return range(r0, r1 + 1), range(-(n // 2), n - n // 2)
+    return range(r0, r1 + 1), [(c + n // 2) % n - n // 2 for c in range(c0, c1 + 1)]
+
+
+def cells_covering(lat, lng, radius_m, cell_deg=CELL_DEG):
+    """
+    Iterate every grid cell that intersects the bbox of a circle around (lat, lng).
+    ValueError when that is more than MAX_COVER_CELLS cells.
+    """
+    rows, cols = cell_span(lat, lng, radius_m, cell_deg)
+    if len(rows) * len(cols) > MAX_COVER_CELLS:
+        raise ValueError(f'search area spans {len(rows) * len(cols)} cells (max {MAX_COVER_CELLS})')
+    return ((r, c) for r in rows for c in cols)
+
+
+def cell_key(lat, lng, cell_deg=DB_CELL_DEG):
+    """Return the DriverLive.cell key ("row:col") for (lat, lng), or None without coords."""
+    if lat is None or lng is None:
+        return None
+    r, c = cell_of(float(lat), float(lng), cell_deg)
+    return f'{r}:{c}'
+
+
+def cell_keys_covering(lat, lng, radius_m, cell_deg=DB_CELL_DEG):
+    return [f'{r}:{c}' for r, c in cells_covering(lat, lng, radius_m, cell_deg)]
+
+
+def cell_group(lat, lng, cell_deg=VIEWPORT_CELL_DEG):
+    """Channel-layer group that carries driver moves for the viewport cell containing (lat, lng)."""
+    r, c = cell_of(float(lat), float(lng), cell_deg)
+    return f'cell_{r}_{c}'
+
+
+def cell_count_in_bbox(south, west, north, east, cell_deg=VIEWPORT_CELL_DEG):
+    """Number of viewport cells cell_groups_in_bbox() would return, without building them."""
+    r0, c0 = cell_of(south, west, cell_deg)
+    r1, c1 = cell_of(north, east, cell_deg)
+    return (r1 - r0 + 1) * (c1 - c0 + 1)
+
+
+def cell_groups_in_bbox(south, west, north, east, cell_deg=VIEWPORT_CELL_DEG):
+    """Return the viewport cell groups intersecting a lat/lng bounding box (check cell_count_in_bbox first)."""
+    r0, c0 = cell_of(south, west, cell_deg)
+    r1, c1 = cell_of(north, east, cell_deg)
+    return [f'cell_{r}_{c}' for r in range(r0, r1 + 1) for c in range(c0, c1 + 1)]
+
+
+def bbox_around(lat, lng, radius_m):
+    """Return (south, west, north, east) of the bbox of a circle around (lat, lng)."""
+    deg_lat = radius_m / M_PER_DEG_LAT
+    # longitude degrees scale by cos(latitude)
+    deg_lng = radius_m / (M_PER_DEG_LAT * max(0.000001, abs(cos(radians(lat)))))
+    return lat - deg_lat, lng - deg_lng, lat + deg_lat, lng + deg_lng
+
+
+def db_within(lat, lng, radius_m, limit=None):
+    """
+    Same contract as DriverGrid.within() but answered from the database:
+    equality lookups on the (is_online, cell) index over the neighbouring cells.
+    """
+    from .models import DriverLive
+
+    rows = list(DriverLive.objects.filter(
+        is_online=True, cell__in=cell_keys_covering(lat, lng, radius_m),
+    ).values_list('driver_id', 'latitude', 'longitude'))
+    if not rows:
+        return []
+    lats = [float(r[1]) for r in rows]
+    lngs = [float(r[2]) for r in rows]
+    distance_m = haversine_m_batch(lat, lng, lats, lngs)
+    return [
+        (float(distance_m[i]), rows[i][0], lats[i], lngs[i])
+        for i in top_n(distance_m, limit) if distance_m[i] <= radius_m
+    ]
+
+
+class DriverGrid:
+    """
+    Thread-safe grid index: cell -> driver ids, driver id -> (lat, lng, cell).
+    Only online drivers with coordinates are kept.
+    """
+
+    def __init__(self, cell_deg=CELL_DEG, resync_s=RESYNC_S, enabled=INDEX_ENABLED):
+        self.cell_deg = cell_deg
+        self.resync_s = resync_s
+        self.enabled = enabled
+        self._lock = threading.RLock()
+        self._cells = {}
+        self._pos = {}
+        self._loaded = False
+        self._synced_at = None      # DB time of the last (re)sync
+        self._checked_at = 0.0      # monotonic time of the last resync attempt
+
+    def __len__(self):
+        return len(self._pos)
+
+    # --- writes ---
+    def upsert(self, driver_id, lat, lng):
+        cell = cell_of(lat, lng, self.cell_deg)
+        with self._lock:
+            prev = self._pos.get(driver_id)
+            if prev and prev[2] != cell:
+                self._discard(driver_id, prev[2])
+            self._pos[driver_id] = (lat, lng, cell)
+            self._cells.setdefault(cell, set()).add(driver_id)
+
+    def remove(self, driver_id):
+        with self._lock:
+            prev = self._pos.pop(driver_id, None)
+            if prev:
+                self._discard(driver_id, prev[2])
+
+    def apply(self, driver_id, lat, lng, is_online):
+        """Apply one live update (same shape as the api_driver_live_update payload)."""
+        if not is_online:
+            self.remove(driver_id)
+        elif lat is not None and lng is not None:
+            self.upsert(driver_id, float(lat), float(lng))
+
+    def _discard(self, driver_id, cell):
+        ids = self._cells.get(cell)
+        if ids is not None:
+            ids.discard(driver_id)
+            if not ids:
+                del self._cells[cell]
+
+    # --- loading ---
+    def load(self):
+        """(Re)build the grid from DriverLive."""
+        from .models import DriverLive
+
+        now = timezone.now()
+        rows = DriverLive.objects.filter(is_online=True, cell__isnull=False).values_list(
+            'driver_id', 'latitude', 'longitude')
+        cells, pos = {}, {}
+        for driver_id, lat, lng in rows.iterator():
+            lat, lng = float(lat), float(lng)
+            cell = cell_of(lat, lng, self.cell_deg)
+            pos[driver_id] = (lat, lng, cell)
+            cells.setdefault(cell, set()).add(driver_id)
+        with self._lock:
+            self._cells, self._pos = cells, pos
+            self._loaded = True
+            self._synced_at = now
+            self._checked_at = time.monotonic()
+
+    def resync(self):
+        """Pull DriverLive rows touched since the last sync (uses the -last_seen index)."""
+        from .models import DriverLive
+
+        now = timezone.now()
+        # small overlap so rows committed while we were reading are not missed
+        since = self._synced_at - timedelta(seconds=1)
+        rows = DriverLive.objects.filter(last_seen__gte=since).values_list(
+            'driver_id', 'latitude', 'longitude', 'is_online')
+        for driver_id, lat, lng, is_online in rows.iterator():
+            self.apply(driver_id, lat, lng, is_online)
+        self._synced_at = now
+
+    def _is_fresh(self):
+        return self._loaded and time.monotonic() - self._checked_at < self.resync_s
+
+    def ensure_fresh(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+            return
+        if time.monotonic() - self._checked_at < self.resync_s:
+            return
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.resync_s:
+                return
+            self._checked_at = time.monotonic()
+            self.resync()
+
+    # --- queries ---
+    def position(self, driver_id):
+        """(lat, lng) of an online driver as last seen by this worker, else None."""
+        pos = self._pos.get(driver_id)
+        return (pos[0], pos[1]) if pos else None
+
+    def count(self, cells):
+        """Online drivers in the given grid cells (in-memory, no resync)."""
+        return sum(len(self._cells.get(cell, ())) for cell in cells)
+
+    def within(self, lat, lng, radius_m, limit=None):
+        """
+        Return [(distance_m, driver_id, lat, lng), ...] for online drivers within
+        radius_m of (lat, lng), nearest first, trimmed to limit.
+        """
+        if not self.enabled:
+            return db_within(lat, lng, radius_m, limit)
+        self.ensure_fresh()
+        return self._within(lat, lng, radius_m, limit)
+
+    def _within(self, lat, lng, radius_m, limit=None):
+        rows, cols = cell_span(lat, lng, radius_m, self.cell_deg)
+        with self._lock:
+            if len(rows) * len(cols) <= len(self._cells):
+                cells = ((r, c) for r in rows for c in cols)
+            else:
+                # search area larger than the occupied grid: walk the occupied cells instead
+                cols = set(cols)
+                cells = [cell for cell in self._cells if cell[0] in rows and cell[1] in cols]
+            ids = [driver_id for cell in cells for driver_id in self._cells.get(cell, ())]
+            lats = [self._pos[driver_id][0] for driver_id in ids]
+            lngs = [self._pos[driver_id][1] for driver_id in ids]
+        if not ids:
+            return []
+        distance_m = haversine_m_batch(lat, lng, lats, lngs)
+        order = top_n(distance_m, limit)
+        return [
+            (float(distance_m[i]), ids[i], lats[i], lngs[i])
+            for i in order if distance_m[i] <= radius_m
+        ]
+
+    async def awithin(self, lat, lng, radius_m, limit=None):
+        """within() for async views: only hops to a thread when a DB (re)sync is due."""
+        if not self.enabled:
+            return await sync_to_async(db_within)(lat, lng, radius_m, limit)
+        if not self._is_fresh():
+            await sync_to_async(self.ensure_fresh)()
+        return self._within(lat, lng, radius_m, limit)
+
+    def nearest(self, lat, lng, k, max_radius_m):
+        """Return the k nearest online drivers within max_radius_m (same shape as within())."""
+        radius_m = self.cell_deg * M_PER_DEG_LAT
+        while True:
+            radius_m = min(radius_m, max_radius_m)
+            hits = self.within(lat, lng, radius_m, limit=k)
+            if len(hits) >= k or radius_m >= max_radius_m:
+                return hits
+            radius_m *= 2
+
+
+driver_index = DriverGrid()
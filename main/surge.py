@@ -0,0 +1,230 @@
+"""
+In-memory demand/supply grid for surge pricing (one per worker process).
+
+Demand is the number of open rides (status requested / matching) picked up
+in a cell during the last SURGE_WINDOW_S seconds. It is kept incrementally:
+- this worker's changes are fed by feed_on_commit(), once the transaction
+  that wrote them commits (a rolled-back booking never counts): from the
+  Ride post_save / post_delete receivers in main.signals for inserts and
+  deletes, and from main.rides for transitions (an UPDATE, no post_save)
+- a background thread pulls rides other workers changed since its last pass
+  (updated_at index) and expires entries that fall out of the window
+Tables are never re-scanned.
+
+Supply is the online driver count from driver_index (main.spatial), which
+location updates already keep current.
+
+multiplier(lat, lng) sums both over the pickup cell and its neighbours: a
+handful of dict lookups and no query, so the estimate / booking path can
+call it freely. Until the first background load has finished every
+multiplier is 1.
+
+Multipliers are integers in thousandths (1000 = no surge) so main.pricing
+stays in integer paise.
+
+Settings:
+  SURGE_ENABLED         set False to always price at 1x (default True)
+  SURGE_WINDOW_S        how long an open request counts as demand (default 900)
+  SURGE_NEIGHBOURS      cells around the pickup cell that are summed (default 1 -> 3x3)
+  SURGE_THRESHOLD       demand/supply ratio where surge starts (default 1.0)
+  SURGE_SLOPE           multiplier added per unit of ratio above the threshold (default 0.5)
+  SURGE_MAX             cap on the multiplier (default 2.0)
+  SURGE_RESYNC_S        background pass interval (default 5)
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .spatial import cell_of, driver_index
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'SURGE_ENABLED', True)
+WINDOW_S = float(getattr(settings, 'SURGE_WINDOW_S', 900))
+NEIGHBOURS = int(getattr(settings, 'SURGE_NEIGHBOURS', 1))
+THRESHOLD = float(getattr(settings, 'SURGE_THRESHOLD', 1.0))
+SLOPE = float(getattr(settings, 'SURGE_SLOPE', 0.5))
+MAX_MILLI = int(round(float(getattr(settings, 'SURGE_MAX', 2.0)) * 1000))
+RESYNC_S = float(getattr(settings, 'SURGE_RESYNC_S', 5.0))
+
+OPEN_STATUSES = ('requested', 'matching')
+NO_SURGE = 1000
+
+
+def surge_milli(demand, supply):
+    """Multiplier (thousandths, 50-step) for a demand/supply pair."""
+    ratio = demand / max(supply, 1)
+    if ratio <= THRESHOLD:
+        return NO_SURGE
+    milli = NO_SURGE + (ratio - THRESHOLD) * SLOPE * 1000
+    # 0.05 steps keep quotes from jittering with every request
+    return min(MAX_MILLI, int(round(milli / 50.0)) * 50)
+
+
+class SurgeGrid:
+    """
+    Thread-safe open-request counts per driver_index cell over a sliding window.
+    """
+
+    def __init__(self, window_s=WINDOW_S, resync_s=RESYNC_S, enabled=ENABLED):
+        self.window_s = window_s
+        self.resync_s = resync_s
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._open = {}            # ride id -> (cell, requested epoch seconds)
+        self._demand = {}          # cell -> open request count
+        self._expiry = deque()     # (requested epoch, ride id), oldest first
+        self._loaded = False
+        self._synced_at = None     # DB time of the last pass
+        self._thread = None
+        self._pid = None
+
+    # --- writes ---
+    def ride_changed(self, ride_id, status, lat, lng, requested_at):
+        """Apply one Ride save (also used for rows pulled by the resync)."""
+        if status not in OPEN_STATUSES or lat is None or lng is None or requested_at is None:
+            self.ride_closed(ride_id)
+            return
+        ts = requested_at.timestamp()
+        if ts < time.time() - self.window_s:
+            self.ride_closed(ride_id)
+            return
+        cell = cell_of(float(lat), float(lng), driver_index.cell_deg)
+        with self._lock:
+            prev = self._open.get(ride_id)
+            if prev == (cell, ts):
+                return
+            if prev:
+                self._dec(prev[0])
+            if not prev or prev[1] != ts:
+                self._expiry.append((ts, ride_id))
+            self._open[ride_id] = (cell, ts)
+            self._demand[cell] = self._demand.get(cell, 0) + 1
+
+    def ride_closed(self, ride_id):
+        with self._lock:
+            prev = self._open.pop(ride_id, None)
+            if prev:
+                self._dec(prev[0])
+
+    def _dec(self, cell):
+        n = self._demand.get(cell, 0) - 1
+        if n > 0:
+            self._demand[cell] = n
+        else:
+            self._demand.pop(cell, None)
+
+    def expire(self):
+        """Drop requests older than the window (amortized O(1) per request)."""
+        cutoff = time.time() - self.window_s
+        with self._lock:
+            while self._expiry and self._expiry[0][0] < cutoff:
+                ts, ride_id = self._expiry.popleft()
+                entry = self._open.get(ride_id)
+                if entry and entry[1] == ts:
+                    del self._open[ride_id]
+                    self._dec(entry[0])
+            # a ride re-requested later gets a second deque entry; keep the deque bounded
+            if len(self._expiry) > 4 * len(self._open) + 1024:
+                live = sorted((ts, rid) for rid, (_cell, ts) in self._open.items())
+                self._expiry = deque(live)
+
+    # --- background sync ---
+    def load(self):
+        from .models import Ride
+
+        now = timezone.now()
+        rows = Ride.objects.filter(
+            status__in=OPEN_STATUSES, created_at__gte=now - timedelta(seconds=self.window_s),
+        ).values_list('id', 'status', 'pickup_lat', 'pickup_lng', 'requested_at')
+        for row in rows.iterator():
+            self.ride_changed(*row)
+        self._loaded = True
+        self._synced_at = now
+
+    def resync(self):
+        """Apply rides saved by any worker since the last pass (uses the updated_at index)."""
+        from .models import Ride
+
+        now = timezone.now()
+        since = self._synced_at - timedelta(seconds=1)  # overlap for rows committed mid-read
+        rows = Ride.objects.filter(updated_at__gte=since).values_list(
+            'id', 'status', 'pickup_lat', 'pickup_lng', 'requested_at')
+        for row in rows.iterator():
+            self.ride_changed(*row)
+        self._synced_at = now
+
+    def _run(self):
+        while True:
+            close_old_connections()
+            try:
+                if not self._loaded:
+                    self.load()
+                else:
+                    self.resync()
+                self.expire()
+                # supply side: keep the driver grid current even if no view queried it lately
+                if driver_index.enabled:
+                    driver_index.ensure_fresh()
+            except Exception:
+                logger.exception("surge grid sync failed")
+            finally:
+                close_old_connections()
+            time.sleep(self.resync_s)
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                # forked worker: the parent's state and thread did not come along
+                self._open, self._demand, self._expiry = {}, {}, deque()
+                self._loaded = False
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='surge-grid', daemon=True)
+            self._thread.start()
+
+    # --- reads ---
+    def _cells_around(self, lat, lng):
+        row, col = cell_of(lat, lng, driver_index.cell_deg)
+        return [(row + dr, col + dc)
+                for dr in range(-NEIGHBOURS, NEIGHBOURS + 1)
+                for dc in range(-NEIGHBOURS, NEIGHBOURS + 1)]
+
+    def counts(self, lat, lng):
+        """(open requests, online drivers) around (lat, lng)."""
+        cells = self._cells_around(lat, lng)
+        demand = sum(self._demand.get(cell, 0) for cell in cells)
+        return demand, driver_index.count(cells)
+
+    def multiplier(self, lat, lng):
+        """Surge multiplier in thousandths for a pickup at (lat, lng); 1000 = none."""
+        if not self.enabled:
+            return NO_SURGE
+        self._ensure_thread()
+        if not self._loaded:
+            return NO_SURGE
+        return surge_milli(*self.counts(lat, lng))
+
+
+surge_grid = SurgeGrid()
+
+
+def feed_on_commit(ride, deleted=False):
+    """Apply a Ride write to this worker's surge_grid once the current transaction commits."""
+    ride_id = ride.id
+    if deleted:
+        transaction.on_commit(lambda: surge_grid.ride_closed(ride_id))
+        return
+    status, lat, lng, requested_at = ride.status, ride.pickup_lat, ride.pickup_lng, ride.requested_at
+    transaction.on_commit(lambda: surge_grid.ride_changed(ride_id, status, lat, lng, requested_at))
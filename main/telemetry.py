@@ -0,0 +1,63 @@
+"""
+Buffered DriverLocation telemetry.
+
+record_fix() is called on every driver fix and only appends to memory; the
+write-behind thread inserts batches with COPY on Postgres (psycopg2) or
+bulk_create everywhere else.
+
+Settings:
+  TELEMETRY_FLUSH_ROWS   flush once this many fixes are buffered (default 500)
+  TELEMETRY_FLUSH_MS     ...or after this many milliseconds (default 1000)
+  TELEMETRY_MAX_BUFFER   fixes kept in memory before new ones are dropped (default 50000)
+"""
+import csv
+import io
+
+from django.conf import settings
+from django.db import connection
+
+from .models import DriverLocation
+from .writebehind import WriteBehindBuffer
+
+COPY_COLUMNS = ('driver_id', 'latitude', 'longitude', 'speed', 'heading', 'recorded_at')
+
+
+def _copy_rows(cursor, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        # empty unquoted CSV fields load as NULL
+        writer.writerow(['' if v is None else v for v in row])
+    buf.seek(0)
+    cursor.copy_expert(
+        f"COPY {DriverLocation._meta.db_table} ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        buf,
+    )
+
+
+def write_locations(rows):
+    """Insert a batch of (driver_id, lat, lng, speed, heading, recorded_at) tuples."""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            if hasattr(cursor.cursor, 'copy_expert'):  # psycopg2
+                _copy_rows(cursor, rows)
+                return
+    DriverLocation.objects.bulk_create([
+        DriverLocation(driver_id=driver_id, latitude=lat, longitude=lng,
+                       speed=speed, heading=heading, recorded_at=recorded_at)
+        for driver_id, lat, lng, speed, heading, recorded_at in rows
+    ])
+
+
+location_writer = WriteBehindBuffer(
+    'driver_locations',
+    write_locations,
+    max_rows=int(getattr(settings, 'TELEMETRY_FLUSH_ROWS', 500)),
+    max_delay_ms=int(getattr(settings, 'TELEMETRY_FLUSH_MS', 1000)),
+    max_buffer=int(getattr(settings, 'TELEMETRY_MAX_BUFFER', 50000)),
+)
+
+
+def record_fix(driver_id, lat, lng, recorded_at, speed=None, heading=None):
+    """Queue one DriverLocation row. Returns False if it was dropped (buffer full)."""
+    return location_writer.add((driver_id, lat, lng, speed, heading, recorded_at))
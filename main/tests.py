@@ -1,3 +1,1289 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.http import JsonResponse
+from django.test import AsyncClient, Client, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from verify.models import Drivers, Users
+
+from . import (api_keys, consumers, dispatch, geometry, idempotency, live, outbox, pricing, retention, ride_cache,
+               ride_events, rides, sessions, spatial, surge, telemetry, ws_auth)
+from .models import DriverAPIKey, DriverLive, DriverLocation, IdempotencyKey, OutboxMessage, Ride
+from .sessions import SessionStore as TieredSessionStore
+from .writebehind import WriteBehindBuffer
+
+
+def make_user(n, user_type='user'):
+    return Users.objects.create(name=f'U{n}', email=f'u{n}@example.com', phone_number=f'9{n:09d}',
+                                user_type=user_type)
+
+
+def make_driver(n):
+    user = make_user(1000 + n, user_type='driver')
+    return Drivers.objects.create(user=user, full_name=f'Driver {n}', gender='male', dob='1990-01-01',
+                                  address='x', experience=3, emergency_contact='1', status='approved')
+
+
+def make_ride(user, status='matching', **fields):
+    return Ride.objects.create(user=user, pickup_address='x', pickup_lat=12.9, pickup_lng=77.6,
+                               status=status, **fields)
+
+
+# keep ride transitions free of background writers (RideEvent buffer, outbox thread)
+quiet = mock.patch.multiple('main.rides', ride_events=mock.DEFAULT)
+
+
+@quiet
+class RideTransitionTests(TestCase):
+    def setUp(self):
+        self.rider = make_user(1)
+        self.drivers = [make_driver(i) for i in range(2)]
+
+    def test_assign_wins_once(self, **_):
+        ride = make_ride(self.rider)
+        first = rides.assign(ride.id, self.drivers[0].id)
+        second = rides.assign(ride.id, self.drivers[1].id)
+        self.assertTrue(first.won)
+        self.assertEqual(first.ride.status, 'assigned')
+        self.assertEqual(first.ride.driver_id, self.drivers[0].id)
+        self.assertIsNotNone(first.ride.assigned_at)
+        # the loser gets the ride as it is now, so it can say why
+        self.assertFalse(second.won)
+        self.assertEqual(second.ride.driver_id, self.drivers[0].id)
+
+    def test_missing_ride(self, **_):
+        outcome = rides.assign(999999, self.drivers[0].id)
+        self.assertEqual(outcome, rides.Outcome(False, None))
+
+    def test_wrong_status(self, **_):
+        ride = make_ride(self.rider, status='completed')
+        outcome = rides.cancel_by_rider(ride.id, self.rider.id)
+        self.assertFalse(outcome.won)
+        self.assertEqual(outcome.ride.status, 'completed')
+
+    def test_cancel_checks_owner(self, **_):
+        ride = make_ride(self.rider)
+        other = make_user(2)
+        self.assertIsNone(rides.cancel_by_rider(ride.id, other.id).ride)
+        outcome = rides.cancel_by_rider(ride.id, self.rider.id, reason='changed plans')
+        self.assertTrue(outcome.won)
+        self.assertEqual(outcome.ride.cancellation_reason, 'changed plans')
+
+    def test_unknown_transition(self, **_):
+        with self.assertRaises(rides.InvalidTransition):
+            rides.transition(1, 'teleport')
+
+
+@quiet
+class ConcurrentAssignTests(TransactionTestCase):
+    def test_single_winner(self, **_):
+        rider = make_user(1)
+        drivers = [make_driver(i) for i in range(8)]
+        ride = make_ride(rider)
+        results = {}
+        barrier = threading.Barrier(len(drivers))
+
+        def accept(driver):
+            try:
+                barrier.wait()
+                while True:
+                    try:
+                        results[driver.id] = rides.assign(ride.id, driver.id).won
+                        return
+                    except OperationalError as e:
+                        # sqlite's shared-cache test database locks whole tables; nothing was written
+                        if connection.vendor != 'sqlite' or 'locked' not in str(e):
+                            raise
+                        time.sleep(0.01)
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=accept, args=(d,)) for d in drivers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        winners = [driver_id for driver_id, won in results.items() if won]
+        self.assertEqual(len(results), len(drivers))
+        self.assertEqual(len(winners), 1)
+        ride.refresh_from_db()
+        self.assertEqual(ride.driver_id, winners[0])
+        self.assertEqual(ride.status, 'assigned')
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.calls = 0
+
+    def post(self, body='{"a": 1}', key='key-1', user_id=7):
+        headers = {'Idempotency-Key': key} if key else {}
+        request = self.factory.post('/book/', body, content_type='application/json', headers=headers)
+        request.session = SessionStore()
+        request.session['user_id'] = user_id
+        return request
+
+    def view(self, status=200):
+        @idempotency.idempotent('book')
+        def book(request):
+            self.calls += 1
+            return JsonResponse({'ride_id': self.calls}, status=status)
+        return book
+
+    def test_replay(self):
+        view = self.view()
+        first = view(self.post())
+        second = view(self.post())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+
+    def test_replay_from_table_when_cache_is_cold(self):
+        view = self.view()
+        first = view(self.post())
+        cache.clear()
+        second = view(self.post())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.content, first.content)
+
+    def test_keys_are_per_user_and_without_header_nothing_changes(self):
+        view = self.view()
+        view(self.post(user_id=7))
+        view(self.post(user_id=8))
+        view(self.post(key=None))
+        view(self.post(key=None))
+        self.assertEqual(self.calls, 4)
+
+    def test_conflict_while_in_flight(self):
+        inner = {}
+
+        @idempotency.idempotent('book')
+        def book(request):
+            self.calls += 1
+            if self.calls == 1:
+                inner['response'] = book(self.post())  # the client retries before we answered
+            return JsonResponse({'ok': True})
+
+        book(self.post())
+        self.assertEqual(inner['response'].status_code, 409)
+        self.assertEqual(self.calls, 1)
+
+    def test_different_body(self):
+        view = self.view()
+        view(self.post(body='{"a": 1}'))
+        cached = view(self.post(body='{"a": 2}'))
+        cache.clear()
+        stored = view(self.post(body='{"a": 2}'))
+        self.assertEqual((cached.status_code, stored.status_code), (422, 422))
+        self.assertEqual(self.calls, 1)
+
+    def test_server_error_releases_key(self):
+        self.view(status=503)(self.post())
+        self.assertFalse(IdempotencyKey.objects.exists())
+        response = self.view()(self.post())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.calls, 2)
+
+    def test_exception_releases_key(self):
+        @idempotency.idempotent('book')
+        def boom(request):
+            raise RuntimeError('db down')
+
+        with self.assertRaises(RuntimeError):
+            boom(self.post())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_async_view(self):
+        @idempotency.idempotent('book')
+        async def book(request):
+            self.calls += 1
+            return JsonResponse({'ride_id': self.calls})
+
+        first = async_to_sync(book)(self.post())
+        second = async_to_sync(book)(self.post())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.content, first.content)
+
+
+class FakeLayer:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.sent = []
+
+    async def group_send(self, group, event):
+        if group in self.failing:
+            raise ConnectionError('redis down')
+        self.sent.append((group, event))
+
+
+@mock.patch.object(outbox.dispatcher, 'ensure_thread')
+class OutboxTests(TestCase):
+    def drain(self, layer):
+        with mock.patch('channels.layers.get_channel_layer', return_value=layer):
+            return outbox.Dispatcher().drain()
+
+    def test_rows_are_written_with_the_transaction(self, _thread):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                outbox.enqueue([('ride_1', {'type': 'ride.cancelled', 'ride_id': 1})])
+                raise ValueError
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_dispatcher_is_woken_only_on_commit(self, _thread):
+        with mock.patch.object(outbox, 'IN_PROCESS', True), \
+                mock.patch.object(outbox.dispatcher, 'wake') as wake, \
+                self.captureOnCommitCallbacks(execute=True) as callbacks:
+            outbox.enqueue([('ride_1', {'type': 'ride.cancelled', 'ride_id': 1})])
+            wake.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        wake.assert_called_once()
+
+    def test_sent_rows_are_deleted(self, _thread):
+        outbox.enqueue([('ride_1', {'type': 'ride.cancelled', 'ride_id': 1}),
+                        ('driver_2', {'type': 'ride.cancelled', 'ride_id': 1})])
+        layer = FakeLayer()
+        self.assertEqual(self.drain(layer), 2)
+        self.assertEqual([g for g, _e in layer.sent], ['ride_1', 'driver_2'])
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_failures_back_off_then_give_up(self, _thread):
+        outbox.enqueue([('ride_1', {'type': 'ride.cancelled', 'ride_id': 1}),
+                        ('driver_2', {'type': 'ride.cancelled', 'ride_id': 1})])
+        layer = FakeLayer(failing={'ride_1'})
+        before = timezone.now()
+        self.assertEqual(self.drain(layer), 1)
+
+        row = OutboxMessage.objects.get()
+        self.assertEqual((row.group, row.attempts, row.failed_at), ('ride_1', 1, None))
+        self.assertIn('redis down', row.last_error)
+        self.assertGreaterEqual(row.available_at, before + timedelta(seconds=outbox.backoff_s(1)))
+        # not due yet: a second pass leaves it alone
+        self.assertEqual(self.drain(layer), 0)
+        self.assertEqual(OutboxMessage.objects.get().attempts, 1)
+
+        OutboxMessage.objects.update(attempts=outbox.MAX_ATTEMPTS - 1, available_at=timezone.now())
+        with self.assertLogs('main.outbox', 'ERROR'):
+            self.drain(layer)
+        row = OutboxMessage.objects.get()
+        self.assertIsNotNone(row.failed_at)
+        # kept for inspection, never claimed again
+        OutboxMessage.objects.update(available_at=timezone.now())
+        self.assertEqual(outbox.Dispatcher().claim(), [])
+
+    def test_a_failure_holds_back_the_rest_of_its_group(self, _thread):
+        outbox.enqueue([('ride_1', {'type': 'ride.assigned', 'ride_id': 1}),
+                        ('driver_2', {'type': 'ride.cancelled', 'ride_id': 1}),
+                        ('ride_1', {'type': 'ride.cancelled', 'ride_id': 1})])
+        layer = FakeLayer(failing={'ride_1'})
+        self.assertEqual(self.drain(layer), 1)
+        self.assertEqual(layer.sent, [('driver_2', {'type': 'ride.cancelled', 'ride_id': 1})])
+        first, second = OutboxMessage.objects.order_by('id')
+        self.assertEqual((first.attempts, second.attempts), (1, 0))  # the second was never tried
+
+        # the second is due, but not ahead of the first while that one backs off
+        layer.failing.clear()
+        self.assertEqual(self.drain(layer), 0)
+        # new messages to the group queue up behind it too
+        outbox.enqueue([('ride_1', {'type': 'ride.completed', 'ride_id': 1})])
+        self.assertEqual(self.drain(layer), 0)
+
+        OutboxMessage.objects.filter(pk=first.pk).update(available_at=timezone.now())
+        self.assertEqual(self.drain(layer), 3)
+        self.assertEqual([e['type'] for g, e in layer.sent if g == 'ride_1'],
+                         ['ride.assigned', 'ride.cancelled', 'ride.completed'])
+
+    def test_given_up_rows_do_not_block_their_group(self, _thread):
+        outbox.enqueue([('ride_1', {'type': 'ride.assigned', 'ride_id': 1}),
+                        ('ride_1', {'type': 'ride.cancelled', 'ride_id': 1})])
+        OutboxMessage.objects.filter(pk=OutboxMessage.objects.order_by('id')[0].pk).update(
+            failed_at=timezone.now(), available_at=timezone.now() + timedelta(hours=1))
+        layer = FakeLayer()
+        self.assertEqual(self.drain(layer), 1)
+        self.assertEqual(layer.sent, [('ride_1', {'type': 'ride.cancelled', 'ride_id': 1})])
+
+    def test_in_memory_layer_is_sent_on_the_server_loop(self, _thread):
+        from channels.layers import InMemoryChannelLayer
+
+        loop = asyncio.new_event_loop()
+        server = threading.Thread(target=loop.run_forever, daemon=True)
+        server.start()
+        self.addCleanup(loop.close)
+        self.addCleanup(server.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+
+        def on_server(coro):
+            return asyncio.run_coroutine_threadsafe(coro, loop).result(5)
+
+        layer = InMemoryChannelLayer()
+        on_server(layer.group_add('ride_1', 'client'))
+        dispatcher = outbox.Dispatcher()
+        dispatcher.attach_loop(loop)
+        outbox.enqueue([('ride_1', {'type': 'ride.cancelled', 'ride_id': 1})])
+        with mock.patch('channels.layers.get_channel_layer', return_value=layer):
+            self.assertEqual(dispatcher.drain(), 1)
+        self.assertIsNone(dispatcher._loop)  # no private loop was used
+        self.assertEqual(on_server(layer.receive('client')), {'type': 'ride.cancelled', 'ride_id': 1})
+
+    def test_claim_leases_rows(self, _thread):
+        outbox.enqueue([('ride_1', {'type': 'ride.cancelled', 'ride_id': 1})])
+        self.assertEqual(len(outbox.Dispatcher().claim()), 1)
+        self.assertEqual(outbox.Dispatcher().claim(), [])
+
+
+
+def hit(driver_id, d_m):
+    return (d_m, driver_id, 12.9, 77.6)
+
+
+@quiet
+@mock.patch.object(outbox.dispatcher, 'ensure_thread')
+@mock.patch('main.dispatch.ride_events')
+class DispatchWaveTests(TestCase):
+    def setUp(self):
+        self.rider = make_user(1)
+        self.ride = make_ride(self.rider, requested_at=timezone.now())
+        self.dispatcher = dispatch.Dispatcher(waves=[(5000, 2), (10000, 2), (20000, 2)], offer_timeout_s=25)
+        self.m = dispatch._Matching(self.ride.id, 12.9, 77.6, 'BLS', 150000, offered=[1])
+
+    def offers(self):
+        return [(row.group, row.payload['wave']) for row in OutboxMessage.objects.order_by('id')]
+
+    def test_wave_offers_only_new_drivers(self, _events, _thread, **_):
+        nearby = [hit(1, 100), hit(2, 900), hit(3, 4000), hit(4, 9000)]
+        with mock.patch.object(dispatch.driver_index, 'within', return_value=nearby) as within:
+            self.assertEqual(self.dispatcher._send_wave(self.m, 1), [2, 3])
+        # asks for enough drivers to still fill the wave after dropping the ones already offered
+        within.assert_called_once_with(12.9, 77.6, 10000, limit=3)
+        self.assertEqual(self.offers(), [('driver_2', 1), ('driver_3', 1)])
+        _events.record_many.assert_called_once()
+
+    def test_wave_claims_the_ride(self, _events, _thread, **_):
+        stale = timezone.now() - timedelta(hours=1)
+        Ride.objects.filter(pk=self.ride.pk).update(updated_at=stale)
+        with mock.patch.object(dispatch.driver_index, 'within', return_value=[]):
+            self.assertEqual(self.dispatcher._send_wave(self.m, 1), [])
+        self.assertGreater(Ride.objects.get(pk=self.ride.pk).updated_at, stale)
+
+    def test_wave_for_a_closed_ride(self, _events, _thread, **_):
+        rides.assign(self.ride.id, make_driver(1).id)
+        with mock.patch.object(dispatch.driver_index, 'within', return_value=[hit(2, 100)]):
+            self.assertIsNone(self.dispatcher._send_wave(self.m, 1))
+        self.assertEqual(self.offers(), [])
+
+    def test_fail(self, _events, _thread, **_):
+        self.assertTrue(dispatch.fail(self.ride.id))
+        ride = Ride.objects.get(pk=self.ride.pk)
+        self.assertEqual((ride.status, ride.cancellation_reason), ('cancelled', 'no driver accepted'))
+        self.assertEqual([(row.group, row.payload) for row in OutboxMessage.objects.all()],
+                         [(f'ride_{ride.id}', {'type': 'ride.matching_failed', 'ride_id': ride.id})])
+        self.assertFalse(dispatch.fail(self.ride.id))
+
+    def test_sweep_fails_only_unclaimed_rides(self, _events, _thread, **_):
+        old = timezone.now() - timedelta(hours=1)
+        tracked = make_ride(self.rider)
+        Ride.objects.filter(pk__in=[self.ride.pk, tracked.pk]).update(created_at=old, updated_at=old)
+        # a live worker claims one of them (its next wave)
+        with mock.patch.object(dispatch.driver_index, 'within', return_value=[]):
+            self.dispatcher._send_wave(dispatch._Matching(tracked.id, 12.9, 77.6, 'BLS', 0, []), 1)
+        self.assertEqual(self.dispatcher.fail_orphans(), 1)
+        self.assertEqual(Ride.objects.get(pk=self.ride.pk).status, 'cancelled')
+        self.assertEqual(Ride.objects.get(pk=tracked.pk).status, 'matching')
+
+    def test_sweep_loses_to_a_claim_made_after_it_looked(self, _events, _thread, **_):
+        cutoff = timezone.now() - timedelta(minutes=1)
+        Ride.objects.filter(pk=self.ride.pk).update(updated_at=cutoff - timedelta(minutes=1))
+        with mock.patch.object(dispatch.driver_index, 'within', return_value=[]):
+            self.dispatcher._send_wave(self.m, 1)
+        self.assertFalse(dispatch.fail(self.ride.id, updated_before=cutoff))
+        self.assertEqual(Ride.objects.get(pk=self.ride.pk).status, 'matching')
+
+
+class DispatchTimerTests(TestCase):
+    """The wave timers, with the database work (_send_wave, fail) mocked out."""
+
+    def start(self, offer_timeout_s):
+        d = dispatch.Dispatcher(waves=[(5000, 1), (10000, 1), (20000, 1)], offer_timeout_s=offer_timeout_s,
+                                workers=1, sweep_s=3600)
+        patchers = {
+            'send_wave': mock.patch.object(d, '_send_wave', side_effect=lambda m, wave: [100 + wave]),
+            'fail_ride': mock.patch('main.dispatch.fail'),
+            'sweep': mock.patch.object(d, 'fail_orphans', return_value=0),
+        }
+        for name, patcher in patchers.items():
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: d._executor.shutdown(wait=True))
+        self.addCleanup(lambda: d._thread.join(5))
+        self.addCleanup(lambda: d._loop.call_soon_threadsafe(d._loop.stop))
+        return d
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('timed out')
+            time.sleep(0.01)
+
+    def test_unanswered_ride_escalates_then_fails(self):
+        d = self.start(offer_timeout_s=0.02)
+        d.track(1, 12.9, 77.6, 'BLS', 150000, [7])
+        self.wait_for(lambda: self.fail_ride.called)
+        self.assertEqual([c.args[1] for c in self.send_wave.call_args_list], [1, 2])
+        self.assertEqual(self.send_wave.call_args_list[-1].args[0].offered, {7, 101, 102})
+        self.fail_ride.assert_called_once_with(1)
+        self.wait_for(lambda: d.stats()['matching'] == 0)
+
+    def test_everybody_rejecting_skips_the_wait(self):
+        d = self.start(offer_timeout_s=60)
+        d.track(1, 12.9, 77.6, 'BLS', 150000, [7, 8])
+        self.wait_for(lambda: d.stats()['matching'] == 1)
+        d.rejected(1, 99)  # never offered: ignored
+        d.rejected(1, 7)
+        time.sleep(0.05)
+        self.send_wave.assert_not_called()
+        d.rejected(1, 8)
+        self.wait_for(lambda: self.send_wave.called)
+        self.assertEqual(self.send_wave.call_args.args[1], 1)
+        self.fail_ride.assert_not_called()
+
+    def test_ride_closed_meanwhile_is_dropped(self):
+        d = self.start(offer_timeout_s=0.02)
+        self.send_wave.side_effect = None
+        self.send_wave.return_value = None
+        d.track(1, 12.9, 77.6, 'BLS', 150000, [7])
+        self.wait_for(lambda: self.send_wave.called and d.stats()['matching'] == 0)
+        time.sleep(0.1)
+        self.assertEqual(self.send_wave.call_count, 1)
+        self.fail_ride.assert_not_called()
+
+class PricingTests(TestCase):
+    def quote(self, distance_m, eta_s, tariff, surge=pricing.NO_SURGE):
+        return pricing.quote_batch(distance_m, eta_s, tariff=tariff, surge=surge).tolist()
+
+    def test_terms_round_half_up(self):
+        per_km = pricing.Tariff(base=10000, per_km=1001, per_min=0, minimum=0)
+        # 1.5 km * 10.01 = 15.015 -> 15.02; 1.499 km -> 15.004999 -> 15.00
+        self.assertEqual(self.quote([1500, 1499], [0, 0], per_km), [11502, 11500])
+        per_min = pricing.Tariff(base=0, per_km=0, per_min=1, minimum=0)
+        self.assertEqual(self.quote([0, 0], [30, 29], per_min), [1, 0])
+
+    def test_minimum_fare_per_candidate(self):
+        tariff = pricing.Tariff(base=20000, per_km=1000, per_min=0, minimum=30000)
+        self.assertEqual(self.quote([0, 20000], [0, 0], tariff), [30000, 40000])
+
+    def test_surge_applied_last_and_rounded(self):
+        tariff = pricing.Tariff(base=10000, per_km=1001, per_min=0, minimum=12000)
+        # the minimum applies before surge: 100.00 -> 120.00 -> x1.25 = 150.00
+        self.assertEqual(self.quote([0], [0], tariff, surge=1250), [15000])
+        # 115.02 x 1.25 = 143.775 -> 143.78
+        tariff = tariff._replace(minimum=0)
+        self.assertEqual(self.quote([1500], [0], tariff, surge=1250), [14378])
+
+    def test_money_helpers(self):
+        self.assertEqual(pricing.to_paise('12.345'), 1235)
+        self.assertEqual(pricing.rupees(1235), '12.35')
+        self.assertEqual(pricing.rupees(-5), '-0.05')
+        self.assertEqual(str(pricing.to_decimal(1235)), '12.35')
+
+    def test_period_wrapping_midnight(self):
+        table = pricing._day_table({
+            'base': '200.00', 'per_km': '10.00', 'per_min': '2.00',
+            'periods': [{'from': '22:00', 'to': '06:00', 'base': '250.00'}],
+        })
+        tables = {'night_test': ([start for start, _ in table], [t for _, t in table])}
+        zone = pricing.TIME_ZONE
+        with mock.patch.dict(pricing._TABLES, tables):
+            def at(hour, minute=0):
+                return pricing.tariff_for('night_test', datetime(2026, 1, 1, hour, minute, tzinfo=zone))
+            self.assertEqual(at(12).base, 20000)
+            self.assertEqual(at(22).base, 25000)
+            self.assertEqual(at(3).base, 25000)
+            self.assertEqual(at(5, 59).base, 25000)
+            self.assertEqual(at(6).base, 20000)
+            # fields a period does not override come from the default tariff
+            self.assertEqual(at(23).per_km, 1000)
+
+    def test_unknown_type(self):
+        with self.assertRaises(pricing.UnknownAmbulanceType):
+            pricing.tariff_for('hovercraft')
+
+
+
+@mock.patch.multiple('main.surge', THRESHOLD=1.0, SLOPE=0.5, MAX_MILLI=2000)
+class SurgeTests(TestCase):
+    def setUp(self):
+        self.grid = surge.SurgeGrid(window_s=60, enabled=True)
+        self.grid._loaded = True
+        self.patch(self.grid, '_ensure_thread')
+        self.supply = self.patch(surge.driver_index, 'count', return_value=2)
+
+    def patch(self, target, name, **kwargs):
+        patcher = mock.patch.object(target, name, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_multiplier_thresholds(self):
+        self.assertEqual(surge.surge_milli(0, 0), 1000)
+        self.assertEqual(surge.surge_milli(2, 2), 1000)      # ratio 1.0: at the threshold, no surge
+        self.assertEqual(surge.surge_milli(3, 2), 1250)      # 1.5 -> 1 + 0.5 * 0.5
+        self.assertEqual(surge.surge_milli(4, 3), 1150)      # 1.1667 rounded to a 0.05 step
+        self.assertEqual(surge.surge_milli(2, 0), 1500)      # no drivers counts as one
+        self.assertEqual(surge.surge_milli(100, 1), 2000)    # capped
+
+    def test_demand_is_counted_around_the_pickup(self):
+        now = timezone.now()
+        for ride_id in range(1, 4):
+            self.grid.ride_changed(ride_id, 'matching', 12.9, 77.6, now)
+        self.grid.ride_changed(4, 'matching', 40.0, -70.0, now)   # far away
+        self.grid.ride_changed(5, 'assigned', 12.9, 77.6, now)    # no longer open
+        self.assertEqual(self.grid.counts(12.9, 77.6), (3, 2))
+        self.assertEqual(self.grid.multiplier(12.9, 77.6), 1250)
+
+        self.grid.ride_changed(1, 'assigned', 12.9, 77.6, now)
+        self.grid.ride_closed(2)
+        self.assertEqual(self.grid.multiplier(12.9, 77.6), 1000)
+        self.assertEqual(surge.SurgeGrid(enabled=False).multiplier(12.9, 77.6), surge.NO_SURGE)
+
+    def test_counted_demand_expires(self):
+        now = timezone.now()
+        self.grid.ride_changed(1, 'matching', 12.9, 77.6, now - timedelta(seconds=50))
+        self.grid.ride_changed(2, 'matching', 12.9, 77.6, now)
+        self.grid.ride_changed(3, 'matching', 12.9, 77.6, now - timedelta(seconds=61))  # already outside
+        self.assertEqual(self.grid.counts(12.9, 77.6)[0], 2)
+        with mock.patch('main.surge.time.time', return_value=now.timestamp() + 20):
+            self.grid.expire()
+        self.assertEqual(self.grid.counts(12.9, 77.6)[0], 1)
+        with mock.patch('main.surge.time.time', return_value=now.timestamp() + 61):
+            self.grid.expire()
+        self.assertEqual(self.grid.counts(12.9, 77.6)[0], 0)
+        self.assertEqual(self.grid._open, {})
+
+    @quiet
+    def test_fed_only_after_commit(self, **_mocks):
+        user = make_user(1)
+        with mock.patch('main.surge.surge_grid', self.grid):
+            with self.captureOnCommitCallbacks() as callbacks:
+                ride = make_ride(user, requested_at=timezone.now())
+            self.assertEqual(self.grid.counts(12.9, 77.6)[0], 0)
+            for callback in callbacks:
+                callback()
+            self.assertEqual(self.grid.counts(12.9, 77.6)[0], 1)
+
+            driver = make_driver(1)
+            with self.captureOnCommitCallbacks(execute=True):
+                rides.assign(ride.id, driver.id)  # an UPDATE: fed by main.rides, not post_save
+            self.assertEqual(self.grid.counts(12.9, 77.6)[0], 0)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                other = make_ride(user, requested_at=timezone.now())
+            self.assertEqual(self.grid.counts(12.9, 77.6)[0], 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                other.delete()
+            self.assertEqual(self.grid.counts(12.9, 77.6)[0], 0)
+
+class NearbyBoundsTests(TestCase):
+    def setUp(self):
+        self.grid = spatial.DriverGrid(enabled=True)
+        self.grid.load()
+        patcher = mock.patch('main.views.driver_index', self.grid)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, **params):
+        return self.client.get(reverse('api_nearby_ambulances'), {'lat': 22.57, 'lng': 88.36, **params})
+
+    def test_bad_limits_are_400(self):
+        for params in ({'max_results': 0}, {'max_results': -3}, {'max_results': 10 ** 6},
+                       {'radius_m': -1}, {'radius_m': 'nan'}, {'radius_m': 'far'}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+
+    def test_radius_is_clamped(self):
+        with mock.patch.object(self.grid, 'within', return_value=[]) as within:
+            self.assertEqual(self.get(radius_m=10 ** 7).status_code, 200)
+        self.assertLessEqual(within.call_args.args[2], 50000)
+
+    def test_huge_search_walks_occupied_cells(self):
+        self.grid.upsert(1, 22.57, 88.36)
+        self.grid.upsert(2, -33.86, 151.2)
+        hits = self.grid.within(22.57, 88.36, 2.5e7)
+        self.assertEqual(sorted(h[1] for h in hits), [1, 2])
+        with self.assertRaises(ValueError):
+            next(spatial.cells_covering(22.57, 88.36, 2.5e7))
+
+
+class DriverGridTests(TestCase):
+    def setUp(self):
+        self.grid = spatial.DriverGrid(cell_deg=0.01, enabled=True)
+        self.grid._loaded = True
+        self.grid._checked_at = time.monotonic()
+        self.points = {}
+
+    def put(self, driver_id, lat, lng):
+        self.points[driver_id] = (lat, lng)
+        self.grid.upsert(driver_id, lat, lng)
+
+    def brute(self, lat, lng, radius_m):
+        found = [(spatial.haversine_m(lat, lng, plat, plng), driver_id)
+                 for driver_id, (plat, plng) in self.points.items()]
+        return sorted((d, driver_id) for d, driver_id in found if d <= radius_m)
+
+    def assertMatchesBrute(self, lat, lng, radius_m):
+        hits = self.grid.within(lat, lng, radius_m)
+        expected = self.brute(lat, lng, radius_m)
+        self.assertEqual([h[1] for h in hits], [driver_id for _d, driver_id in expected])
+        for (d, _id, _lat, _lng), (want, _) in zip(hits, expected):
+            self.assertAlmostEqual(d, want, delta=0.01)
+
+    def test_matches_brute_force(self):
+        rng = random.Random(7)
+        for driver_id in range(300):
+            self.put(driver_id, 22.5 + rng.uniform(-0.1, 0.1), 88.3 + rng.uniform(-0.1, 0.1))
+        for radius_m in (200, 1000, 3000, 12000):
+            self.assertMatchesBrute(22.5, 88.3, radius_m)
+            self.assertMatchesBrute(22.53, 88.27, radius_m)
+
+    def test_cell_boundaries(self):
+        # either side of the 0.01 deg lines through (22.50, 88.30)
+        for driver_id, (lat, lng) in enumerate([(22.5, 88.3), (22.4999999, 88.3), (22.5, 88.2999999),
+                                                (22.4999999, 88.2999999), (22.5009, 88.3009)]):
+            self.put(driver_id, lat, lng)
+        self.assertEqual(len({self.grid._pos[i][2] for i in self.points}), 4)
+        self.assertMatchesBrute(22.5, 88.3, 1)
+        self.assertMatchesBrute(22.4999, 88.2999, 300)
+
+    def test_antimeridian(self):
+        self.put(1, -17.0, 179.999)
+        self.put(2, -17.0, -179.999)
+        self.put(3, -17.0, 179.9)
+        self.assertMatchesBrute(-17.0, -179.9995, 1000)
+        self.assertMatchesBrute(-17.0, 179.9995, 20000)
+        self.assertEqual([h[1] for h in self.grid.within(-17.0, -179.9995, 1000)], [2, 1])
+
+    def test_limit_keeps_nearest_first(self):
+        for driver_id, offset in enumerate([0.004, 0.001, 0.003, 0.002, 0.005]):
+            self.put(driver_id, 22.5 + offset, 88.3)
+        hits = self.grid.within(22.5, 88.3, 5000, limit=3)
+        self.assertEqual([h[1] for h in hits], [1, 3, 2])
+        self.assertEqual([h[1] for h in self.grid.nearest(22.5, 88.3, 2, 5000)], [1, 3])
+
+    def test_apply_moves_between_cells(self):
+        self.grid.apply(1, '22.5050', '88.3050', True)
+        old_cell = self.grid._pos[1][2]
+        self.grid.apply(1, '22.6050', '88.3050', True)
+        self.assertNotIn(old_cell, self.grid._cells)
+        self.assertEqual(self.grid.within(22.505, 88.305, 500), [])
+        self.assertEqual([h[1] for h in self.grid.within(22.605, 88.305, 500)], [1])
+        self.grid.apply(1, None, None, False)
+        self.assertEqual(len(self.grid), 0)
+        self.assertEqual(self.grid._cells, {})
+
+    def test_resync_picks_up_last_seen(self):
+        drivers = [make_driver(i) for i in range(3)]
+        now = timezone.now() - timedelta(minutes=1)
+        for driver, lat in zip(drivers, (22.50, 22.51, 22.52)):
+            DriverLive.objects.create(driver=driver, latitude=lat, longitude=88.3, is_online=True, last_seen=now)
+        self.grid.load()
+        self.assertEqual(len(self.grid), 3)
+        later = timezone.now()
+        DriverLive.objects.filter(driver=drivers[0]).update(latitude=22.6, last_seen=later)
+        DriverLive.objects.filter(driver=drivers[1]).update(is_online=False, last_seen=later)
+        # written without touching last_seen: invisible to an incremental resync
+        DriverLive.objects.filter(driver=drivers[2]).update(latitude=22.7)
+        self.grid.resync()
+        self.assertEqual(self.grid.position(drivers[0].id), (22.6, 88.3))
+        self.assertIsNone(self.grid.position(drivers[1].id))
+        self.assertEqual(self.grid.position(drivers[2].id), (22.52, 88.3))
+
+
+class GeometryTests(TestCase):
+    def test_haversine_batch_matches_scalar(self):
+        lats, lngs = [22.5, 22.6, -33.9, 51.5], [88.3, 88.4, 151.2, -0.12]
+        distance_m = geometry.haversine_m_batch(22.57, 88.36, lats, lngs)
+        for d, lat, lng in zip(distance_m, lats, lngs):
+            self.assertAlmostEqual(float(d), spatial.haversine_m(22.57, 88.36, lat, lng), delta=0.01)
+
+    def test_top_n(self):
+        values = [5.0, 1.0, 4.0, 1.0, 3.0]
+        self.assertEqual(list(geometry.top_n(values)), [1, 3, 4, 2, 0])
+        self.assertEqual(list(geometry.top_n(values, 3)), [1, 3, 4])
+        self.assertEqual(list(geometry.eta_s_batch([0, 25000 / 3.6])), [0, 1000])
+
+
+class DriverLiveCellTests(TestCase):
+    def setUp(self):
+        self.drivers = [make_driver(i) for i in range(6)]
+
+    def test_save_keeps_cell_in_sync(self):
+        live = DriverLive.objects.create(driver=self.drivers[0], latitude='22.570000', longitude='88.360000',
+                                         is_online=True)
+        self.assertEqual(live.cell, spatial.cell_key(22.57, 88.36))
+        live.latitude, live.longitude = '22.700000', '88.500000'
+        live.save(update_fields=['latitude', 'longitude'])
+        live.refresh_from_db()
+        self.assertEqual(live.cell, spatial.cell_key(22.7, 88.5))
+        live.latitude = live.longitude = None
+        live.save()
+        self.assertIsNone(DriverLive.objects.get(pk=live.pk).cell)
+
+    def test_update_or_create_keeps_cell_in_sync(self):
+        for lat in ('22.570000', '22.900000'):
+            live, _ = DriverLive.objects.update_or_create(
+                driver=self.drivers[0], defaults={'latitude': lat, 'longitude': '88.360000', 'is_online': True})
+            self.assertEqual(DriverLive.objects.get(pk=live.pk).cell, spatial.cell_key(float(lat), 88.36))
+
+    def test_db_within_matches_grid(self):
+        points = [(22.57, 88.36), (22.60, 88.40), (22.45, 88.30), (22.5501, 88.3499), (22.90, 88.90), (22.58, 88.37)]
+        for i, (driver, (lat, lng)) in enumerate(zip(self.drivers, points)):
+            DriverLive.objects.create(driver=driver, latitude=lat, longitude=lng, is_online=i != 5)
+        grid = spatial.DriverGrid(enabled=True)
+        grid.load()
+        for radius_m in (1000, 6000, 20000, 80000):
+            with self.subTest(radius_m=radius_m):
+                from_db = spatial.db_within(22.57, 88.36, radius_m, limit=4)
+                from_grid = grid.within(22.57, 88.36, radius_m, limit=4)
+                self.assertEqual([h[1] for h in from_db], [h[1] for h in from_grid])
+        self.assertNotIn(self.drivers[5].id, [h[1] for h in spatial.db_within(22.57, 88.36, 80000)])
+
+    def test_disabled_index_answers_from_db(self):
+        DriverLive.objects.create(driver=self.drivers[0], latitude=22.57, longitude=88.36, is_online=True)
+        grid = spatial.DriverGrid(enabled=False)
+        self.assertEqual([h[1] for h in grid.within(22.57, 88.36, 1000)], [self.drivers[0].id])
+        self.assertEqual(len(grid), 0)
+
+
+@mock.patch('main.live.anote_fix', new_callable=mock.AsyncMock)
+@mock.patch('main.live.aactive_ride_ids', new_callable=mock.AsyncMock, return_value=[])
+@mock.patch('main.live.record_fix')
+class DeadbandTests(TestCase):
+    def setUp(self):
+        self.driver = make_driver(1)
+        live._last_written.clear()
+        patcher = mock.patch('main.live.driver_index', spatial.DriverGrid(enabled=True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(live._last_written.clear)
+
+    def fix(self, lat, lng, is_online=True):
+        parsed = live.parse_fix({'lat': lat, 'lng': lng, 'is_online': is_online})
+        now = timezone.now()
+        return async_to_sync(live.save_fix)(self.driver.id, *parsed, now), now
+
+    def row(self):
+        return DriverLive.objects.get(driver=self.driver)
+
+    def test_small_move_only_touches_last_seen(self, record_fix, *_):
+        self.assertEqual(self.fix(22.57, 88.36)[0], [])
+        result, now = self.fix(22.57003, 88.36003)  # ~4 m
+        self.assertIsNone(result)
+        row = self.row()
+        self.assertEqual((float(row.latitude), float(row.longitude)), (22.57, 88.36))
+        self.assertEqual(row.last_seen, now)
+        self.assertEqual(record_fix.call_count, 1)
+
+    def test_real_move_writes_position(self, record_fix, *_):
+        self.fix(22.57, 88.36)
+        result, _now = self.fix(22.571, 88.36)  # ~110 m
+        self.assertEqual(result, [])
+        self.assertEqual(float(self.row().latitude), 22.571)
+        self.assertEqual(record_fix.call_count, 2)
+
+    def test_status_change_and_keepalive_write(self, record_fix, *_):
+        self.fix(22.57, 88.36)
+        self.assertEqual(self.fix(None, None, is_online=False)[0], [])
+        self.assertFalse(self.row().is_online)
+        self.fix(22.57, 88.36)
+        with mock.patch('main.live.time.monotonic', return_value=time.monotonic() + live.KEEPALIVE_S):
+            self.assertEqual(self.fix(22.57, 88.36)[0], [])
+        self.assertEqual(record_fix.call_count, 3)
+
+    def test_first_fix_after_restart_writes(self, record_fix, *_):
+        self.fix(22.57, 88.36)
+        live._last_written.clear()  # a fresh worker knows nothing about the last write
+        self.assertEqual(self.fix(22.57, 88.36)[0], [])
+        self.assertEqual(record_fix.call_count, 2)
+
+
+class WriteBehindTests(TestCase):
+    def buffer(self, **kwargs):
+        self.batches = []
+        self.flushed = threading.Event()
+
+        def flush_fn(batch):
+            self.batches.append(batch)
+            self.flushed.set()
+
+        buf = WriteBehindBuffer('test', flush_fn, **kwargs)
+        self.addCleanup(buf.close)
+        return buf
+
+    def test_flushes_on_max_rows(self):
+        buf = self.buffer(max_rows=3, max_delay_ms=60000)
+        for i in range(3):
+            buf.add(i)
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(self.batches, [[0, 1, 2]])
+
+    def test_flushes_on_max_delay(self):
+        buf = self.buffer(max_rows=1000, max_delay_ms=50)
+        buf.add('a')
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(self.batches, [['a']])
+        self.assertEqual(buf.stats()['flushed'], 1)
+
+    def test_full_buffer_drops_and_counts(self):
+        buf = self.buffer(max_rows=1000, max_delay_ms=60000, max_buffer=2)
+        self.assertEqual([buf.add(i) for i in range(4)], [True, True, False, False])
+        stats = buf.stats()
+        self.assertEqual((stats['added'], stats['dropped'], stats['depth']), (2, 2, 2))
+
+    def test_close_drains(self):
+        buf = self.buffer(max_rows=2, max_delay_ms=60000)
+        for i in range(5):
+            buf.add(i)
+        buf.close()
+        self.assertEqual([row for batch in self.batches for row in batch], [0, 1, 2, 3, 4])
+        self.assertEqual(buf.stats()['depth'], 0)
+
+    def test_failed_flush_counts_rows_as_dropped(self):
+        buf = WriteBehindBuffer('failing', mock.Mock(side_effect=RuntimeError('db down')), max_delay_ms=60000)
+        buf.add(1)
+        with self.assertLogs('main.writebehind', 'ERROR'):
+            buf.close()
+        self.assertEqual((buf.stats()['failures'], buf.stats()['dropped']), (1, 1))
+
+    def test_location_rows_bulk_created(self):
+        driver = make_driver(1)
+        buf = WriteBehindBuffer('driver_locations_test', telemetry.write_locations, max_delay_ms=60000)
+        with mock.patch.object(telemetry, 'location_writer', buf):
+            now = timezone.now()
+            for i in range(3):
+                telemetry.record_fix(driver.id, f'22.57000{i}', '88.360000', now, speed=1.5)
+            # close() drains on this thread, inside the test's transaction
+            buf.close()
+        rows = DriverLocation.objects.filter(driver=driver).order_by('latitude')
+        self.assertEqual([str(r.latitude) for r in rows], ['22.570000', '22.570001', '22.570002'])
+        self.assertEqual({r.speed for r in rows}, {1.5})
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        driver = make_driver(1)
+        now = timezone.now()
+        ages = [timedelta(days=d, hours=h) for d in (8, 9, 30) for h in (0, 5)] + [timedelta(days=7, minutes=1)]
+        ages += [timedelta(days=6, hours=23), timedelta(hours=1), timedelta(0)]
+        DriverLocation.objects.bulk_create([
+            DriverLocation(driver=driver, latitude=22.5, longitude=88.3, recorded_at=now - age) for age in ages])
+        self.cutoff = retention.cutoff_for(7)
+
+    def old(self):
+        return DriverLocation.objects.filter(recorded_at__lt=self.cutoff).count()
+
+    def test_batches_remove_only_expired_rows(self):
+        with CaptureQueriesContext(connection) as queries:
+            removed = retention.prune_driver_locations(days=7, batch_size=2)
+        self.assertEqual(removed, 7)
+        self.assertEqual(self.old(), 0)
+        self.assertEqual(DriverLocation.objects.count(), 3)
+        deletes = [q for q in queries if q['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 4)
+
+    def test_max_batches(self):
+        self.assertEqual(retention.prune_driver_locations(days=7, batch_size=3, max_batches=2), 6)
+        self.assertEqual(self.old(), 1)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('prune_driver_locations', '--days', '7', '--batch-size', '4', stdout=out)
+        self.assertIn('pruned 7 driver_locations rows', out.getvalue())
+        self.assertEqual(DriverLocation.objects.count(), 3)
+        with self.assertRaises(CommandError):
+            call_command('prune_driver_locations', '--convert-to-partitions', stdout=io.StringIO())
+
+
+@quiet
+class RideCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.rider = make_user(1)
+        self.driver = make_driver(1)
+
+    def test_cached_until_a_transition_commits(self, **_):
+        ride = make_ride(self.rider, status='requested')
+        self.assertEqual(ride_cache.active_ride_ids(self.driver.id), [])  # 'requested' is not active
+        with self.assertNumQueries(0):
+            self.assertEqual(ride_cache.active_ride_ids(self.driver.id), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(rides.assign(ride.id, self.driver.id).won)
+        with self.assertNumQueries(0):
+            self.assertEqual(ride_cache.active_ride_ids(self.driver.id), [ride.id])
+        self.assertEqual(async_to_sync(ride_cache.aactive_ride_ids)(self.driver.id), [ride.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            rides.transition(ride.id, 'cancel')
+        self.assertEqual(ride_cache.active_ride_ids(self.driver.id), [])
+
+    def test_rolled_back_change_leaves_cache_alone(self, **_):
+        ride = make_ride(self.rider, driver=self.driver, status='assigned')
+        self.assertEqual(ride_cache.active_ride_ids(self.driver.id), [ride.id])
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    rides.transition(ride.id, 'cancel')
+                    raise RuntimeError('rollback')
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(ride_cache.active_ride_ids(self.driver.id), [ride.id])
+
+    def test_cache_down_falls_back_to_query(self, **_):
+        ride = make_ride(self.rider, driver=self.driver, status='on_trip')
+        with mock.patch.object(ride_cache, 'cache') as broken:
+            broken.get.side_effect = ConnectionError('cache down')
+            self.assertEqual(ride_cache.active_ride_ids(self.driver.id), [ride.id])
+
+
+
+
+class RideTimelineTests(TestCase):
+    def setUp(self):
+        self.rider = make_user(1)
+        self.driver = make_driver(1)
+        self.ride = make_ride(self.rider, status='assigned', driver=self.driver)
+        start = timezone.now()
+        # written out of order, as separate flushes would
+        ride_events.write_events([
+            (self.ride.id, None, 'driver', 'ride.assigned', {'driver_id': self.driver.id}, start + timedelta(seconds=2)),
+            (self.ride.id, self.rider.id, 'user', 'ride.requested', {}, start),
+            (self.ride.id, None, 'system', 'ride.offered', {'driver_id': self.driver.id}, start + timedelta(seconds=1)),
+        ])
+
+    async def get(self, user, **params):
+        store = TieredSessionStore()
+        store['user_id'] = user.id
+        await sync_to_async(store.save)()
+        client = AsyncClient()
+        client.cookies[settings.SESSION_COOKIE_NAME] = store.session_key
+        response = await client.get(reverse('api_ride_timeline', args=[self.ride.id]), params)
+        if not response.streaming:
+            return response.status_code, None
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        return response.status_code, json.loads(body)
+
+    async def test_events_in_order(self):
+        status, body = await self.get(self.rider)
+        self.assertEqual(status, 200)
+        self.assertEqual(body['ride_id'], self.ride.id)
+        self.assertEqual([e['type'] for e in body['events']], ['ride.requested', 'ride.offered', 'ride.assigned'])
+        self.assertEqual(body['events'][0]['actor_user_id'], self.rider.id)
+
+        status, body = await self.get(self.driver.user, order='desc', limit=2)
+        self.assertEqual([e['type'] for e in body['events']], ['ride.assigned', 'ride.offered'])
+
+    async def test_only_the_parties_see_it(self):
+        stranger = await sync_to_async(make_user)(2)
+        self.assertEqual((await self.get(stranger))[0], 403)
+        self.assertEqual((await self.get(self.rider, limit='x'))[0], 400)
+
+    def test_near_pickup_recorded_once(self):
+        note_fix = async_to_sync(ride_events.anote_fix)
+        now = timezone.now()
+        with mock.patch.dict(ride_events._pickups, clear=True), \
+                mock.patch.object(ride_events, 'event_writer') as writer:
+            note_fix(self.driver.id, 13.0, 77.6, [self.ride.id], now)  # ~11 km out
+            writer.add.assert_not_called()
+            note_fix(self.driver.id, 12.9005, 77.6, [self.ride.id], now + timedelta(seconds=3))
+            note_fix(self.driver.id, 12.9, 77.6, [self.ride.id], now + timedelta(seconds=4))
+        writer.add.assert_called_once()
+        ride_events.write_events([row for (row,), _ in writer.add.call_args_list])
+
+        events = async_to_sync(self.get)(self.rider)[1]['events']
+        self.assertEqual([e['type'] for e in events][-1], 'driver.near_pickup')
+        self.assertEqual(events[-1]['data'], {'driver_id': self.driver.id, 'distance_m': 55})
+        self.assertEqual(events[-1]['actor_type'], 'driver')
+
+class NearbyConsumerTests(TestCase):
+    def setUp(self):
+        grid = spatial.DriverGrid(enabled=True)
+        grid._loaded = True
+        grid._checked_at = time.monotonic() + 3600
+        grid.upsert(7, 22.571, 88.361)
+        patcher = mock.patch('main.consumers.driver_index', grid)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def subscribe(self, **viewport):
+        communicator = WebsocketCommunicator(consumers.NearbyConsumer.as_asgi(), '/ws/nearby/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'type': 'subscribe', **viewport})
+        reply = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return reply
+
+    async def test_snapshot(self):
+        reply = await self.subscribe(lat=22.57, lng=88.36, radius_m=2000)
+        self.assertEqual(reply['type'], 'nearby.delta')
+        self.assertEqual([d['driver_id'] for d in reply['add']], [7])
+
+    async def test_huge_viewport_refused_before_building_groups(self):
+        with mock.patch('main.consumers.cell_groups_in_bbox') as build:
+            reply = await self.subscribe(south=-90, west=-180, north=90, east=180)
+        self.assertEqual(reply, {'type': 'nearby.error', 'error': 'viewport too large, zoom in'})
+        build.assert_not_called()
+
+
+class WebsocketSessionCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        ws_auth._resolved.clear()
+        self.addCleanup(ws_auth._resolved.clear)
+        self.user = make_user(1)
+        self.store = TieredSessionStore()
+        self.store['user_id'] = self.user.id
+        self.store.create()
+
+    def resolve(self, session_key):
+        return async_to_sync(ws_auth.resolve_session_user)(session_key)[0]
+
+    def test_resolved_user_is_cached(self):
+        self.assertEqual(self.resolve(self.store.session_key), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve(self.store.session_key), self.user)
+
+    def test_logout_is_seen_within_the_ttl(self):
+        self.assertEqual(self.resolve(self.store.session_key), self.user)
+        TieredSessionStore(self.store.session_key).delete()
+        self.assertIsNone(self.resolve(self.store.session_key))
+
+    def test_delete_reaches_other_workers(self):
+        key = self.store.session_key
+        self.assertEqual(self.resolve(key), self.user)
+        TieredSessionStore(key).delete()
+        # another worker still holds the user in its own map: the shared "gone" marker wins
+        ws_auth._remember(key, self.user)
+        self.assertIsNone(self.resolve(key))
+
+    def test_unknown_key_is_negatively_cached(self):
+        self.assertIsNone(self.resolve('no-such-session-key'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.resolve('no-such-session-key'))
+
+    def test_session_without_user_is_not_cached(self):
+        anonymous = TieredSessionStore()
+        anonymous['cart'] = 1
+        anonymous.create()
+        self.assertIsNone(self.resolve(anonymous.session_key))
+        anonymous['user_id'] = self.user.id
+        anonymous.save()
+        self.assertEqual(self.resolve(anonymous.session_key), self.user)
+
+
+class WebsocketAuthMiddlewareTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        from medwheels.asgi import RobustCookieAuthMiddleware
+        self.scopes = []
+
+        async def inner(scope, receive, send):
+            self.scopes.append(scope)
+
+        self.middleware = RobustCookieAuthMiddleware(inner)
+
+    def handshake(self, *headers):
+        async_to_sync(self.middleware)({'type': 'websocket', 'headers': list(headers)}, None, None)
+        return self.scopes[-1]
+
+    @mock.patch('main.api_keys.touch')
+    def test_token_header_sets_api_driver_id(self, _touch):
+        driver = make_driver(1)
+        token = DriverAPIKey.create_for_driver(driver)
+        scope = self.handshake((b'authorization', f'Token {token}'.encode()))
+        self.assertEqual(scope['api_driver_id'], driver.id)
+        self.assertFalse(scope['user'].is_authenticated)
+        scope = self.handshake((b'x-driver-token', b'not-a-token'))
+        self.assertIsNone(scope['api_driver_id'])
+
+    def test_session_cookie_sets_user(self):
+        user = make_user(1)
+        store = TieredSessionStore()
+        store['user_id'] = user.id
+        store.create()
+        scope = self.handshake((b'cookie', f'sessionid={store.session_key}'.encode()))
+        self.assertEqual(scope['user'], user)
+        self.assertNotIn('api_driver_id', scope)
+
+
+class TieredSessionTests(TestCase):
+    """main.sessions as it runs with a shared (non-LocMem) cache: write-behind on."""
+
+    def setUp(self):
+        cache.clear()
+        sessions._l1.clear()
+        self.addCleanup(sessions._l1.clear)
+        self.writer = WriteBehindBuffer('sessions_test', sessions.write_sessions, max_delay_ms=60000)
+        self.addCleanup(self.writer.close)
+        for patcher in (mock.patch.object(sessions, 'WRITE_BEHIND', True),
+                        mock.patch.object(sessions, 'session_writer', self.writer)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.store = TieredSessionStore()
+        self.store['user_id'] = 1
+        self.store.create()  # new sessions are written synchronously
+        self.key = self.store.session_key
+
+    def db_data(self):
+        row = Session.objects.filter(pk=self.key).first()
+        return row.get_decoded() if row else None
+
+    def test_save_is_written_behind(self):
+        store = TieredSessionStore(self.key)
+        store['cart'] = 3
+        store.save()
+        self.assertEqual(self.db_data(), {'user_id': 1})  # not yet
+        self.assertEqual(TieredSessionStore(self.key).load(), {'user_id': 1, 'cart': 3})
+        for n in (4, 5):
+            store['cart'] = n
+            store.save()
+        self.assertEqual(self.writer.stats()['depth'], 3)
+        self.writer.close()  # drains on this thread
+        self.assertEqual(self.db_data(), {'user_id': 1, 'cart': 5})
+        self.assertEqual(self.writer.stats()['flushes'], 1)  # three saves, one UPDATE
+
+    def test_l1_serves_reads_for_its_ttl(self):
+        self.assertEqual(TieredSessionStore(self.key).load(), {'user_id': 1})
+        cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(TieredSessionStore(self.key).load(), {'user_id': 1})
+        with mock.patch('main.sessions.time.monotonic', return_value=time.monotonic() + sessions.L1_TTL_S):
+            with self.assertNumQueries(1):
+                self.assertEqual(TieredSessionStore(self.key).load(), {'user_id': 1})
+
+    def test_deleted_session_does_not_come_back(self):
+        store = TieredSessionStore(self.key)
+        store['cart'] = 3
+        store.save()  # queued UPDATE for a row that is about to go
+        with mock.patch.object(sessions, 'forget_session') as forget:
+            TieredSessionStore(self.key).delete()
+        forget.assert_called_once_with(self.key)
+        self.assertEqual(TieredSessionStore(self.key).load(), {})  # not from L1, not from the cache
+        self.writer.close()
+        self.assertIsNone(self.db_data())  # the queued UPDATE did not recreate it
+
+    def test_logout_flush_drops_the_handshake_cache(self):
+        ws_auth._remember(self.key, object())
+        self.addCleanup(ws_auth._resolved.clear)
+        store = TieredSessionStore(self.key)
+        store.flush()
+        self.assertIsNone(ws_auth._cached(self.key))
+        self.assertTrue(cache.get(ws_auth._gone_key(self.key)))
+
+
+@mock.patch('main.api_keys.touch')
+class DriverAPIKeyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.driver = make_driver(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token = DriverAPIKey.create_for_driver(self.driver)
+
+    def test_verify_and_averify(self, _touch):
+        principal = api_keys.verify(self.token)
+        self.assertEqual(principal.driver_id, self.driver.id)
+        self.assertEqual(principal.user_id, self.driver.user_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(api_keys.verify(self.token), principal)
+            self.assertEqual(async_to_sync(api_keys.averify)(self.token), principal)
+        self.assertIsNone(api_keys.verify('not-a-token'))
+        self.assertIsNone(api_keys.verify(''))
+
+    def test_rotation_invalidates_the_old_token(self, _touch):
+        self.assertIsNotNone(api_keys.verify(self.token))  # now cached
+        with self.captureOnCommitCallbacks() as callbacks:
+            new_token = DriverAPIKey.create_for_driver(self.driver)
+            # forgotten after commit, not before: a verify() racing the UPDATE cannot re-cache it
+            self.assertIsNotNone(api_keys.verify(self.token))
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(api_keys.verify(self.token))
+        self.assertEqual(api_keys.verify(new_token).driver_id, self.driver.id)
+
+    def test_revoke_and_expiry(self, _touch):
+        self.assertIsNotNone(api_keys.verify(self.token))
+        key = DriverAPIKey.objects.get(driver=self.driver)
+        key.revoked = True
+        with self.captureOnCommitCallbacks(execute=True):
+            key.save()
+        self.assertIsNone(api_keys.verify(self.token))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            token = DriverAPIKey.create_for_driver(self.driver, lifetime_days=1)
+        self.assertIsNotNone(api_keys.verify(token))
+        with mock.patch('main.api_keys.time.time', return_value=time.time() + 2 * 86400):
+            self.assertIsNone(api_keys.verify(token))
+
+    def test_write_last_used_keeps_the_latest(self, _touch):
+        key = DriverAPIKey.objects.get(driver=self.driver)
+        now = timezone.now()
+        api_keys.write_last_used([(key.id, now), (key.id, now - timedelta(minutes=5))])
+        key.refresh_from_db()
+        self.assertEqual(key.last_used, now)
+
+
+class DriverAPIKeyTouchTests(TestCase):
+    def test_last_used_is_throttled(self):
+        api_keys._touched.clear()
+        self.addCleanup(api_keys._touched.clear)
+        with mock.patch.object(api_keys, 'last_used_writer') as writer:
+            for _ in range(3):
+                api_keys.touch(7)
+            self.assertEqual(writer.add.call_count, 1)
+            with mock.patch('main.api_keys.time.monotonic', return_value=time.monotonic() + api_keys.LAST_USED_S):
+                api_keys.touch(7)
+            self.assertEqual(writer.add.call_count, 2)
+
+
+@mock.patch('main.api_keys.touch')
+class DriverTokenCsrfTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token = DriverAPIKey.create_for_driver(make_driver(1))
+
+    def post(self, client, path, token):
+        return client.post(path, '{}', content_type='application/json', headers={'Authorization': f'Token {token}'})
+
+    def test_verified_token_skips_csrf_on_driver_api(self, _touch):
+        # 400 from the view (no ride_id) means CsrfViewMiddleware let it through
+        self.assertEqual(self.post(Client(enforce_csrf_checks=True), '/api/driver/respond/', self.token).status_code, 400)
+
+    async def test_verified_token_skips_csrf_on_async_stack(self, _touch):
+        response = await self.post(AsyncClient(enforce_csrf_checks=True), '/api/driver/respond/', self.token)
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_token_is_csrf_checked(self, _touch):
+        response = self.post(Client(enforce_csrf_checks=True), '/api/driver/respond/', 'forged')
+        self.assertEqual(response.status_code, 403)
+        self.assertIn(b'CSRF', response.content)
+
+    def test_other_paths_are_csrf_checked(self, _touch):
+        response = self.post(Client(enforce_csrf_checks=True), '/api/estimate/', self.token)
+        self.assertEqual(response.status_code, 403)
+        self.assertIn(b'CSRF', response.content)
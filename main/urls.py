@@ -8,6 +8,7 @@ urlpatterns = [
     path('service/estimate/', views.service_estimate, name='service_estimate'),
     path('driver/dashboard/', views.driver_dashboard, name='driver_dashboard'),
     path('api/driver/live/', views.api_driver_live_update, name='api_driver_live_update'),
+    path('api/driver/token/', views.api_driver_token, name='api_driver_token'),
     path('api/estimate/', views.api_estimate, name='api_estimate'),
     path('api/book_ride/', views.api_book_ride, name='api_book_ride'),
     path('api/nearby/', views.api_nearby_ambulances, name='api_nearby_ambulances'),
@@ -15,6 +16,8 @@ urlpatterns = [
     path('find_driver/<int:ride_id>/', views.find_driver_view, name='find_driver'),
     path('api/driver/respond/', views.api_driver_respond, name='api_driver_respond'),
     path('api_cancel_ride/<int:ride_id>/', views.api_cancel_ride, name='api_cancel_ride'),
+    path('api/rides/<int:ride_id>/timeline/', views.api_ride_timeline, name='api_ride_timeline'),
     path('debug/channel_layer/', views.debug_channel_layer, name='debug_channel_layer'),
+    path('debug/telemetry/', views.debug_telemetry, name='debug_telemetry'),
 
 ]
@@ -1,26 +1,31 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.db import transaction
 from django.utils import timezone
 from django.views.decorators.http import require_GET, require_POST
 import json
 import random
-from decimal import Decimal
-from math import radians, cos, sin, asin, sqrt
-from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
 from channels.layers import get_channel_layer
+from django.db import transaction
 from django.http import Http404
 from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from django.utils.encoding import force_bytes
 from django.contrib.auth.tokens import default_token_generator
 from django.core.mail import send_mail
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from django.views.decorators.csrf import ensure_csrf_cookie
-from verify.models import Users, Drivers,DriverDocuments
-from .models import DriverLive, DriverLocation, Ride
+from verify import driver_cards
+from verify.models import Users, Drivers
+from verify.principals import session_principal
+from .models import DriverAPIKey, DriverLive, Ride
+from . import api_keys, dispatch, outbox, ride_events, rides
+from . import pricing
+from .idempotency import idempotent
+from .geometry import eta_s_batch, haversine_m_batch, top_n
+from .live import parse_fix, save_fix, fix_messages, publish
+from .spatial import driver_index, haversine_m
+from .surge import surge_grid
+from .telemetry import location_writer
 from django.urls import reverse
 from django.conf import settings
-from django.http import JsonResponse, HttpResponseForbidden, HttpResponseBadRequest
+from django.http import JsonResponse, HttpResponseForbidden, HttpResponseBadRequest, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required, user_passes_test
 
@@ -28,6 +33,8 @@ from django.contrib.auth.decorators import login_required, user_passes_test
 
 
 DEFAULT_MAP_CENTER = (22.5726, 88.3639)  # fallback (Kolkata) - change to your city
+NEARBY_MAX_RADIUS_M = float(getattr(settings, 'NEARBY_MAX_RADIUS_M', 50000))  # api/nearby/ clamps radius_m to this
+NEARBY_MAX_RESULTS = int(getattr(settings, 'NEARBY_MAX_RESULTS', 100))
 def debug_channel_layer(request):
     try:
         from channels.layers import get_channel_layer
@@ -36,17 +43,29 @@ def debug_channel_layer(request):
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)})
 
+def debug_telemetry(request):
+    """Write-behind telemetry counters (buffer depth, flush latency, dropped rows)."""
+    if not settings.DEBUG and not request.user.is_staff:
+        return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'forbidden'}), content_type='application/json')
+    return JsonResponse({'ok': True, 'driver_locations': location_writer.stats(),
+                         'ride_events': ride_events.event_writer.stats(),
+                         'dispatch': dispatch.dispatcher.stats()})
+
 # helpers
-def haversine_m(lat1, lon1, lat2, lon2):
-    """Return distance in meters between two (lat,lng)."""
-    # convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    R = 6371000  # Earth radius in meters
-    return R * c
+def _live_rows_for(hits):
+    """
+    Resolve driver_index hits [(distance_m, driver_id, lat, lng), ...] to
+    [(distance_m, DriverLive), ...] in the same order, in one query.
+    Driver name/photo/vehicle come from driver_cards.get_cards(), not the row.
+    Rows that went offline on another worker since the index last synced are dropped.
+    """
+    if not hits:
+        return []
+    rows = DriverLive.objects.filter(
+        is_online=True, latitude__isnull=False, longitude__isnull=False,
+    ).in_bulk([h[1] for h in hits], field_name='driver_id')
+    return [(h[0], rows[h[1]]) for h in hits if h[1] in rows]
+
 def service_view(request):
     """
     Renders the service page. Pass GOOGLE_MAPS_API_KEY and DEFAULT_MAP_CENTER in context.
@@ -131,9 +150,19 @@ def api_see_price(request):
 
 def _get_driver_for_session(request):
     """
-    Return Drivers instance for currently-authenticated driver based on session user_id.
+    Return Drivers instance for currently-authenticated driver based on session user_id,
+    or on an API token header (native app, see main.api_keys) when one is sent.
     Returns (driver_obj, None) or (None, error_response) so callers can return early.
     """
+    token = api_keys.request_token(request)
+    if token:
+        # a token request never falls back to the session (it skips CSRF, see main.middleware)
+        principal = api_keys.verify(token)
+        driver = Drivers.objects.filter(pk=principal.driver_id).first() if principal else None
+        if not driver:
+            return None, HttpResponseForbidden(json.dumps({'ok': False, 'error': 'invalid token'}), content_type='application/json')
+        return driver, None
+
     user_id = request.session.get('user_id')
     if not user_id:
         return None, HttpResponseForbidden(json.dumps({'ok': False, 'error': 'not authenticated'}), content_type='application/json')
@@ -147,6 +176,26 @@ def _get_driver_for_session(request):
         return None, HttpResponseForbidden(json.dumps({'ok': False, 'error': 'driver profile not found'}), content_type='application/json')
     return driver, None
 
+async def _aget_driver_for_session(request):
+    """Async-ORM twin of _get_driver_for_session() for the async hot-path views."""
+    token = api_keys.request_token(request)
+    if token:
+        principal = await api_keys.averify(token)
+        driver = await Drivers.objects.filter(pk=principal.driver_id).afirst() if principal else None
+        if not driver:
+            return None, HttpResponseForbidden(json.dumps({'ok': False, 'error': 'invalid token'}), content_type='application/json')
+        return driver, None
+
+    user_id = await request.session.aget('user_id')
+    if not user_id:
+        return None, HttpResponseForbidden(json.dumps({'ok': False, 'error': 'not authenticated'}), content_type='application/json')
+    driver = await Drivers.objects.filter(user_id=user_id).afirst()
+    if not driver:
+        if not await Users.objects.filter(pk=user_id).aexists():
+            return None, HttpResponseForbidden(json.dumps({'ok': False, 'error': 'user not found'}), content_type='application/json')
+        return None, HttpResponseForbidden(json.dumps({'ok': False, 'error': 'driver profile not found'}), content_type='application/json')
+    return driver, None
+
 @ensure_csrf_cookie
 def driver_dashboard(request):
     """
@@ -188,14 +237,16 @@ def driver_dashboard(request):
 
 
 @require_POST
-def api_driver_live_update(request):
+async def api_driver_live_update(request):
     """
     Receive JSON { lat: <float>|null, lng: <float>|null, is_online: true/false } from driver dashboard.
     Updates/creates DriverLive and appends DriverLocation (if coords present).
     Also broadcasts a group message to WebSocket clients subscribed to group "driver_<id>".
+    Drivers with an open ws/driver/<id>/ socket send fixes there instead (DriverConsumer);
+    this endpoint is the fallback and uses the same main.live pipeline.
     """
     # find driver for session
-    driver, auth_err = _get_driver_for_session(request)
+    driver, auth_err = await _aget_driver_for_session(request)
     if auth_err:
         return auth_err
 
@@ -207,102 +258,54 @@ def api_driver_live_update(request):
             content_type='application/json'
         )
 
-    lat = payload.get('lat')
-    lng = payload.get('lng')
-    is_online = payload.get('is_online', True)
-
-    # If driver intends to mark offline, allow missing coords (browser may not provide them on unload)
-    if is_online is True:
-        if lat is None or lng is None:
-            return HttpResponseBadRequest(
-                json.dumps({'ok': False, 'error': 'lat and lng required when is_online is true'}),
-                content_type='application/json'
-            )
-    # If driver is setting offline, we will accept missing lat/lng and only update is_online flag.
-
-    # coercion and validation (only if lat/lng present)
-    lat_dec = None
-    lng_dec = None
-    if lat is not None and lng is not None:
-        try:
-            lat_dec = Decimal(str(lat))
-            lng_dec = Decimal(str(lng))
-        except Exception:
-            return HttpResponseBadRequest(
-                json.dumps({'ok': False, 'error': 'invalid lat/lng'}),
-                content_type='application/json'
-            )
+    try:
+        lat_dec, lng_dec, is_online = parse_fix(payload)
+    except ValueError as e:
+        return HttpResponseBadRequest(
+            json.dumps({'ok': False, 'error': str(e)}),
+            content_type='application/json'
+        )
 
     now = timezone.now()
 
-    # update or create DriverLive row
+    # update DriverLive, append telemetry, feed the grid index
     try:
-        if lat_dec is not None and lng_dec is not None:
-            live_obj, created = DriverLive.objects.update_or_create(
-                driver=driver,
-                defaults={'latitude': lat_dec, 'longitude': lng_dec, 'is_online': bool(is_online), 'last_seen': now}
-            )
-        else:
-            # No coords provided (likely marking offline). Update only is_online/last_seen.
-            live_obj, created = DriverLive.objects.update_or_create(
-                driver=driver,
-                defaults={'is_online': bool(is_online), 'last_seen': now}
-            )
+        ride_ids = await save_fix(driver.id, lat_dec, lng_dec, is_online, now)
     except Exception as e:
         # In case DB update fails return server error
         return JsonResponse({'ok': False, 'error': 'failed to update live', 'detail': str(e)}, status=500)
 
-    # append telemetry (DriverLocation) - only if we have coords
-    if lat_dec is not None and lng_dec is not None:
-        try:
-            DriverLocation.objects.create(
-                driver=driver,
-                latitude=lat_dec,
-                longitude=lng_dec,
-                recorded_at=now
-            )
-        except Exception:
-            # If this fails for any reason, we still want to return success for live update.
-            # Log in real app.
-            pass
-
-    # --- BROADCAST to WebSocket group (so any user subscribed to this driver's group gets the update) ---
-    try:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"driver_{driver.id}",
-            {
-                'type': 'location.update',
-                'driver_id': driver.id,
-                'lat': float(lat_dec) if lat_dec is not None else None,
-                'lng': float(lng_dec) if lng_dec is not None else None,
-                'is_online': bool(is_online),
-                'last_seen': now.isoformat()
-            }
-        )
-        # Also notify any rider(s) with assigned rides to this driver
-        assigned_rides = Ride.objects.filter(driver=driver,
-                                             status__in=['assigned', 'accepted', 'on_trip'])
-        for r in assigned_rides:
-            async_to_sync(channel_layer.group_send)(
-                f"ride_{r.id}",
-                {
-                    'type': 'location.update',
-                    'driver_id': driver.id,
-                    'lat': float(lat_dec) if lat_dec is not None else None,
-                    'lng': float(lng_dec) if lng_dec is not None else None,
-                    'last_seen': now.isoformat()
-                }
-            )
-    except Exception:
-        # Non-fatal: ignore broadcast errors (log in production)
-        pass
+    # --- BROADCAST to WebSocket groups (driver_<id> watchers + riders on assigned rides) ---
+    # ride_ids is None when the fix was dead-banded: nothing moved, nothing to fan out
+    # sends go out concurrently; failures are non-fatal (log in production)
+    if ride_ids is not None:
+        await publish(get_channel_layer(), fix_messages(driver.id, lat_dec, lng_dec, is_online, now, ride_ids))
 
-    return JsonResponse({'ok': True, 'last_seen': now.isoformat(), 'is_online': bool(is_online)})
+    return JsonResponse({'ok': True, 'last_seen': now.isoformat(), 'is_online': is_online})
 
 
 
 
+@require_POST
+def api_driver_token(request):
+    """
+    Issue (or rotate) the driver's API token for the native app.
+    The raw token is returned once; send it back as `Authorization: Token <token>`
+    on the driver endpoints and websockets. Any previous token stops working.
+    Optional JSON: { lifetime_days: <int> }
+    """
+    driver, auth_err = _get_driver_for_session(request)
+    if auth_err:
+        return auth_err
+    try:
+        payload = json.loads(request.body.decode('utf-8') or '{}')
+        lifetime_days = int(payload['lifetime_days']) if payload.get('lifetime_days') else None
+    except Exception:
+        return HttpResponseBadRequest(json.dumps({'ok': False, 'error': 'invalid json'}), content_type='application/json')
+    token = DriverAPIKey.create_for_driver(driver, lifetime_days=lifetime_days)
+    return JsonResponse({'ok': True, 'token': token, 'driver_id': driver.id})
+
+
 @require_GET
 def api_nearby_ambulances(request):
     """
@@ -310,15 +313,13 @@ def api_nearby_ambulances(request):
     Query params:
       - lat (required)
       - lng (required)
-      - radius_m (optional, default 5000 meters)
-      - max_results (optional, default 20)
+      - radius_m (optional, default 5000 meters, capped at NEARBY_MAX_RADIUS_M)
+      - max_results (optional, default 20, 1..NEARBY_MAX_RESULTS)
 
     Returns JSON: { ambulances: [ { id, driver_id, full_name, lat, lng, distance_m, heading, status, vehicle, photo_url, last_seen } ] }
     """
     lat = request.GET.get('lat')
     lng = request.GET.get('lng')
-    radius_m = float(request.GET.get('radius_m') or 5000.0)
-    max_results = int(request.GET.get('max_results') or 20)
 
     try:
         if lat is None or lng is None:
@@ -329,75 +330,55 @@ def api_nearby_ambulances(request):
             json.dumps({'error': 'Provide lat & lng as query params (floats).'}),
             content_type='application/json'
         )
-
-    # quick bbox filter to avoid full table scan: approximate degrees for radius
-    # 1 deg lat ≈ 111320 meters
     try:
-        deg_lat = radius_m / 111320.0
-        # longitude degrees scale by cos(latitude)
-        deg_lng = radius_m / (111320.0 * max(0.000001, abs(cos(radians(plat)))))
-    except Exception:
-        deg_lat = radius_m / 111320.0
-        deg_lng = radius_m / 111320.0
-
-    min_lat = plat - deg_lat
-    max_lat = plat + deg_lat
-    min_lng = plng - deg_lng
-    max_lng = plng + deg_lng
-
-    q = DriverLive.objects.filter(
-        is_online=True,
-        latitude__isnull=False,
-        longitude__isnull=False,
-        latitude__gte=min_lat, latitude__lte=max_lat,
-        longitude__gte=min_lng, longitude__lte=max_lng
-    ).select_related('driver')[:500]  # safety cap
+        radius_m = float(request.GET.get('radius_m') or 5000.0)
+        max_results = int(request.GET.get('max_results') or 20)
+        if not radius_m > 0 or not 1 <= max_results <= NEARBY_MAX_RESULTS:
+            raise ValueError("out of range")
+    except ValueError:
+        return HttpResponseBadRequest(
+            json.dumps({'error': f'radius_m must be > 0 and max_results between 1 and {NEARBY_MAX_RESULTS}.'}),
+            content_type='application/json'
+        )
+    radius_m = min(radius_m, NEARBY_MAX_RADIUS_M)
 
-    ambulances = []
-    for live in q:
-        try:
-            d_m = haversine_m(plat, plng, float(live.latitude), float(live.longitude))
-        except Exception:
-            continue
-        if d_m > radius_m:
-            continue
+    # grid index lookup instead of a bbox scan over DriverLive
+    hits = driver_index.within(plat, plng, radius_m, limit=max_results)
 
-        driver = live.driver
-        # try to pick a photo
-        doc = DriverDocuments.objects.filter(driver=driver).order_by('-uploaded_at').first()
-        photo_url = ''
-        if doc and getattr(doc, 'photo', None) and hasattr(doc.photo, 'url'):
-            photo_url = request.build_absolute_uri(doc.photo.url)
-        else:
-            if getattr(driver.user, 'profile_picture', None):
-                photo_url = driver.user.profile_picture
+    rows = _live_rows_for(hits)
+    # name / photo / vehicle for all candidates in one cache read (verify.driver_cards)
+    cards = driver_cards.get_cards([live.driver_id for _d, live in rows])
 
+    ambulances = []
+    for d_m, live in rows:
+        card = cards.get(live.driver_id)
+        if not card:
+            continue
         ambulances.append({
             'id': f'driverlive-{live.id}',
-            'driver_id': driver.id,
-            'full_name': getattr(driver, 'full_name', '') or getattr(driver.user, 'get_full_name', '') or str(driver.id),
+            'driver_id': live.driver_id,
+            'full_name': card['full_name'],
             'lat': float(live.latitude),
             'lng': float(live.longitude),
             'distance_m': int(d_m),
             'heading': getattr(live, 'heading', None) or 0,
-            'status': getattr(live, 'is_online', True) and getattr(driver, 'status', '') or 'offline',
-            'vehicle': getattr(driver, 'vehicle_type', '') or '',
-            'photo_url': photo_url,
+            'status': getattr(live, 'is_online', True) and card['status'] or 'offline',
+            'vehicle': card['vehicle'],
+            'photo_url': driver_cards.photo_url(card, request, 'marker'),
+            'photo_webp_url': driver_cards.photo_url(card, request, 'marker', 'webp'),
             'last_seen': live.last_seen.isoformat() if getattr(live, 'last_seen', None) else None,
         })
 
-    # sort by distance and trim
-    ambulances.sort(key=lambda x: x['distance_m'])
-    ambulances = ambulances[:max_results]
-
+    # hits are already sorted by distance and trimmed to max_results
     return JsonResponse({'ambulances': ambulances})
 
 
 @require_POST
 def api_estimate(request):
     """
-    Accepts { pickup: {lat,lng,address}, dropoff: {..} }
+    Accepts { pickup: {lat,lng,address}, dropoff: {..}, ambulance_type (optional) }
     Returns candidates: list of nearby drivers with simple ETA/distance/fare.
+    Fares come from main.pricing (tariff of the type, at the current time of day).
     """
     try:
         payload = json.loads(request.body.decode('utf-8'))
@@ -411,62 +392,59 @@ def api_estimate(request):
         plng = float(pickup.get('lng'))
     except Exception:
         return JsonResponse({'ok': False, 'error': 'pickup lat/lng required'}, status=400)
+    try:
+        tariff = pricing.tariff_for(payload.get('ambulance_type'))
+    except pricing.UnknownAmbulanceType:
+        return JsonResponse({'ok': False, 'error': 'unknown ambulance_type'}, status=400)
 
     # configuration
     MAX_RESULTS = 6
-    AVG_SPEED_KMPH = 25.0  # conservative city speed for ETA estimate
-    BASE_FARE = Decimal(getattr(settings, 'FARE_BASE', '200.00'))  # rupee base
-    PER_KM = Decimal(getattr(settings, 'FARE_PER_KM', '10.0'))
-    PER_MIN = Decimal(getattr(settings, 'FARE_PER_MIN', '2.0'))
-
-    # query DriverLive for online drivers and compute distances
-    q = DriverLive.objects.filter(is_online=True).select_related('driver')[:200]  # limit scan
+    SEARCH_RADIUS_M = 50000.0  # don't offer drivers further than 50km
+
+    # k nearest online drivers from the grid index (ETA is monotonic in distance)
+    hits = driver_index.nearest(plat, plng, MAX_RESULTS, SEARCH_RADIUS_M)
+    rows = [live for _d, live in _live_rows_for(hits)]
+    # distance / ETA for every candidate in one vectorized pass, fares (paise) for the top ones
+    distance_m = haversine_m_batch(plat, plng, [float(live.latitude) for live in rows], [float(live.longitude) for live in rows])
+    eta_s_all = eta_s_batch(distance_m)
+    order = top_n(distance_m, MAX_RESULTS)
+    surge = surge_grid.multiplier(plat, plng)  # in-memory, no query
+    fares = pricing.quote_batch(distance_m[order], eta_s_all[order], tariff=tariff, surge=surge)
+    # driver photo / vehicle for every candidate in one cache read (verify.driver_cards)
+    cards = driver_cards.get_cards([rows[i].driver_id for i in order])
     candidates = []
-    for live in q:
-        if live.latitude is None or live.longitude is None:
-            continue
-        try:
-            d_m = haversine_m(plat, plng, float(live.latitude), float(live.longitude))
-        except Exception:
+    for rank, i in enumerate(order):
+        live = rows[i]
+        eta_s = int(eta_s_all[i])
+        card = cards.get(live.driver_id)
+        if not card:
             continue
-        d_km = Decimal(d_m) / Decimal(1000)
-        eta_min = (d_km / Decimal(AVG_SPEED_KMPH)) * Decimal(60)
-        # simple fare estimate: base + per_km*distance + per_min*eta
-        fare = (BASE_FARE + (PER_KM * d_km) + (PER_MIN * eta_min)).quantize(Decimal('0.01'))
-        driver = live.driver
-        # fetch driver photo (from DriverDocuments.photo) or driver.user.profile_picture
-        doc = DriverDocuments.objects.filter(driver=driver).order_by('-uploaded_at').first()
-        photo_url = ''
-        if doc and getattr(doc, 'photo', None) and hasattr(doc.photo, 'url'):
-            photo_url = request.build_absolute_uri(doc.photo.url)
-        else:
-            if getattr(driver.user, 'profile_picture', None):
-                photo_url = driver.user.profile_picture
         candidates.append({
-            'driver_id': driver.id,
-            'full_name': driver.full_name,
-            'vehicle': getattr(doc, 'vehicle', '') or '',
+            'driver_id': live.driver_id,
+            'full_name': card['full_name'],
+            'vehicle': card['vehicle'],
             'lat': float(live.latitude),
             'lng': float(live.longitude),
-            'distance_m': int(d_m),
-            'eta_s': int((eta_min * Decimal(60)).quantize(Decimal('1'))),  # seconds
-            'eta_min': int(eta_min.quantize(Decimal('1'))),
-            'fare': str(fare),
-            'photo_url': photo_url,
-            'status': driver.status,
+            'distance_m': int(distance_m[i]),
+            'eta_s': eta_s,  # seconds
+            'eta_min': round(eta_s / 60),
+            'fare': pricing.rupees(fares[rank]),
+            'photo_url': driver_cards.photo_url(card, request, 'card'),
+            'photo_webp_url': driver_cards.photo_url(card, request, 'card', 'webp'),
+            'status': card['status'],
         })
 
-    # sort by ETA / distance and return top N
-    candidates.sort(key=lambda x: (x['eta_s'], x['distance_m']))
-    top = candidates[:MAX_RESULTS]
-    return JsonResponse({'ok': True, 'candidates': top})
+    # order is already nearest (= lowest ETA) first, trimmed to MAX_RESULTS
+    return JsonResponse({'ok': True, 'candidates': candidates, 'surge': surge / 1000})
 
 @login_required
 @require_POST
+@idempotent('book_ride')
 def api_book_ride(request):
     """
     Book a ride with a selected driver id.
     POST body: { driver_id: int, pickup: {...}, dropoff: {...} }
+    Send an Idempotency-Key header to make retries safe (main.idempotency).
     """
     try:
         payload = json.loads(request.body.decode('utf-8'))
@@ -493,23 +471,36 @@ def api_book_ride(request):
     except Users.DoesNotExist:
         return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'user missing'}), content_type='application/json')
 
-    # create Ride snapshot
-    ride = Ride.objects.create(
-        user=user,
-        driver=driver,
-        pickup_address=pickup.get('address') or '',
-        pickup_lat=pickup.get('lat'),
-        pickup_lng=pickup.get('lng'),
-        dropoff_address=dropoff.get('address') if dropoff else '',
-        dropoff_lat=dropoff.get('lat') if dropoff else None,
-        dropoff_lng=dropoff.get('lng') if dropoff else None,
-        status='requested',
-    )
-
-    # notify driver via channels
+    # fare quote for this driver (same as api_estimate showed for them), stored on the ride
+    live = DriverLive.objects.filter(driver=driver).only('latitude', 'longitude').first()
+    try:
+        d_m = haversine_m(float(live.latitude), float(live.longitude), float(pickup.get('lat')), float(pickup.get('lng')))
+    except (AttributeError, TypeError, ValueError):
+        d_m = 0.0
     try:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
+        surge = surge_grid.multiplier(float(pickup.get('lat')), float(pickup.get('lng')))
+    except (TypeError, ValueError):
+        surge = pricing.NO_SURGE
+    try:
+        fare_paise = pricing.quote(d_m, int(eta_s_batch([d_m])[0]), payload.get('ambulance_type'), surge=surge)
+    except pricing.UnknownAmbulanceType:
+        return JsonResponse({'ok': False, 'error': 'unknown ambulance_type'}, status=400)
+
+    # create Ride snapshot; the driver notification is an outbox row in the same transaction
+    with transaction.atomic():
+        ride = Ride.objects.create(
+            user=user,
+            driver=driver,
+            pickup_address=pickup.get('address') or '',
+            pickup_lat=pickup.get('lat'),
+            pickup_lng=pickup.get('lng'),
+            dropoff_address=dropoff.get('address') if dropoff else '',
+            dropoff_lat=dropoff.get('lat') if dropoff else None,
+            dropoff_lng=dropoff.get('lng') if dropoff else None,
+            status='requested',
+            estimated_fare=pricing.to_decimal(fare_paise),
+        )
+        outbox.enqueue([(
             f"driver_{driver.id}",
             {
                 'type': 'ride.request',     # consumer handler
@@ -518,16 +509,38 @@ def api_book_ride(request):
                 'pickup_lat': float(ride.pickup_lat),
                 'pickup_lng': float(ride.pickup_lng),
                 'dropoff': ride.dropoff_address,
-            }
-        )
-    except Exception:
-        # non-fatal
-        pass
+            },
+        )])
+        ride_events.record_many(ride.id, [
+            ('ride.requested', {'fare': pricing.rupees(fare_paise), 'surge': surge / 1000}),
+            ('ride.offered', {'driver_id': driver.id, 'distance_m': int(d_m)}),
+        ], actor_type='user', actor_user_id=user.id)
+    # no ride_cache refresh: 'requested' is not active; the driver's accept (main.rides) refreshes it
 
     return JsonResponse({'ok': True, 'ride_id': ride.id})
 
+@sync_to_async
+def _create_matching_ride(nearby, ambulance_type, fare_paise, surge, **fields):
+    """
+    Ride INSERT + wave 0 ride.request outbox rows for the nearby drivers, atomically;
+    later waves are main.dispatch's job once this commits. -> (ride, queued)
+    """
+    with transaction.atomic():
+        ride = Ride.objects.create(**fields)
+        queued = outbox.enqueue(dispatch.offer_messages(ride, nearby, ambulance_type, fare_paise))
+        ride_events.record_many(ride.id, [
+            ('ride.requested', {'ambulance_type': ambulance_type, 'fare': pricing.rupees(fare_paise),
+                                'surge': surge / 1000}),
+        ] + dispatch.offer_events(nearby), actor_type='user', actor_user_id=ride.user_id)
+        transaction.on_commit(lambda: dispatch.dispatcher.track(
+            ride.id, float(ride.pickup_lat), float(ride.pickup_lng), ambulance_type, fare_paise,
+            [driver_id for _d, driver_id, _lat, _lng in nearby]))
+    return ride, queued
+
+
 @require_POST
-def api_request_ambulance_type(request):
+@idempotent('request_ambulance_type')
+async def api_request_ambulance_type(request):
     """
     POST JSON:
       { ambulance_type: 'medwheels_basic',
@@ -535,14 +548,17 @@ def api_request_ambulance_type(request):
         dropoff: { address, lat, lng } (optional) }
 
     Creates a Ride (driver=NULL) and notifies top N nearby online drivers (by distance).
+    The notifications are outbox rows written with the ride; notified = how many were queued.
+    Further, wider waves and ride.matching_failed come from main.dispatch.
     Returns: { ok: True, ride_id: <id>, notified: <n> }
+    A retry with the same Idempotency-Key header gets this response back, no new ride.
     """
     try:
         payload = json.loads(request.body.decode('utf-8'))
     except Exception:
         return HttpResponseBadRequest(json.dumps({'ok': False, 'error': 'invalid json'}), content_type='application/json')
 
-    ambulance_type = payload.get('ambulance_type') or 'medwheels_basic'
+    ambulance_type = payload.get('ambulance_type') or pricing.DEFAULT_TYPE
     pickup = payload.get('pickup') or {}
     dropoff = payload.get('dropoff') or None
 
@@ -552,103 +568,57 @@ def api_request_ambulance_type(request):
         plng = float(pickup.get('lng'))
     except Exception:
         return JsonResponse({'ok': False, 'error': 'pickup lat/lng required'}, status=400)
+    try:
+        tariff = pricing.tariff_for(ambulance_type)
+    except pricing.UnknownAmbulanceType:
+        return JsonResponse({'ok': False, 'error': 'unknown ambulance_type'}, status=400)
 
     # require authenticated user via session (your code uses session['user_id'])
-    user_id = request.session.get('user_id')
+    user_id = await request.session.aget('user_id')
     if not user_id:
         return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'authentication required'}), content_type='application/json')
     try:
-        user = Users.objects.get(pk=user_id)
+        user = await Users.objects.aget(pk=user_id)
     except Users.DoesNotExist:
         return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'user missing'}), content_type='application/json')
 
-    # Create Ride row with driver=NULL (this is allowed in your model)
-    # Use transaction so ride exists before notifications
-    ride = None
+    # Find nearby online drivers from the grid index (sorted by distance asc): dispatch wave 0.
+    # Wider waves follow from main.dispatch if nobody accepts (DISPATCH_WAVES).
+    search_radius_m, notify_top_n = dispatch.WAVES[0]
+
+    nearby = await driver_index.awithin(plat, plng, search_radius_m, limit=notify_top_n)
+
+    # the quote the rider was shown: nearest driver's fare (api_estimate), stored so nothing recomputes it
+    nearest_m = nearby[0][0] if nearby else 0.0
+    surge = surge_grid.multiplier(plat, plng)
+    fare_paise = int(pricing.quote_batch([nearest_m], eta_s_batch([nearest_m]), tariff=tariff, surge=surge)[0])
+
+    # Create Ride row with driver=NULL (this is allowed in your model) and queue the
+    # top N driver notifications in the same transaction (main.outbox)
     try:
-        with transaction.atomic():
-            ride = Ride.objects.create(
-                user=user,
-                driver=None,
-                pickup_address=pickup.get('address') or '',
-                pickup_lat=plat,
-                pickup_lng=plng,
-                dropoff_address=dropoff.get('address') if dropoff else '',
-                dropoff_lat=float(dropoff.get('lat')) if dropoff and dropoff.get('lat') is not None else None,
-                dropoff_lng=float(dropoff.get('lng')) if dropoff and dropoff.get('lng') is not None else None,
-                status='matching',  # indicates matching in progress
-            )
+        ride, notified = await _create_matching_ride(
+            user=user,
+            driver=None,
+            pickup_address=pickup.get('address') or '',
+            pickup_lat=plat,
+            pickup_lng=plng,
+            dropoff_address=dropoff.get('address') if dropoff else '',
+            dropoff_lat=float(dropoff.get('lat')) if dropoff and dropoff.get('lat') is not None else None,
+            dropoff_lng=float(dropoff.get('lng')) if dropoff and dropoff.get('lng') is not None else None,
+            status='matching',  # indicates matching in progress
+            estimated_fare=pricing.to_decimal(fare_paise),
+            nearby=nearby,
+            ambulance_type=ambulance_type,
+            fare_paise=fare_paise,
+            surge=surge,
+        )
     except Exception as e:
         # If creating Ride fails, still return a meaningful error
         return JsonResponse({'ok': False, 'error': 'could not create ride', 'detail': str(e)}, status=500)
 
-    # Find nearby online drivers (DriverLive). We'll compute distances and sort.
-    # Tune these parameters to fit your needs:
-    MAX_SEARCH = 200
-    NOTIFY_TOP_N = 8
-    SEARCH_RADIUS_M = 10000.0  # 10km max (you can tune)
-
-    # Bounding box to reduce DB scan (approx)
-    try:
-        deg_lat = SEARCH_RADIUS_M / 111320.0
-        deg_lng = SEARCH_RADIUS_M / (111320.0 * max(0.000001, abs(cos(radians(plat)))))
-    except Exception:
-        deg_lat = SEARCH_RADIUS_M / 111320.0
-        deg_lng = SEARCH_RADIUS_M / 111320.0
-
-    min_lat = plat - deg_lat
-    max_lat = plat + deg_lat
-    min_lng = plng - deg_lng
-    max_lng = plng + deg_lng
-
-    q = DriverLive.objects.filter(
-        is_online=True,
-        latitude__isnull=False,
-        longitude__isnull=False,
-        latitude__gte=min_lat, latitude__lte=max_lat,
-        longitude__gte=min_lng, longitude__lte=max_lng
-    ).select_related('driver')[:MAX_SEARCH]
-
-    # compute distances
-    nearby = []
-    for live in q:
-        try:
-            d_m = haversine_m(plat, plng, float(live.latitude), float(live.longitude))
-        except Exception:
-            continue
-        if d_m > SEARCH_RADIUS_M:
-            continue
-        nearby.append((d_m, live))
-
-    # sort by distance asc
-    nearby.sort(key=lambda x: x[0])
-
-    # notify top N drivers via channels (group_send to "driver_<id>")
-    channel_layer = get_channel_layer()
-    notified = 0
-    for d_m, live in nearby[:NOTIFY_TOP_N]:
-        try:
-            async_to_sync(channel_layer.group_send)(
-                f"driver_{live.driver.id}",
-                {
-                    'type': 'ride.request',     # your driver consumer must handle this
-                    'ride_id': ride.id,
-                    'pickup': ride.pickup_address,
-                    'pickup_lat': float(ride.pickup_lat),
-                    'pickup_lng': float(ride.pickup_lng),
-                    'dropoff': ride.dropoff_address,
-                    'ambulance_type': ambulance_type,
-                    'distance_m': float(d_m),
-                    'requested_at': ride.requested_at.isoformat() if getattr(ride, 'requested_at', None) else timezone.now().isoformat(),
-                }
-            )
-            notified += 1
-        except Exception:
-            # ignore send errors per driver but continue
-            continue
-
     tracking_url = reverse('find_driver', args=[ride.id])
-    return JsonResponse({'ok': True, 'ride_id': ride.id, 'notified': notified, 'tracking_url': tracking_url})
+    return JsonResponse({'ok': True, 'ride_id': ride.id, 'notified': notified, 'tracking_url': tracking_url,
+                         'fare': pricing.rupees(fare_paise)})
 
 def find_driver_view(request, ride_id):
     """
@@ -693,26 +663,21 @@ def find_driver_view(request, ride_id):
 
     # include driver info if ride already assigned
     driver_data = None
-    if ride.status == 'assigned' and ride.driver:
-        d = ride.driver
-        live = getattr(d, 'live', None)
+    card = driver_cards.get_card(ride.driver_id) if ride.status == 'assigned' and ride.driver_id else None
+    if card:
+        live = DriverLive.objects.filter(driver_id=ride.driver_id).only('latitude', 'longitude').first()
         driver_data = {
-            'id': d.id,
-            'name': getattr(d, 'full_name', '') or str(d.id),
-            'phone': getattr(d.user, 'phone', '') or '',
-            'vehicle_no': getattr(d, 'vehicle_no', '') or getattr(d, 'vehicle_number', ''),
-            'vehicle_type': getattr(d, 'vehicle_type', ''),
-            'photo_url': None,
+            'id': ride.driver_id,
+            'name': card['full_name'],
+            'phone': card['phone'],
+            'vehicle_no': '',
+            'vehicle_type': card['vehicle'],
+            'photo_url': driver_cards.photo_url(card, request, 'card') or None,
+            'photo_webp_url': driver_cards.photo_url(card, request, 'card', 'webp') or None,
             'lat': getattr(live, 'latitude', None),
             'lng': getattr(live, 'longitude', None),
         }
 
-        doc = DriverDocuments.objects.filter(driver=d).order_by('-uploaded_at').first()
-        if doc and getattr(doc, 'photo', None) and hasattr(doc.photo, 'url'):
-            driver_data['photo_url'] = request.build_absolute_uri(doc.photo.url)
-        elif getattr(d.user, 'profile_picture', None):
-            driver_data['photo_url'] = d.user.profile_picture
-
         ride_payload['driver'] = driver_data
 
     return render(request, 'find_driver.html', {
@@ -762,90 +727,69 @@ def api_driver_respond(request):
         )
 
     if action == 'reject':
+        ride_events.record(ride_id, 'ride.offer_rejected', {'driver_id': driver.id},
+                           actor_type='driver', actor_user_id=driver.user_id)
+        dispatch.dispatcher.rejected(ride_id, driver.id)
         return JsonResponse({'ok': True, 'rejected': True})
 
-    try:
-        with transaction.atomic():
-            ride = Ride.objects.select_for_update().get(pk=ride_id)
-
-            # --- Validation ---
-            if ride.driver_id is not None:
-                return JsonResponse({'ok': False, 'assigned': False, 'error': 'already assigned'})
-            if ride.status not in ('matching', 'requested'):
-                return JsonResponse({'ok': False, 'assigned': False, 'error': f'invalid ride status: {ride.status}'})
-
-            # --- Assign driver ---
-            ride.driver = driver
-            ride.status = 'assigned'
-            ride.assigned_at = timezone.now()
-            ride.save()
-
-            # --- Build driver payload ---
-            driver_payload = {
-                'id': driver.id,
-                'name': getattr(driver, 'full_name', '') or str(driver.id),
-                'phone': getattr(driver.user, 'phone', '') or '',
-                'vehicle_no': getattr(driver, 'vehicle_no', '') or getattr(driver, 'vehicle_number', '') or '',
-                'vehicle_type': getattr(driver, 'vehicle_type', '') or '',
-                'photo_url': None,
-                'lat': None,
-                'lng': None,
-                'eta_min': None,
-            }
-
-            # photo url
-            doc = DriverDocuments.objects.filter(driver=driver).order_by('-uploaded_at').first()
-            if doc and getattr(doc, 'photo', None) and hasattr(doc.photo, 'url'):
-                driver_payload['photo_url'] = request.build_absolute_uri(doc.photo.url)
-            elif getattr(driver.user, 'profile_picture', None):
-                driver_payload['photo_url'] = driver.user.profile_picture
-
-            # live coordinates
-            if getattr(driver, 'live', None):
-                driver_payload['lat'] = float(driver.live.latitude) if driver.live.latitude else None
-                driver_payload['lng'] = float(driver.live.longitude) if driver.live.longitude else None
-
-            # --- ETA Calculation ---
-            if driver_payload['lat'] and driver_payload['lng']:
-                try:
-                    d_m = haversine_m(
-                        float(driver_payload['lat']), float(driver_payload['lng']),
-                        float(ride.pickup_lat), float(ride.pickup_lng)
-                    )
-                    d_km = d_m / 1000.0
-                    AVG_SPEED_KMPH = 25.0
-                    driver_payload['eta_min'] = int((d_km / AVG_SPEED_KMPH) * 60)
-                except Exception:
-                    driver_payload['eta_min'] = None
-
-            # --- Notify rider via WebSocket ---
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                f"ride_{ride.id}",
-                {
-                    "type": "ride.assigned",
-                    "driver": driver_payload,
-                    "lat": driver_payload["lat"],
-                    "lng": driver_payload["lng"],
-                    "eta_min": driver_payload["eta_min"],
-                    "fare": getattr(ride, "fare", None),
-                }
-            )
-
-            # --- Notify driver their acceptance succeeded ---
-            async_to_sync(channel_layer.group_send)(
-                f"driver_{driver.id}",
-                {"type": "driver.assignment_confirmed", "ride_id": ride.id}
-            )
-
-            return JsonResponse({'ok': True, 'assigned': True, 'ride_id': ride.id})
-
-    except Ride.DoesNotExist:
+    # Everything the notification needs is read before the compare-and-set, so the row lock
+    # taken by the UPDATE is held only for the UPDATE, its read-back and the outbox INSERT.
+    snapshot = Ride.objects.filter(pk=ride_id).values('pickup_lat', 'pickup_lng', 'estimated_fare').first()
+    if snapshot is None:
         return JsonResponse({'ok': False, 'error': 'ride not found'}, status=404)
-    except Exception as e:
-        return JsonResponse({'ok': False, 'error': 'server error', 'detail': str(e)}, status=500)
 
+    # --- Build driver payload (from the cached driver card) ---
+    card = driver_cards.get_card(driver.id) or {}
+    driver_payload = {
+        'id': driver.id,
+        'name': card.get('full_name') or getattr(driver, 'full_name', '') or str(driver.id),
+        'phone': card.get('phone', ''),
+        'vehicle_no': '',
+        'vehicle_type': card.get('vehicle', ''),
+        'photo_url': driver_cards.photo_url(card, request, 'card') or None,
+        'photo_webp_url': driver_cards.photo_url(card, request, 'card', 'webp') or None,
+        'lat': None,
+        'lng': None,
+        'eta_min': None,
+        'fare': float(snapshot['estimated_fare']) if snapshot['estimated_fare'] is not None else None,
+    }
+
+    # live coordinates (grid index first, DriverLive row otherwise)
+    pos = driver_index.position(driver.id)
+    if pos is None:
+        live = DriverLive.objects.filter(driver_id=driver.id).values_list('latitude', 'longitude').first()
+        pos = (float(live[0]), float(live[1])) if live and live[0] is not None and live[1] is not None else None
+    if pos is not None:
+        driver_payload['lat'], driver_payload['lng'] = pos
+        # --- ETA Calculation ---
+        d_m = haversine_m(pos[0], pos[1], float(snapshot['pickup_lat']), float(snapshot['pickup_lng']))
+        driver_payload['eta_min'] = int(eta_s_batch([d_m])[0] // 60)
+
+    def assigned_messages(ride):
+        # --- Notify rider and driver via WebSocket (outbox rows, committed with the assignment) ---
+        return [
+            (f"ride_{ride.id}", {
+                "type": "ride.assigned",
+                "driver": driver_payload,
+                "lat": driver_payload["lat"],
+                "lng": driver_payload["lng"],
+                "eta_min": driver_payload["eta_min"],
+                "fare": driver_payload["fare"],
+            }),
+            (f"driver_{driver.id}", {"type": "driver.assignment_confirmed", "ride_id": ride.id}),
+        ]
+
+    # compare-and-set: one conditional UPDATE, no row lock (main.rides)
+    outcome = rides.assign(ride_id, driver.id, notify=assigned_messages)
+    ride = outcome.ride
+    if ride is None:
+        return JsonResponse({'ok': False, 'error': 'ride not found'}, status=404)
+    if not outcome.won:
+        if ride.driver_id is not None:
+            return JsonResponse({'ok': False, 'assigned': False, 'error': 'already assigned'})
+        return JsonResponse({'ok': False, 'assigned': False, 'error': f'invalid ride status: {ride.status}'})
 
+    return JsonResponse({'ok': True, 'assigned': True, 'ride_id': ride.id})
 
 
 @require_POST
@@ -859,35 +803,56 @@ def api_cancel_ride(request, ride_id):
     if not user_id:
         return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'auth required'}), content_type='application/json')
 
-    try:
-        ride = Ride.objects.get(pk=ride_id)
-    except Ride.DoesNotExist:
+    def cancelled_messages(ride):
+        # broadcast cancel to rider & (if assigned) driver groups, via the outbox
+        messages = [(f"ride_{ride.id}", {'type': 'ride.cancelled', 'ride_id': ride.id})]
+        if ride.driver_id:
+            messages.append((f"driver_{ride.driver_id}", {'type': 'ride.cancelled', 'ride_id': ride.id}))
+        return messages
+
+    # compare-and-set on (status, owner) (main.rides); 0 rows -> tell the caller why
+    outcome = rides.cancel_by_rider(ride_id, int(user_id), notify=cancelled_messages)
+    ride = outcome.ride
+    if ride is None:
+        if Ride.objects.filter(pk=ride_id).exists():
+            return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'not your ride'}), content_type='application/json')
         return JsonResponse({'ok': False, 'error': 'ride not found'}, status=404)
+    if not outcome.won:
+        return JsonResponse({'ok': False, 'error': f'cannot cancel ride in status {ride.status}'}, status=409)
+    return JsonResponse({'ok': True})
 
-    if ride.user_id != int(user_id):
-        return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'not your ride'}), content_type='application/json')
 
-    # change status and broadcast cancel to driver & rider groups
-    prev_status = ride.status
-    ride.status = 'cancelled'
-    ride.cancelled_at = timezone.now() if hasattr(ride, 'cancelled_at') else timezone.now()
-    ride.save()
+@require_GET
+def api_ride_timeline(request, ride_id):
+    """
+    Audit trail of a ride (main.ride_events), oldest first; ?order=desc for newest first,
+    ?limit=N to cap it. Streamed as a JSON array from an async generator (no worker
+    thread is held while the client reads); visible to the rider, the assigned driver
+    and the CEO.
+    """
+    ride = Ride.objects.filter(pk=ride_id).values('user_id', 'driver__user_id').first()
+    if ride is None:
+        return JsonResponse({'ok': False, 'error': 'ride not found'}, status=404)
+    user_id = request.session.get('user_id')
+    if not user_id:
+        return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'auth required'}), content_type='application/json')
+    if int(user_id) not in (ride['user_id'], ride['driver__user_id']):
+        principal = session_principal(request) if request.session.get('is_ceo') else None
+        if not (principal and principal.is_ceo):
+            return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'not your ride'}), content_type='application/json')
 
-    # notify ride group
     try:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"ride_{ride.id}",
-            {'type': 'ride.cancelled', 'ride_id': ride.id}
-        )
-        # notify driver group if assigned
-        if ride.driver_id:
-            async_to_sync(channel_layer.group_send)(
-                f"driver_{ride.driver_id}",
-                {'type': 'ride.cancelled', 'ride_id': ride.id}
-            )
-    except Exception:
-        pass
-
-    return JsonResponse({'ok': True})
-
+        limit = max(1, int(request.GET['limit'])) if request.GET.get('limit') else None
+    except ValueError:
+        return JsonResponse({'ok': False, 'error': 'invalid limit'}, status=400)
+    events = ride_events.atimeline(ride_id, newest_first=request.GET.get('order') == 'desc', limit=limit)
+
+    async def stream():
+        yield '{"ok": true, "ride_id": %d, "events": [' % ride_id
+        sep = ''
+        async for event in events:
+            yield sep + json.dumps(event)
+            sep = ','
+        yield ']}'
+
+    return StreamingHttpResponse(stream(), content_type='application/json')
@@ -0,0 +1,122 @@
+"""
+Generic write-behind buffer: callers add() rows from the request path and a
+background thread hands them to a flush function in batches, every
+`max_rows` rows or `max_delay_ms` milliseconds, whichever comes first.
+
+The buffer is bounded; when it is full new rows are dropped (and counted)
+rather than blocking the caller. Remaining rows are drained at interpreter
+exit. stats() exposes buffer depth, flush latency and drop counters.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    def __init__(self, name, flush_fn, max_rows=500, max_delay_ms=1000, max_buffer=50000):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.max_rows = max_rows
+        self.max_delay_ms = max_delay_ms
+        self.max_buffer = max_buffer
+        self._buf = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._closing = False
+        self._counters = {
+            'added': 0,
+            'flushed': 0,
+            'dropped': 0,
+            'flushes': 0,
+            'failures': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+        }
+        atexit.register(self.close)
+
+    def add(self, row):
+        """Queue one row. Returns False if the buffer is full and the row was dropped."""
+        with self._cond:
+            if len(self._buf) >= self.max_buffer:
+                self._counters['dropped'] += 1
+                return False
+            self._buf.append(row)
+            self._counters['added'] += 1
+            self._ensure_thread()
+            if len(self._buf) >= self.max_rows:
+                self._cond.notify()
+        return True
+
+    def flush(self):
+        """Write everything currently buffered on the calling thread."""
+        while True:
+            batch = self._take()
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self):
+        """Stop the background thread and drain what is left."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=max(5.0, self.max_delay_ms / 1000.0 * 2))
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            return dict(self._counters, name=self.name, depth=len(self._buf))
+
+    # --- internals ---
+    def _ensure_thread(self):
+        # (re)start lazily, and again after a fork (e.g. gunicorn --preload workers)
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name=f'writebehind-{self.name}', daemon=True)
+        self._thread.start()
+
+    def _take(self):
+        with self._cond:
+            n = min(len(self._buf), self.max_rows)
+            return [self._buf.popleft() for _ in range(n)]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._buf) < self.max_rows and not self._closing:
+                    self._cond.wait(timeout=self.max_delay_ms / 1000.0)
+                if self._closing:
+                    return
+            batch = self._take()
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        try:
+            close_old_connections()
+            self.flush_fn(batch)
+        except Exception as e:
+            logger.exception("write-behind %s: flush of %s rows failed: %s", self.name, len(batch), e)
+            with self._cond:
+                self._counters['failures'] += 1
+                self._counters['dropped'] += len(batch)
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._cond:
+            self._counters['flushes'] += 1
+            self._counters['flushed'] += len(batch)
+            self._counters['last_flush_ms'] = round(elapsed_ms, 3)
+            self._counters['max_flush_ms'] = round(max(self._counters['max_flush_ms'], elapsed_ms), 3)
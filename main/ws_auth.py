@@ -0,0 +1,129 @@
+"""
+Session -> user resolution for websocket handshakes (medwheels.asgi).
+
+A reconnect storm (deploy, network blip) makes every driver and rider socket
+resolve its sessionid at once. Resolved users are kept in a per-process
+TTL/LRU map, so a reconnecting socket costs no DB query. Keys the session
+store does not know (stale cookies) are cached as unknown too: Django never
+adopts a client-supplied key for a new session, so they cannot become valid.
+A session that exists but has no user yet is not cached, so a login is seen
+right away.
+
+forget_session() drops a key here and leaves a short-lived marker in the
+shared cache so other workers drop it too. It is called from the session
+store (main.sessions) whenever a session is deleted: logout, flush(),
+cycle_key().
+
+Settings:
+  WS_SESSION_CACHE_TTL_S   seconds a resolved session is trusted (default 60)
+  WS_SESSION_CACHE_SIZE    sessions kept per process (default 10000)
+"""
+import threading
+import time
+from collections import OrderedDict
+from importlib import import_module
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+TTL_S = float(getattr(settings, 'WS_SESSION_CACHE_TTL_S', 60))
+MAX_SIZE = int(getattr(settings, 'WS_SESSION_CACHE_SIZE', 10000))
+
+# session_key -> (expires_at monotonic, user or UNKNOWN)
+_resolved = OrderedDict()
+_lock = threading.Lock()
+
+UNKNOWN = object()  # cached in place of a user for session keys the store does not have
+
+
+def _gone_key(session_key):
+    return f'ws_session_gone:{session_key}'
+
+
+def _cached(session_key):
+    with _lock:
+        entry = _resolved.get(session_key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del _resolved[session_key]
+            return None
+        _resolved.move_to_end(session_key)
+        return entry[1]
+
+
+def _remember(session_key, user):
+    with _lock:
+        _resolved[session_key] = (time.monotonic() + TTL_S, user)
+        _resolved.move_to_end(session_key)
+        while len(_resolved) > MAX_SIZE:
+            _resolved.popitem(last=False)
+
+
+def forget_session(session_key):
+    """Drop a session from the handshake cache of every worker (logout / flush)."""
+    if not session_key:
+        return
+    with _lock:
+        _resolved.pop(session_key, None)
+    try:
+        cache.set(_gone_key(session_key), 1, int(TTL_S) + 1)
+    except Exception:
+        pass
+
+
+def _load_user(session_key):
+    """
+    Returns (user_or_None_or_UNKNOWN, debug_message). One session read through the configured
+    session engine, then one user lookup:
+      1) Django auth key '_auth_user_id' -> auth user model
+      2) custom 'user_id' -> verify.models.Users
+    """
+    from verify.models import Users
+
+    data = import_module(settings.SESSION_ENGINE).SessionStore(session_key).load()
+    if not data:
+        return UNKNOWN, f"session not found for key {session_key[:8]!r}..."
+
+    auth_uid = data.get('_auth_user_id')
+    if auth_uid:
+        DjangoUser = get_user_model()
+        try:
+            return DjangoUser.objects.get(pk=auth_uid), f"_auth_user_id -> DjangoUser id={auth_uid}"
+        except DjangoUser.DoesNotExist:
+            return None, f"_auth_user_id {auth_uid} not found in DjangoUser"
+
+    custom_uid = data.get('user_id')
+    if custom_uid:
+        try:
+            # custom user id may be stored as int or str; coerce
+            return Users.objects.get(pk=int(custom_uid)), f"user_id -> CustomUsers id={custom_uid}"
+        except Users.DoesNotExist:
+            return None, f"user_id {custom_uid} not found in CustomUsers"
+        except Exception as e:
+            return None, f"user_id lookup failed: {e}"
+
+    return None, "session contains no '_auth_user_id' or 'user_id'"
+
+
+async def resolve_session_user(session_key):
+    """Returns (user_or_None, debug_message); cache hits skip the database entirely."""
+    user = _cached(session_key)
+    if user is UNKNOWN:
+        return None, f"session not found for key {session_key[:8]!r}... (cached)"
+    if user is not None:
+        try:
+            gone = await cache.aget(_gone_key(session_key))
+        except Exception:
+            gone = None
+        if not gone:
+            return user, f"cached -> {type(user).__name__} id={user.pk}"
+        with _lock:
+            _resolved.pop(session_key, None)
+
+    user, dbg = await sync_to_async(_load_user)(session_key)
+    if user is not None:
+        _remember(session_key, user)
+    return (None if user is UNKNOWN else user), dbg
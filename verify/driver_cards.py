@@ -0,0 +1,126 @@
+"""
+Denormalized "driver cards": what the rider and admin views show about a
+driver. That is name, status, vehicle, licence, contact and media URLs,
+taken from Drivers, its Users row and its latest DriverDocuments row.
+
+get_cards(ids) reads the cards for a list of drivers with one cache
+get_many. Misses are built with two queries for the whole batch, instead of
+a DriverDocuments query plus a lazy driver.user per driver. Cards are
+dropped by the receivers in verify.signals when any of the three source rows
+change.
+
+Media fields are site-relative (doc.photo.url); use photo_url(card, request)
+or absolute(request, url) to build links. photo_variants holds the resized
+photo URLs from verify.thumbnails ({} until they have been generated).
+
+Settings:
+  DRIVER_CARD_TTL_S   seconds a card is kept (default 86400)
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
+
+from . import thumbnails
+from .models import DriverDocuments, Drivers
+
+TTL_S = int(getattr(settings, 'DRIVER_CARD_TTL_S', 24 * 3600))
+
+
+def _key(driver_id):
+    return f'driver_card:{driver_id}'
+
+
+def _file_url(f):
+    try:
+        return f.url if f else ''
+    except ValueError:
+        return ''
+
+
+def build_cards(driver_ids):
+    """Build cards for driver_ids straight from the database (two queries)."""
+    # newest document first: same "latest document" as order_by('-uploaded_at').first() per driver
+    drivers = Drivers.objects.filter(pk__in=driver_ids).select_related('user').prefetch_related(
+        Prefetch('documents', queryset=DriverDocuments.objects.order_by('-uploaded_at'), to_attr='docs_newest_first')
+    )
+    cards = {}
+    for d in drivers:
+        doc = d.docs_newest_first[0] if d.docs_newest_first else None
+        user = d.user if d.user_id else None
+        cards[d.id] = {
+            'driver_id': d.id,
+            'user_id': d.user_id,
+            'full_name': d.full_name or str(d.id),
+            'status': d.status,
+            'gender': d.gender,
+            'address': d.address,
+            'experience': d.experience if d.experience is not None else 0,
+            'created_at': d.created_at.isoformat() if d.created_at else None,
+            'phone': (user.phone_number or '') if user else '',
+            'email': (user.email or '') if user else '',
+            'profile_picture': (user.profile_picture or '') if user else '',
+            'vehicle': doc.vehicle if doc else '',
+            'license_no': doc.license_no if doc else '',
+            'photo': _file_url(doc.photo) if doc else '',
+            'license_scan': _file_url(doc.license_scan) if doc else '',
+            'gov_id': _file_url(doc.gov_id) if doc else '',
+            'photo_variants': thumbnails.variant_urls(doc.photo_derivatives) if doc else {},
+        }
+        if doc and not thumbnails.is_current(doc):
+            # older upload (or a new one still queued): make the variants in the background
+            thumbnails.schedule(doc.id)
+    return cards
+
+
+def get_cards(driver_ids):
+    """Return {driver_id: card} for the given ids (unknown ids are left out)."""
+    ids = list(dict.fromkeys(driver_ids))
+    if not ids:
+        return {}
+    try:
+        hits = cache.get_many([_key(i) for i in ids])
+    except Exception:
+        hits = {}
+    cards = {i: hits[_key(i)] for i in ids if _key(i) in hits}
+    missing = [i for i in ids if i not in cards]
+    if missing:
+        built = build_cards(missing)
+        cards.update(built)
+        try:
+            cache.set_many({_key(i): card for i, card in built.items()}, TTL_S)
+        except Exception:
+            pass
+    return cards
+
+
+def get_card(driver_id):
+    return get_cards([driver_id]).get(driver_id)
+
+
+def forget(*driver_ids):
+    keys = [_key(i) for i in driver_ids if i]
+    if keys:
+        try:
+            cache.delete_many(keys)
+        except Exception:
+            pass
+
+
+def absolute(request, url):
+    if not url:
+        return ''
+    return request.build_absolute_uri(url) if request is not None and url.startswith('/') else url
+
+
+def photo_url(card, request=None, size=None, fmt='jpg'):
+    """
+    Document photo if there is one, else the user's profile picture (what the views always showed).
+    With size ('marker', 'card', 'full') the resized variant in fmt ('jpg' or 'webp') is
+    returned when it has been generated, falling back to the original.
+    """
+    if not card:
+        return ''
+    variant = (card.get('photo_variants') or {}).get(size) if size else None
+    if variant:
+        return absolute(request, variant[fmt])
+    return absolute(request, card['photo']) if card['photo'] else card['profile_picture']
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verify', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='drivers',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='drivers_pending_keyset_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verify', '0002_drivers_pending_keyset_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driverdocuments',
+            name='photo_derivatives',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-18 10:14
+
+import verify.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verify', '0003_driverdocuments_photo_derivatives'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='driverdocuments',
+            name='gov_id',
+            field=models.FileField(storage=verify.storage.ContentAddressedStorage(), upload_to='drivers/gov_ids/'),
+        ),
+        migrations.AlterField(
+            model_name='driverdocuments',
+            name='license_scan',
+            field=models.FileField(storage=verify.storage.ContentAddressedStorage(), upload_to='drivers/license_scans/'),
+        ),
+        migrations.AlterField(
+            model_name='driverdocuments',
+            name='photo',
+            field=models.ImageField(storage=verify.storage.ContentAddressedStorage(), upload_to='drivers/photos/'),
+        ),
+    ]
@@ -1,18 +1,20 @@
 # verify/models.py
 from django.db import models
 
+from .storage import document_storage
+
 
 
 class DriverDocuments(models.Model):
     driver = models.ForeignKey('Drivers', models.DO_NOTHING, related_name='documents')
-    photo = models.ImageField(upload_to="drivers/photos/")
+    photo = models.ImageField(upload_to="drivers/photos/", storage=document_storage)
     license_no = models.CharField(max_length=50, unique=True)
-    license_scan = models.FileField(upload_to="drivers/license_scans/")
+    license_scan = models.FileField(upload_to="drivers/license_scans/", storage=document_storage)
     issue_date = models.DateField()
     expiry_date = models.DateField()
     vehicle = models.CharField(max_length=100)
     gov_id_number = models.CharField(max_length=50, unique=True)
-    gov_id = models.FileField(upload_to="drivers/gov_ids/")
+    gov_id = models.FileField(upload_to="drivers/gov_ids/", storage=document_storage)
     uploaded_at = models.DateTimeField(blank=True, null=True)
     verified_by = models.ForeignKey(
         'Employees',
@@ -23,6 +25,8 @@ class DriverDocuments(models.Model):
         related_name='verified_driver_documents'
     )
     status = models.CharField(max_length=8, blank=True, null=True)
+    # {'source': photo.name, 'digest': ...} once resized variants exist (verify.thumbnails)
+    photo_derivatives = models.JSONField(blank=True, null=True)
 
     class Meta:
         managed = True
@@ -58,6 +62,10 @@ class Drivers(models.Model):
     class Meta:
         managed = True
         db_table = 'drivers'
+        indexes = [
+            # keyset pagination of the admin pending list (verify.views.admin_pending_drivers)
+            models.Index(fields=['status', '-created_at', '-id'], name='drivers_pending_keyset_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user_id} - {self.full_name}"
@@ -0,0 +1,88 @@
+"""
+Resolved-principal cache for the CEO / admin checks.
+
+get_principal(user_id) returns Principal(user_id, employee_id, roles) where
+roles is a frozenset of lower-cased role names. It is cached (Redis when
+configured), so ceo_required and the admin APIs authorize without the
+Users -> Employees -> Roles -> EmployeeRoles query chain.
+
+Entries are dropped by the receivers in verify.signals whenever Employees,
+EmployeeRoles or Roles rows change. Bulk updates skip signals, so the TTL
+bounds how long those can go unnoticed.
+
+Settings:
+  PRINCIPAL_CACHE_TTL_S   seconds a resolved principal is kept (default 300)
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import EmployeeRoles, Employees, Users
+
+TTL_S = int(getattr(settings, 'PRINCIPAL_CACHE_TTL_S', 300))
+
+_MISSING = 0  # cached marker: no Users row with that id
+
+
+class Principal(namedtuple('Principal', 'user_id employee_id roles')):
+    __slots__ = ()
+
+    def has_role(self, name):
+        return name.lower() in self.roles
+
+    @property
+    def is_ceo(self):
+        return 'ceo' in self.roles
+
+
+def _key(user_id):
+    return f'principal:{user_id}'
+
+
+def _load(user_id):
+    if not Users.objects.filter(pk=user_id).exists():
+        return _MISSING
+    employee_id = (Employees.objects.filter(user_id=user_id).order_by('id')
+                   .values_list('id', flat=True).first())
+    roles = frozenset()
+    if employee_id is not None:
+        roles = frozenset(
+            name.lower() for name in
+            EmployeeRoles.objects.filter(employee_id=employee_id).values_list('role__name', flat=True)
+        )
+    return Principal(int(user_id), employee_id, roles)
+
+
+def get_principal(user_id):
+    """Principal for a verify.Users id, or None if there is no such user."""
+    if not user_id:
+        return None
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    try:
+        entry = cache.get(_key(user_id))
+    except Exception:
+        entry = None
+    if entry is None:
+        entry = _load(user_id)
+        try:
+            cache.set(_key(user_id), entry, TTL_S)
+        except Exception:
+            pass
+    return entry or None
+
+
+def session_principal(request):
+    return get_principal(request.session.get('user_id'))
+
+
+def forget(*user_ids):
+    keys = [_key(u) for u in user_ids if u]
+    if keys:
+        try:
+            cache.delete_many(keys)
+        except Exception:
+            pass
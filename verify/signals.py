@@ -2,6 +2,7 @@
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
 from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save, pre_save
 from allauth.account.signals import user_signed_up
 from allauth.socialaccount.models import SocialAccount
 from django.db import transaction
@@ -94,3 +95,75 @@ def auth_user_logged_in(sender, request, user, **kwargs):
     # Called when any user logs in (including social logins).
     with transaction.atomic():
         sync_auth_user_to_custom(user, request=request)
+
+
+# --- principal cache invalidation (verify.principals) ---
+
+@receiver(post_save, sender='verify.EmployeeRoles')
+@receiver(post_delete, sender='verify.EmployeeRoles')
+def employee_role_changed(sender, instance, **kwargs):
+    from .models import Employees
+    from .principals import forget
+    forget(*Employees.objects.filter(pk=instance.employee_id).values_list('user_id', flat=True))
+
+
+@receiver(post_save, sender='verify.Roles')
+@receiver(post_delete, sender='verify.Roles')
+def role_changed(sender, instance, **kwargs):
+    # a rename changes the role set of everyone holding it
+    from .models import Employees
+    from .principals import forget
+    forget(*Employees.objects.filter(roles__role_id=instance.pk).values_list('user_id', flat=True).distinct())
+
+
+@receiver(pre_save, sender='verify.Employees')
+def employee_saving(sender, instance, **kwargs):
+    # remember the current owner: if the row moves to another user, both principals change
+    from .models import Employees
+    instance._principal_user_id = (Employees.objects.filter(pk=instance.pk).values_list('user_id', flat=True)
+                                   .first() if instance.pk else None)
+
+
+@receiver(post_save, sender='verify.Employees')
+@receiver(post_delete, sender='verify.Employees')
+def employee_changed(sender, instance, **kwargs):
+    from .principals import forget
+    forget(instance.user_id, getattr(instance, '_principal_user_id', None))
+
+
+@receiver(post_delete, sender='verify.Users')
+def user_deleted(sender, instance, **kwargs):
+    from .principals import forget
+    forget(instance.pk)
+
+
+# --- driver card invalidation (verify.driver_cards) ---
+
+@receiver(post_save, sender='verify.Drivers')
+@receiver(post_delete, sender='verify.Drivers')
+def driver_changed(sender, instance, **kwargs):
+    from .driver_cards import forget
+    forget(instance.pk)
+
+
+@receiver(post_save, sender='verify.DriverDocuments')
+@receiver(post_delete, sender='verify.DriverDocuments')
+def driver_document_changed(sender, instance, **kwargs):
+    from .driver_cards import forget
+    forget(instance.driver_id)
+
+
+@receiver(post_save, sender='verify.DriverDocuments')
+def driver_photo_saved(sender, instance, **kwargs):
+    # resized photo variants are made off the request thread (verify.thumbnails)
+    from . import thumbnails
+    if not thumbnails.is_current(instance):
+        transaction.on_commit(lambda: thumbnails.schedule(instance.pk))
+
+
+@receiver(post_save, sender='verify.Users')
+def driver_user_changed(sender, instance, **kwargs):
+    # phone / email / profile picture are on the card
+    from .driver_cards import forget
+    from .models import Drivers
+    forget(*Drivers.objects.filter(user_id=instance.pk).values_list('id', flat=True))
@@ -0,0 +1,170 @@
+"""
+Content-addressed file storage for driver documents (photo, licence scan,
+government id).
+
+Files are named by the sha256 of their bytes: <upload_to>/<ab>/<digest><ext>.
+An applicant who resubmits the same scan reuses the existing file instead of
+getting a second copy. The URL of a name never points at different bytes, so
+it can be served with a far-future Cache-Control: is_immutable() recognises
+these names (and the verify.thumbnails variants) and verify.views.media adds
+the header when Django serves MEDIA_URL. A web server in front of MEDIA_ROOT
+should do the same for these paths.
+
+Uploads are streamed in chunks to a temp file in the destination directory
+while hashing. The copy stops as soon as it passes the size limit, and the
+finished file is moved into place with os.replace(), so readers never see a
+partial file. Uploads Django already spooled to disk (TemporaryUploadedFile)
+are hashed in place and moved rather than copied.
+
+Because a file can back several rows, delete() only removes it once no
+DriverDocuments row refers to it. Wrap an upload's transaction in
+discard_on_error() so files first written inside it are removed again if
+it raises (a rejected or rolled-back application leaves no orphans).
+
+Settings:
+  DRIVER_DOCUMENT_MAX_BYTES   per-file limit enforced while writing (default 10 MB)
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+MAX_BYTES = int(getattr(settings, 'DRIVER_DOCUMENT_MAX_BYTES', 10 * 1024 * 1024))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# <upload_to>/<ab>/<sha256><ext> (this storage) and derived/drivers/<digest>/<size>.<ext> (verify.thumbnails)
+_IMMUTABLE = re.compile(r'(?:^|/)(?:([0-9a-f]{2})/\1[0-9a-f]{62}\.\w+|derived/drivers/[0-9a-f]{32}/\w+\.\w+)$')
+
+
+def is_immutable(name):
+    """True if name is content-addressed, so its bytes (and URL) never change."""
+    return bool(_IMMUTABLE.search(name.replace('\\', '/')))
+
+
+class FileTooLarge(Exception):
+    def __init__(self, limit):
+        super().__init__(f'file is larger than {limit} bytes')
+        self.limit = limit
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    def __init__(self, max_bytes=None, **kwargs):
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        super().__init__(**kwargs)
+
+    @property
+    def limit(self):
+        return self.max_bytes if self.max_bytes is not None else MAX_BYTES
+
+    def get_available_name(self, name, max_length=None):
+        # the final name comes from the content (see _save); nothing to de-duplicate here
+        return name
+
+    def _digest_name(self, name, digest):
+        directory, base = os.path.split(name)
+        ext = os.path.splitext(base)[1].lower()
+        return os.path.join(directory, digest[:2], digest + ext)
+
+    def _hash_file(self, path):
+        h = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                size += len(chunk)
+                if size > self.limit:
+                    raise FileTooLarge(self.limit)
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _save(self, name, content):
+        if getattr(content, 'size', None) is not None and content.size > self.limit:
+            raise FileTooLarge(self.limit)
+        directory = os.path.dirname(self.path(name))
+        os.makedirs(directory, exist_ok=True)
+
+        if hasattr(content, 'temporary_file_path'):
+            # already on disk: hash it where it is, then move (no copy)
+            tmp_path = content.temporary_file_path()
+            digest = self._hash_file(tmp_path)
+            final = self._digest_name(name, digest)
+            if self.exists(final):
+                return final
+            os.makedirs(os.path.dirname(self.path(final)), exist_ok=True)
+            file_move_safe(tmp_path, self.path(final), allow_overwrite=True)
+            self._written(final)
+        else:
+            h = hashlib.sha256()
+            size = 0
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    for chunk in content.chunks():
+                        size += len(chunk)
+                        if size > self.limit:
+                            raise FileTooLarge(self.limit)
+                        h.update(chunk)
+                        out.write(chunk)
+                    out.flush()
+                    os.fsync(out.fileno())
+                final = self._digest_name(name, h.hexdigest())
+                if self.exists(final):
+                    return final
+                os.makedirs(os.path.dirname(self.path(final)), exist_ok=True)
+                os.replace(tmp_path, self.path(final))
+                self._written(final)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+
+        if self.file_permissions_mode is not None:
+            os.chmod(self.path(final), self.file_permissions_mode)
+        return final.replace('\\', '/')
+
+    def _written(self, name):
+        written = getattr(self._local, 'written', None)
+        if written is not None:
+            written.append(name)
+
+    @contextmanager
+    def discard_on_error(self):
+        """Delete the files first written inside the block if it raises.
+
+        Put it outside transaction.atomic(), so the rows are rolled back before
+        delete() checks whether anything still refers to the files.
+        """
+        outer = getattr(self._local, 'written', None)
+        self._local.written = written = []
+        try:
+            yield
+        except BaseException:
+            for name in written:
+                self.delete(name)
+            raise
+        finally:
+            self._local.written = outer
+            if outer is not None:
+                outer.extend(written)
+
+    def referenced(self, name):
+        from django.db.models import Q
+
+        from .models import DriverDocuments
+        return DriverDocuments.objects.filter(
+            Q(photo=name) | Q(license_scan=name) | Q(gov_id=name)
+        ).exists()
+
+    def delete(self, name):
+        # the same file may back several rows (that is the point); keep it while any row refers to it
+        if not self.referenced(name):
+            super().delete(name)
+
+document_storage = ContentAddressedStorage()
@@ -1,3 +1,346 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import driver_cards, principals, storage, thumbnails, views
+from .decorators import ceo_required
+from .models import DriverDocuments, Drivers, EmployeeRoles, Employees, Organizations, Roles, Users
+from .storage import document_storage
+
+
+@mock.patch('verify.views._ceo_principal', return_value=object())
+class PendingDriversKeysetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        self.drivers = []
+        for n in range(7):
+            user = Users.objects.create(name=f'P{n}', email=f'p{n}@example.com', user_type='driver')
+            driver = Drivers.objects.create(user=user, full_name=f'Pending {n}', gender='female',
+                                            dob='1990-01-01', address='x', experience=n,
+                                            emergency_contact='1', status='pending')
+            self.drivers.append(driver)
+        # pairs sharing a created_at: the id tie-breaker has to keep pages apart
+        stamps = [now, now, now - timedelta(minutes=1), now - timedelta(minutes=2),
+                  now - timedelta(minutes=2), now - timedelta(minutes=3), now - timedelta(minutes=4)]
+        for driver, stamp in zip(self.drivers, stamps):
+            Drivers.objects.filter(pk=driver.pk).update(created_at=stamp)
+        approved = Users.objects.create(name='A', email='a@example.com', user_type='driver')
+        Drivers.objects.create(user=approved, full_name='Approved', gender='male', dob='1990-01-01',
+                               address='x', experience=1, emergency_contact='1', status='approved')
+
+    def get(self, **params):
+        response = self.client.get(reverse('admin_pending_drivers'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_cursor_round_trip(self, _principal):
+        stamp = timezone.now()
+        self.assertEqual(views._decode_cursor(views._encode_cursor(stamp, 42)), (stamp, 42))
+        with self.assertRaises(ValueError):
+            views._decode_cursor('not-a-cursor')
+
+    def test_pages_cover_every_pending_driver_once(self, _principal):
+        page = self.get(limit=3)
+        self.assertEqual(page['total'], 7)
+        seen = [row['id'] for row in page['pending']]
+        while page['next_cursor']:
+            page = self.get(limit=3, cursor=page['next_cursor'])
+            self.assertIsNone(page['total'])  # only counted on the first page
+            seen += [row['id'] for row in page['pending']]
+
+        expected = list(Drivers.objects.filter(status='pending')
+                        .order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_filters_apply_across_pages(self, _principal):
+        page = self.get(limit=2, min_experience=2, max_experience=5)
+        seen = [row['id'] for row in page['pending']]
+        page = self.get(limit=2, min_experience=2, max_experience=5, cursor=page['next_cursor'])
+        seen += [row['id'] for row in page['pending']]
+        self.assertIsNone(page['next_cursor'])
+        self.assertEqual(sorted(seen), sorted(d.id for d in self.drivers[2:6]))
+
+    def test_bad_cursor(self, _principal):
+        response = self.client.get(reverse('admin_pending_drivers'), {'cursor': '!!!'})
+        self.assertEqual(response.status_code, 400)
+
+
+@ceo_required
+def ceo_only(request):
+    return HttpResponse('ok')
+
+
+class PrincipalCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = Users.objects.create(name='Boss', email='boss@example.com', user_type='employee')
+        org = Organizations.objects.create(name='Org')
+        self.employee = Employees.objects.create(user=self.user, organization=org)
+        self.ceo = Roles.objects.create(name='CEO')
+        self.grant = EmployeeRoles.objects.create(employee=self.employee, role=self.ceo)
+
+    def allowed(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        request.session['user_id'] = self.user.id
+        return ceo_only(request).status_code == 200
+
+    def test_principal_is_cached(self):
+        self.assertTrue(principals.get_principal(self.user.id).is_ceo)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.allowed())
+        self.assertIsNone(principals.get_principal(999999))
+        with self.assertNumQueries(0):
+            self.assertIsNone(principals.get_principal(999999))
+
+    def test_role_removal_refuses_at_once(self):
+        self.assertTrue(self.allowed())
+        self.grant.delete()
+        self.assertFalse(self.allowed())
+        EmployeeRoles.objects.create(employee=self.employee, role=self.ceo)
+        self.assertTrue(self.allowed())
+
+    def test_role_rename_applies_at_once(self):
+        self.assertTrue(self.allowed())
+        self.ceo.name = 'Chief'
+        self.ceo.save()
+        self.assertFalse(self.allowed())
+        self.assertTrue(principals.get_principal(self.user.id).has_role('chief'))
+
+    def test_non_employee_is_refused(self):
+        self.assertTrue(self.allowed())
+        self.employee.user = Users.objects.create(name='Other', email='other@example.com', user_type='employee')
+        self.employee.save()
+        self.assertFalse(self.allowed())
+
+
+def make_document(driver, n, uploaded_at, vehicle='BLS'):
+    return DriverDocuments.objects.create(
+        driver=driver, photo=f'drivers/photos/{n}.jpg', license_no=f'L{n}', license_scan=f'drivers/license_scans/{n}.pdf',
+        issue_date='2020-01-01', expiry_date='2030-01-01', vehicle=vehicle, gov_id_number=f'G{n}',
+        gov_id=f'drivers/gov_ids/{n}.pdf', uploaded_at=uploaded_at)
+
+
+@mock.patch('verify.thumbnails.schedule')
+class DriverCardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = Users.objects.create(name='D', email='d@example.com', phone_number='98765', user_type='driver')
+        self.driver = Drivers.objects.create(user=user, full_name='Asha', gender='female', dob='1990-01-01',
+                                             address='x', experience=4, emergency_contact='1', status='approved')
+
+    def test_cards_are_cached(self, _schedule):
+        card = driver_cards.get_card(self.driver.id)
+        self.assertEqual((card['full_name'], card['phone'], card['vehicle']), ('Asha', '98765', ''))
+        with self.assertNumQueries(0):
+            self.assertEqual(driver_cards.get_card(self.driver.id), card)
+        self.assertEqual(driver_cards.get_cards([self.driver.id, 999999]), {self.driver.id: card})
+
+    def test_build_cards_picks_the_newest_document(self, _schedule):
+        now = timezone.now()
+        make_document(self.driver, 1, now - timedelta(days=2), vehicle='BLS')
+        make_document(self.driver, 3, now, vehicle='ICU')
+        make_document(self.driver, 2, now - timedelta(days=1), vehicle='ALS')
+        with self.assertNumQueries(2):
+            card = driver_cards.build_cards([self.driver.id])[self.driver.id]
+        self.assertEqual((card['vehicle'], card['license_no']), ('ICU', 'L3'))
+        self.assertTrue(card['photo'].endswith('3.jpg'))
+
+    def test_driver_edit_invalidates(self, _schedule):
+        self.assertEqual(driver_cards.get_card(self.driver.id)['status'], 'approved')
+        self.driver.status = 'rejected'
+        self.driver.save()
+        self.assertEqual(driver_cards.get_card(self.driver.id)['status'], 'rejected')
+
+    def test_user_edit_invalidates(self, _schedule):
+        driver_cards.get_card(self.driver.id)
+        self.driver.user.phone_number = '11111'
+        self.driver.user.save()
+        self.assertEqual(driver_cards.get_card(self.driver.id)['phone'], '11111')
+
+    def test_document_upload_invalidates(self, _schedule):
+        self.assertEqual(driver_cards.get_card(self.driver.id)['vehicle'], '')
+        doc = make_document(self.driver, 1, timezone.now(), vehicle='ALS')
+        self.assertEqual(driver_cards.get_card(self.driver.id)['vehicle'], 'ALS')
+        doc.delete()
+        self.assertEqual(driver_cards.get_card(self.driver.id)['vehicle'], '')
+
+
+def png_bytes(size=(40, 30), color='red'):
+    buf = io.BytesIO()
+    Image.new('RGB', size, color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+@mock.patch('verify.thumbnails.schedule')
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        cache.clear()
+        user = Users.objects.create(name='D', email='d@example.com', user_type='driver')
+        self.driver = Drivers.objects.create(user=user, full_name='Asha', gender='female', dob='1990-01-01',
+                                             address='x', experience=4, emergency_contact='1', status='approved')
+
+    def document(self, n, photo):
+        doc = make_document(self.driver, n, timezone.now())
+        DriverDocuments.objects.filter(pk=doc.pk).update(photo=photo)
+        return doc.pk
+
+    def derivatives(self, doc_id):
+        return DriverDocuments.objects.get(pk=doc_id).photo_derivatives
+
+    def test_variant_naming(self, _schedule):
+        self.assertEqual(thumbnails.variant_name('ab12', 'card', 'webp'), 'derived/drivers/ab12/card.webp')
+        self.assertEqual(thumbnails.variant_urls(None), {})
+        self.assertEqual(thumbnails.variant_urls({'source': 'x.jpg', 'digest': None}), {})
+        urls = thumbnails.variant_urls({'source': 'x.jpg', 'digest': 'ab12'})
+        self.assertEqual(set(urls), set(thumbnails.SIZES))
+        self.assertEqual(urls['marker']['jpg'], default_storage.url('derived/drivers/ab12/marker.jpg'))
+
+    def test_generate_writes_every_variant(self, _schedule):
+        photo = document_storage.save('drivers/photos/a.png', ContentFile(png_bytes()))
+        doc_id = self.document(1, photo)
+        thumbnails.generate(doc_id)
+
+        derivatives = self.derivatives(doc_id)
+        self.assertEqual(derivatives['source'], photo)
+        self.assertEqual(len(derivatives['digest']), 32)
+        for size in thumbnails.SIZES:
+            for ext, fmt in thumbnails.FORMATS:
+                with default_storage.open(thumbnails.variant_name(derivatives['digest'], size, ext)) as f:
+                    self.assertEqual(Image.open(f).format, fmt)
+        with default_storage.open(thumbnails.variant_name(derivatives['digest'], 'marker', 'jpg')) as f:
+            self.assertLessEqual(max(Image.open(f).size), thumbnails.SIZES['marker'])
+        self.assertTrue(thumbnails.is_current(DriverDocuments.objects.get(pk=doc_id)))
+
+    def test_same_bytes_are_not_encoded_twice(self, _schedule):
+        data = png_bytes()
+        first = self.document(1, document_storage.save('drivers/photos/a.png', ContentFile(data)))
+        # an older upload of the same bytes under a different name
+        second = self.document(2, default_storage.save('legacy/photo.png', ContentFile(data)))
+        thumbnails.generate(first)
+        with mock.patch('verify.thumbnails._render') as render:
+            thumbnails.generate(second)
+        render.assert_not_called()
+        self.assertEqual(self.derivatives(second)['digest'], self.derivatives(first)['digest'])
+        self.assertEqual(self.derivatives(second)['source'], 'legacy/photo.png')
+
+    def test_unreadable_photo_is_recorded(self, _schedule):
+        not_an_image = self.document(1, default_storage.save('drivers/photos/bad.png', ContentFile(b'not a png')))
+        missing = self.document(2, 'drivers/photos/gone.png')
+        for doc_id in (not_an_image, missing):
+            with self.assertLogs('verify.thumbnails', 'WARNING'):
+                thumbnails.generate(doc_id)
+            self.assertIsNone(self.derivatives(doc_id)['digest'])
+            # recorded, so card builds stop queueing it
+            self.assertTrue(thumbnails.is_current(DriverDocuments.objects.get(pk=doc_id)))
+        self.assertEqual(thumbnails.variant_urls(self.derivatives(missing)), {})
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.storage = storage.ContentAddressedStorage(location=self.root, max_bytes=100)
+        user = Users.objects.create(name='D', email='d@example.com', user_type='driver')
+        self.driver = Drivers.objects.create(user=user, full_name='Asha', gender='female', dob='1990-01-01',
+                                             address='x', experience=4, emergency_contact='1', status='pending')
+
+    def leftovers(self):
+        return [name for _, _, files in os.walk(self.root) for name in files if name.startswith('.upload-')]
+
+    def test_identical_content_is_stored_once(self):
+        first = self.storage.save('drivers/gov_ids/a.PDF', ContentFile(b'same scan'))
+        second = self.storage.save('drivers/gov_ids/b.pdf', ContentFile(b'same scan'))
+        other = self.storage.save('drivers/gov_ids/a.pdf', ContentFile(b'another scan'))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        digest = hashlib.sha256(b'same scan').hexdigest()
+        self.assertEqual(first, f'drivers/gov_ids/{digest[:2]}/{digest}.pdf')
+        with self.storage.open(first) as f:
+            self.assertEqual(f.read(), b'same scan')
+        self.assertEqual(len(os.listdir(os.path.dirname(self.storage.path(first)))), 1)
+
+    def test_size_limit(self):
+        with self.assertRaises(storage.FileTooLarge):
+            self.storage.save('drivers/gov_ids/big.pdf', SimpleUploadedFile('big.pdf', b'x' * 101))
+
+        unsized = ContentFile(b'x' * 101)
+        unsized.size = None  # size not known up front: the limit is enforced while copying
+        with self.assertRaises(storage.FileTooLarge):
+            self.storage.save('drivers/gov_ids/big.pdf', unsized)
+        self.assertEqual(self.leftovers(), [])
+        self.assertEqual(os.listdir(self.storage.path('drivers/gov_ids')), [])
+        self.assertTrue(self.storage.save('drivers/gov_ids/ok.pdf', ContentFile(b'x' * 100)))
+
+    def test_spooled_upload_is_moved(self):
+        upload = TemporaryUploadedFile('scan.pdf', 'application/pdf', 0, None)
+        upload.write(b'spooled scan')
+        upload.flush()
+        upload.size = 12
+        spooled = upload.temporary_file_path()
+        name = self.storage.save('drivers/license_scans/scan.pdf', upload)
+        self.assertFalse(os.path.exists(spooled))
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b'spooled scan')
+        upload.close()
+
+    def test_delete_keeps_referenced_files(self):
+        name = self.storage.save('drivers/gov_ids/a.pdf', ContentFile(b'scan'))
+        doc = make_document(self.driver, 1, timezone.now())
+        DriverDocuments.objects.filter(pk=doc.pk).update(gov_id=name)
+        self.storage.delete(name)
+        self.assertTrue(self.storage.exists(name))
+        doc.delete()
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+
+    def test_rolled_back_upload_leaves_no_orphans(self):
+        kept = self.storage.save('drivers/gov_ids/old.pdf', ContentFile(b'already stored'))
+        with self.assertRaises(storage.FileTooLarge):
+            with self.storage.discard_on_error(), transaction.atomic():
+                new = self.storage.save('drivers/photos/new.jpg', ContentFile(b'new photo'))
+                doc = make_document(self.driver, 1, timezone.now())
+                DriverDocuments.objects.filter(pk=doc.pk).update(photo=new)
+                self.storage.save('drivers/gov_ids/dup.pdf', ContentFile(b'already stored'))
+                self.storage.save('drivers/gov_ids/big.pdf', ContentFile(b'x' * 101))
+        self.assertFalse(self.storage.exists(new))
+        self.assertTrue(self.storage.exists(kept))  # written before the block, not by it
+
+    def test_content_addressed_names_are_cached_forever(self):
+        name = self.storage.save('drivers/photos/a.jpg', ContentFile(b'photo'))
+        self.assertTrue(storage.is_immutable(name))
+        self.assertTrue(storage.is_immutable(thumbnails.variant_name('0' * 32, 'card', 'webp')))
+        self.assertFalse(storage.is_immutable('drivers/photos/a.jpg'))
+
+        request = RequestFactory().get('/media/' + name)
+        response = views.media(request, name, document_root=self.root)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn(f'max-age={storage.IMMUTABLE_MAX_AGE}', response['Cache-Control'])
+        with open(os.path.join(self.root, 'plain.txt'), 'w') as f:
+            f.write('mutable')
+        response = views.media(request, 'plain.txt', document_root=self.root)
+        self.assertFalse(response.has_header('Cache-Control'))
@@ -0,0 +1,136 @@
+"""
+Resized variants of driver photos (DriverDocuments.photo).
+
+Map markers, estimate cards and the CEO dashboard used to load the original
+upload. generate(doc_id) writes marker / card / full size versions of the
+photo in WebP and JPEG under a name derived from the sha256 of the source
+bytes (derived/drivers/<digest>/<size>.<ext>). It then records
+{'source': photo.name, 'digest': digest} in DriverDocuments.photo_derivatives
+and drops the driver card, so the next card build picks up the new URLs.
+
+Work runs on a small thread pool, never on the request thread. schedule() is
+called on commit after a document is saved, and by driver_cards when it
+finds a photo without variants, which backfills older uploads. Content-hashed
+names never change, so they can be cached forever, and a photo that was
+already processed is not encoded again.
+
+Settings:
+  DRIVER_PHOTO_SIZES     {name: max edge px} (default marker 96, card 320, full 1024)
+  DRIVER_PHOTO_WORKERS   thread pool size (default 2)
+  DRIVER_PHOTO_QUALITY   WebP / JPEG quality (default 80)
+"""
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+SIZES = dict(getattr(settings, 'DRIVER_PHOTO_SIZES', {'marker': 96, 'card': 320, 'full': 1024}))
+WORKERS = int(getattr(settings, 'DRIVER_PHOTO_WORKERS', 2))
+QUALITY = int(getattr(settings, 'DRIVER_PHOTO_QUALITY', 80))
+FORMATS = (('webp', 'WEBP'), ('jpg', 'JPEG'))
+
+_executor = None
+_pending = set()  # doc ids queued or running in this process
+_lock = threading.Lock()
+
+
+def variant_name(digest, size, ext):
+    return f'derived/drivers/{digest}/{size}.{ext}'
+
+
+def variant_urls(derivatives):
+    """{size: {'webp': url, 'jpg': url}} for a photo_derivatives value, or {}."""
+    if not derivatives or not derivatives.get('digest'):
+        return {}
+    digest = derivatives['digest']
+    return {
+        size: {ext: default_storage.url(variant_name(digest, size, ext)) for ext, _ in FORMATS}
+        for size in SIZES
+    }
+
+
+def is_current(doc):
+    """True if doc.photo already has variants (or there is no photo to process)."""
+    if not doc.photo:
+        return True
+    return (doc.photo_derivatives or {}).get('source') == doc.photo.name
+
+
+def _render(image, max_edge, fmt):
+    from PIL import Image
+
+    im = image.copy()
+    im.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    buf = io.BytesIO()
+    if fmt == 'JPEG':
+        im.save(buf, fmt, quality=QUALITY, optimize=True, progressive=True)
+    else:
+        im.save(buf, fmt, quality=QUALITY, method=4)
+    return buf.getvalue()
+
+
+def generate(doc_id):
+    """Write the variants for one document's photo and record them. Runs on the pool."""
+    from PIL import Image, ImageOps
+
+    from . import driver_cards
+    from .models import DriverDocuments
+
+    doc = DriverDocuments.objects.filter(pk=doc_id).only('id', 'driver_id', 'photo', 'photo_derivatives').first()
+    if doc is None or is_current(doc):
+        return
+    source = doc.photo.name
+    try:
+        with doc.photo.storage.open(source, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        if not default_storage.exists(variant_name(digest, 'full', 'jpg')):
+            image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+            image = image.convert('RGB')
+            for size, max_edge in SIZES.items():
+                for ext, fmt in FORMATS:
+                    name = variant_name(digest, size, ext)
+                    if not default_storage.exists(name):
+                        default_storage.save(name, ContentFile(_render(image, max_edge, fmt)))
+    except (OSError, Image.DecompressionBombError) as e:
+        # missing file or not an image: remember that (digest None) so it is not retried on every card build
+        logger.warning("driver photo %s for document %s not processed: %s", source, doc_id, e)
+        digest = None
+
+    # only if the photo was not replaced meanwhile; .update() skips the post_save receiver
+    DriverDocuments.objects.filter(pk=doc_id, photo=source).update(
+        photo_derivatives={'source': source, 'digest': digest},
+    )
+    driver_cards.forget(doc.driver_id)
+
+
+def _run(doc_id):
+    close_old_connections()
+    try:
+        generate(doc_id)
+    except Exception:
+        logger.exception("driver photo variants failed for document %s", doc_id)
+    finally:
+        with _lock:
+            _pending.discard(doc_id)
+        close_old_connections()
+
+
+def schedule(doc_id):
+    """Queue variant generation for a document; no-op if it is already queued."""
+    global _executor
+    with _lock:
+        if doc_id in _pending:
+            return
+        _pending.add(doc_id)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='driver-photos')
+    _executor.submit(_run, doc_id)
@@ -4,12 +4,18 @@ from django.contrib.auth.hashers import make_password, check_password
 from django.urls import reverse
 from django.contrib.auth import get_user_model, authenticate, login as auth_login
 from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
 from django.contrib.auth import logout as auth_logout
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django.utils.http import urlsafe_base64_decode
 from django.views.decorators.http import require_GET, require_POST
-from .models import Users, Employees, Roles, EmployeeRoles, Drivers, DriverDocuments
+from django.views.static import serve
+from . import driver_cards, storage
+from .models import Users, Roles, Drivers, DriverDocuments
+import base64
 import json
+from datetime import datetime
 from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from django.contrib.auth import get_user_model
 from django.utils.http import urlsafe_base64_encode
@@ -27,6 +33,7 @@ from django.http import HttpResponse
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.shortcuts import get_object_or_404
 from .decorators import ceo_required
+from .principals import get_principal, session_principal
 UserModel = get_user_model()
 
 
@@ -69,15 +76,15 @@ def build_set_password_link(django_user):
 def _is_ceo_or_staff(user):
     return user.is_authenticated and user.is_staff
 def _get_employee_id_from_session(request):
-    user_id = request.session.get('user_id')
-    if not user_id:
-        return None
-    try:
-        user = Users.objects.get(pk=user_id)
-        emp = Employees.objects.filter(user=user).first()
-        return emp.id if emp else None
-    except Users.DoesNotExist:
+    principal = session_principal(request)
+    return principal.employee_id if principal else None
+
+def _ceo_principal(request):
+    """Principal of the session user if they hold the CEO role (cached, see verify.principals)."""
+    if not request.session.get('is_ceo'):
         return None
+    principal = session_principal(request)
+    return principal if principal and principal.is_ceo else None
 
 def signup_login_page(request):
     show = request.GET.get('show', '')
@@ -286,19 +293,15 @@ def ceo_login(request):
     if not check_password(password, custom_user.password or ""):
         return render(request, "admin_login.html", {"error": "Invalid credentials."})
 
-    # verify employee record exists and has CEO role
-    try:
-        employee = Employees.objects.get(user=custom_user)
-    except Employees.DoesNotExist:
+    # verify employee record exists and has CEO role (same cached principal as ceo_required)
+    principal = get_principal(custom_user.id)
+    if not principal or principal.employee_id is None:
         return render(request, "admin_login.html", {"error": "No employee profile found for this user."})
 
-    # find role 'CEO' (case-insensitive)
-    ceo_role = Roles.objects.filter(name__iexact="CEO").first()
-    if not ceo_role:
-        return render(request, "admin_login.html", {"error": "CEO role not configured. Contact admin."})
-
-    has_ceo = EmployeeRoles.objects.filter(employee=employee, role=ceo_role).exists()
-    if not has_ceo:
+    if not principal.is_ceo:
+        # find role 'CEO' (case-insensitive) only to tell a missing role apart
+        if not Roles.objects.filter(name__iexact="CEO").exists():
+            return render(request, "admin_login.html", {"error": "CEO role not configured. Contact admin."})
         return render(request, "admin_login.html", {"error": "You are not authorized to access the admin panel."})
 
     # success: set session
@@ -315,51 +318,86 @@ def ceo_dashboard(request):
     return render(request, "ceo_dashboard.html", {"ceo": request.session.get('user_name')})
 
 
-def driver_application(request):
-    if request.method == "POST":
-        # 1. Create the User (driver applicant)
-        user = Users.objects.create(
-            name=request.POST['fullname'],
-            email=request.POST['email'],
-            phone_number=request.POST['phone'],
-            auth_provider="local",
-            user_type="driver",
-            created_at=timezone.now(),
-        )
+DOCUMENT_FIELDS = ('photo', 'license_scan', 'gov_id')
 
-        # 2. Create the Driver profile
-        driver = Drivers.objects.create(
-            user=user,
-            full_name=request.POST['fullname'],
-            gender=request.POST['gender'],
-            dob=request.POST['dob'],
-            address=request.POST['address'],
-            experience=request.POST['experience'],
-            emergency_contact=request.POST['emergency_contact'],
-            status="pending",
-            created_at=timezone.now(),
-        )
 
-        # 3. Create Driver Documents
-        DriverDocuments.objects.create(
-            driver=driver,
-            photo=request.FILES['photo'],
-            license_no=request.POST['license_no'],
-            license_scan=request.FILES['license_scan'],
-            issue_date=request.POST['issue_date'],
-            expiry_date=request.POST['expiry_date'],
-            vehicle=request.POST['vehicle'],
-            gov_id_number=request.POST['id-card'],
-            gov_id=request.FILES['gov_id'],
-            uploaded_at=timezone.now(),
-            status="pending",
-        )
+def media(request, path, document_root=None, show_indexes=False):
+    # MEDIA_URL when Django serves it; content-addressed names never change, so let clients keep them
+    response = serve(request, path, document_root=document_root, show_indexes=show_indexes)
+    if storage.is_immutable(path):
+        patch_cache_control(response, max_age=storage.IMMUTABLE_MAX_AGE, immutable=True)
+    return response
+
 
+def driver_application(request):
+    if request.method == "POST":
+        # refuse oversized bodies before the multipart parser reads (and spools) them
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        if content_length > len(DOCUMENT_FIELDS) * storage.MAX_BYTES + 64 * 1024:
+            return render(request, "driver_application.html", {"error": "Uploaded files are too large."}, status=413)
+        too_large = [f for f in DOCUMENT_FIELDS if f in request.FILES and request.FILES[f].size > storage.MAX_BYTES]
+        if too_large:
+            limit_mb = storage.MAX_BYTES // (1024 * 1024)
+            return render(request, "driver_application.html",
+                          {"error": f"Each document must be under {limit_mb} MB ({', '.join(too_large)})."}, status=413)
+        try:
+            # files first written by a rolled-back application are removed again
+            with storage.document_storage.discard_on_error(), transaction.atomic():
+                driver = _create_driver_application(request)
+        except storage.FileTooLarge:
+            return render(request, "driver_application.html", {"error": "Uploaded files are too large."}, status=413)
         return render(request, "driver_success.html", {"driver": driver})
 
     return render(request, "driver_application.html")
 
 
+def _create_driver_application(request):
+    # called inside a transaction: a rejected upload must not leave a half-created applicant.
+    # Documents go to verify.storage (content-addressed, streamed, written atomically).
+
+    # 1. Create the User (driver applicant)
+    user = Users.objects.create(
+        name=request.POST['fullname'],
+        email=request.POST['email'],
+        phone_number=request.POST['phone'],
+        auth_provider="local",
+        user_type="driver",
+        created_at=timezone.now(),
+    )
+
+    # 2. Create the Driver profile
+    driver = Drivers.objects.create(
+        user=user,
+        full_name=request.POST['fullname'],
+        gender=request.POST['gender'],
+        dob=request.POST['dob'],
+        address=request.POST['address'],
+        experience=request.POST['experience'],
+        emergency_contact=request.POST['emergency_contact'],
+        status="pending",
+        created_at=timezone.now(),
+    )
+
+    # 3. Create Driver Documents
+    DriverDocuments.objects.create(
+        driver=driver,
+        photo=request.FILES['photo'],
+        license_no=request.POST['license_no'],
+        license_scan=request.FILES['license_scan'],
+        issue_date=request.POST['issue_date'],
+        expiry_date=request.POST['expiry_date'],
+        vehicle=request.POST['vehicle'],
+        gov_id_number=request.POST['id-card'],
+        gov_id=request.FILES['gov_id'],
+        uploaded_at=timezone.now(),
+        status="pending",
+    )
+    return driver
+
+
 def _driver_to_dict(driver, request=None):
     # build a JSON-safe dict to send to front-end
     docs = list(driver.documents.all())  # related_name 'documents'
@@ -387,43 +425,109 @@ def _driver_to_dict(driver, request=None):
         'media': media,
     }
 
+PENDING_PAGE_SIZE = int(getattr(settings, 'ADMIN_PENDING_PAGE_SIZE', 50))
+PENDING_PAGE_MAX = int(getattr(settings, 'ADMIN_PENDING_PAGE_MAX', 200))
+
+
+def _encode_cursor(created_at, driver_id):
+    raw = json.dumps([created_at.isoformat(), driver_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """(created_at, id) of the last row of the previous page; ValueError if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, driver_id = json.loads(raw)
+        created_at = datetime.fromisoformat(created_at)
+        return created_at, int(driver_id)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+
+def _int_param(request, name):
+    value = request.GET.get(name)
+    if value in (None, ''):
+        return None
+    return int(value)  # ValueError -> 400
+
+
 @require_GET
 def admin_pending_drivers(request):
-    if not request.session.get('is_ceo'):
+    """
+    One page of pending drivers, newest first.
+
+    Keyset pagination on (created_at, id) (index drivers_pending_keyset_idx):
+    pass the returned next_cursor as ?cursor= for the next page. Filters:
+    vehicle (substring of any uploaded document's vehicle), min_experience,
+    max_experience. limit defaults to ADMIN_PENDING_PAGE_SIZE.
+    Cost is constant per page: the keyset query (plus a count on the first
+    page) and one driver_cards read, whose misses are built in two queries.
+    """
+    principal = _ceo_principal(request)
+    if not principal:
         return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'forbidden'}), content_type='application/json')
-    qs = Drivers.objects.filter(status='pending').order_by('-created_at')
+    try:
+        limit = min(max(_int_param(request, 'limit') or PENDING_PAGE_SIZE, 1), PENDING_PAGE_MAX)
+        min_exp = _int_param(request, 'min_experience')
+        max_exp = _int_param(request, 'max_experience')
+        cursor = _decode_cursor(request.GET['cursor']) if request.GET.get('cursor') else None
+    except ValueError as e:
+        return HttpResponseBadRequest(json.dumps({'ok': False, 'error': str(e)}), content_type='application/json')
+    vehicle = (request.GET.get('vehicle') or '').strip()
+
+    qs = Drivers.objects.filter(status='pending')
+    if min_exp is not None:
+        qs = qs.filter(experience__gte=min_exp)
+    if max_exp is not None:
+        qs = qs.filter(experience__lte=max_exp)
+    if vehicle:
+        qs = qs.filter(Exists(DriverDocuments.objects.filter(driver=OuterRef('pk'), vehicle__icontains=vehicle)))
+    total = qs.count() if cursor is None else None
+    if cursor is not None:
+        created_at, last_id = cursor
+        qs = qs.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=last_id))
+
+    # one extra row tells us whether there is a next page
+    rows = list(qs.order_by('-created_at', '-id').values_list('id', 'created_at')[:limit + 1])
+    next_cursor = _encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    ids = [driver_id for driver_id, _ in rows[:limit]]
+    cards = driver_cards.get_cards(ids)
     out = []
-    for d in qs:
-        doc = DriverDocuments.objects.filter(driver=d).order_by('-uploaded_at').first()
+    for driver_id in ids:
+        card = cards.get(driver_id)
+        if not card:
+            continue
         media = {}
-        if doc:
-            if getattr(doc, 'photo', None) and hasattr(doc.photo, 'url'):
-                media['photo_url'] = request.build_absolute_uri(doc.photo.url)
-            if getattr(doc, 'license_scan', None) and hasattr(doc.license_scan, 'url'):
-                media['license_scan_url'] = request.build_absolute_uri(doc.license_scan.url)
-            if getattr(doc, 'gov_id', None) and hasattr(doc.gov_id, 'url'):
-                media['gov_id_url'] = request.build_absolute_uri(doc.gov_id.url)
+        for field, name in (('photo', 'photo_url'), ('license_scan', 'license_scan_url'), ('gov_id', 'gov_id_url')):
+            if card[field]:
+                media[name] = driver_cards.absolute(request, card[field])
+        if card['photo']:
+            # resized variants for the list avatar / details pane (original stays in photo_url)
+            media['photo_thumb_url'] = driver_cards.photo_url(card, request, 'marker')
+            media['photo_card_url'] = driver_cards.photo_url(card, request, 'card')
 
         out.append({
-            'id': d.id,
-            'full_name': d.full_name,
-            'phone': getattr(d.user, 'phone_number', '') if d.user_id else '',
-            'email': getattr(d.user, 'email', '') if d.user_id else '',
-            'experience': d.experience if d.experience is not None else 0,
-            'gender': d.gender,
-            'address': d.address,
-            'license_no': getattr(doc, 'license_no', '') if doc else '',
-            'vehicle': getattr(doc, 'vehicle', '') if doc else '',
-            'status': d.status,
-            'created_at': d.created_at.isoformat() if d.created_at else None,
+            'id': driver_id,
+            'full_name': card['full_name'],
+            'phone': card['phone'],
+            'email': card['email'],
+            'experience': card['experience'],
+            'gender': card['gender'],
+            'address': card['address'],
+            'license_no': card['license_no'],
+            'vehicle': card['vehicle'],
+            'status': card['status'],
+            'created_at': card['created_at'],
             'media': media
         })
-    return JsonResponse({'pending': out})
+    return JsonResponse({'pending': out, 'next_cursor': next_cursor, 'total': total})
 
 
 @require_POST
 def admin_approve_driver(request):
-    if not request.session.get('is_ceo'):
+    principal = _ceo_principal(request)
+    if not principal:
         return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'forbidden'}), content_type='application/json')
     try:
         payload = json.loads(request.body.decode('utf-8'))
@@ -434,29 +538,19 @@ def admin_approve_driver(request):
     if not driver_id:
         return JsonResponse({'ok': False, 'error': 'driver_id required'}, status=400)
 
-    # restrict to CEO: here you should check session or Django auth permissions.
-    # Example check (you should replace with your real check)
-    if not request.session.get('user_id'):
-        return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'forbidden'}), content_type='application/json')
-
     with transaction.atomic():
         driver = get_object_or_404(Drivers, pk=driver_id)
-        # set verified_by to current employee if available
-        # you may map session user -> Employees row; here we leave null or try to find employee
-        emp = None
-        emp_user_id = request.session.get('user_id')
-        if emp_user_id:
-            # try to map to your Employees record (if exists)
-            emp = Employees.objects.filter(user__id=emp_user_id).first()
+        # set verified_by to current employee (already resolved by _ceo_principal)
+        emp = principal.employee_id
         driver.status = 'approved'
-        driver.verified_by = emp
+        driver.verified_by_id = emp
         driver.save()
 
         # ensure there's a DriverDocuments record (if applicable)
         doc = DriverDocuments.objects.filter(driver=driver).order_by('-uploaded_at').first()
         if doc:
             doc.status = 'approved'
-            doc.verified_by = emp
+            doc.verified_by_id = emp
             # ensure uploaded_at exists (optional)
             if not doc.uploaded_at:
                 doc.uploaded_at = timezone.now()
@@ -511,7 +605,8 @@ MedWheels Team
 
 @require_POST
 def admin_reject_driver(request):
-    if not request.session.get('is_ceo'):
+    principal = _ceo_principal(request)
+    if not principal:
         return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'forbidden'}), content_type='application/json')
     try:
         payload = json.loads(request.body.decode('utf-8'))
@@ -523,24 +618,18 @@ def admin_reject_driver(request):
     if not driver_id:
         return JsonResponse({'ok': False, 'error': 'driver_id required'}, status=400)
 
-    if not request.session.get('user_id'):
-        return HttpResponseForbidden(json.dumps({'ok': False, 'error': 'forbidden'}), content_type='application/json')
-
     with transaction.atomic():
         driver = get_object_or_404(Drivers, pk=driver_id)
-        emp = None
-        emp_user_id = request.session.get('user_id')
-        if emp_user_id:
-            emp = Employees.objects.filter(user__id=emp_user_id).first()
+        emp = principal.employee_id
         driver.status = 'rejected'
         # optionally save reason somewhere (add a field or related model)
-        driver.verified_by = emp
+        driver.verified_by_id = emp
         driver.save()
 
         doc = DriverDocuments.objects.filter(driver=driver).order_by('-uploaded_at').first()
         if doc:
             doc.status = 'rejected'
-            doc.verified_by = emp
+            doc.verified_by_id = emp
             if not doc.uploaded_at:
                 doc.uploaded_at = timezone.now()
             doc.save()
@@ -709,6 +798,10 @@ def driver_login(request):
 def driver_logout(request):
     
     from django.contrib.auth import logout as auth_logout
+    from main import outbox
+    from main.live import fix_messages
+    from main.models import DriverLive
+    from main.spatial import driver_index
     # if driver, mark live offline
     try:
         if request.session.get('is_driver'):
@@ -718,23 +811,12 @@ def driver_logout(request):
                 try:
                     driver = Drivers.objects.filter(user__id=user_id).first()
                     if driver:
-                        DriverLive.objects.filter(driver=driver).update(is_online=False, last_seen=timezone.now())
-                        # notify via channel layer that driver is offline
-                        try:
-                            channel_layer = get_channel_layer()
-                            async_to_sync(channel_layer.group_send)(
-                                f"driver_{driver.id}",
-                                {
-                                    'type': 'location.update',
-                                    'driver_id': driver.id,
-                                    'lat': None,
-                                    'lng': None,
-                                    'is_online': False,
-                                    'last_seen': timezone.now().isoformat()
-                                }
-                            )
-                        except Exception:
-                            pass
+                        # offline flag and the "driver is offline" notification (driver group + map
+                        # viewers) commit together; main.outbox sends it
+                        with transaction.atomic():
+                            DriverLive.objects.filter(driver=driver).update(is_online=False, last_seen=timezone.now())
+                            outbox.enqueue(fix_messages(driver.id, None, None, False, timezone.now(), []))
+                        driver_index.remove(driver.id)
                 except Exception:
                     pass
     except Exception: